@@ -7,6 +7,7 @@ import threading
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from redis_cache import RedisCache
+from job_queue import JobQueue, RedisJobStore, LocalJobStore
 import logging
 
 redis_cache = RedisCache()
@@ -25,13 +26,32 @@ app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 # Configure filestore path from environment variable
 app.config['FILESTORE_PATH'] = os.environ.get('FILESTORE_PATH', '/app/filestore')
 
+# Number of worker processes used to sum mask volumes when building cohort aggregates (1 = serial).
+# Every gunicorn worker has its own pool, so by default the cores are shared between them
+# (WEB_CONCURRENCY, the gunicorn worker count of the Dockerfile).
+web_workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+app.config['AGGREGATION_WORKERS'] = int(os.environ.get(
+    'AGGREGATION_WORKERS', max(1, (os.cpu_count() or 1) // max(1, web_workers))
+))
+
+# Background jobs: 'redis' shares job state across workers, 'local' keeps it in process (tests, local runs)
+app.config['JOB_BACKEND'] = os.environ.get('JOB_BACKEND', 'redis')
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+
+# Single-flight locks for aggregate and viewer builds: 'redis' works across hosts, 'file' only on one host
+app.config['LOCK_BACKEND'] = os.environ.get('LOCK_BACKEND', 'redis')
+
 # Log configuration (without sensitive data)
 app.logger.info(f"Database URL: {database_url.split('@')[1] if '@' in database_url else 'Invalid format'}")
 app.logger.info(f"Filestore path: {app.config['FILESTORE_PATH']}")
+app.logger.info(f"Aggregation workers: {app.config['AGGREGATION_WORKERS']}")
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+job_store = RedisJobStore(redis_cache) if app.config['JOB_BACKEND'] == 'redis' else LocalJobStore()
+job_queue = JobQueue(app, job_store, max_workers=app.config['JOB_WORKERS'])
+
 import models
 
 # Thread-safe startup management
@@ -114,12 +134,16 @@ from blueprints.filters import filters
 from blueprints.chart import chart
 from blueprints.glass_brain import glass_brain_bp
 from blueprints.patient_queries import patient_queries
+from blueprints.jobs import jobs
+from blueprints.volumes import volumes
 
 app.register_blueprint(viewer)
 app.register_blueprint(filters)
 app.register_blueprint(chart)
 app.register_blueprint(glass_brain_bp)
 app.register_blueprint(patient_queries)
+app.register_blueprint(jobs)
+app.register_blueprint(volumes)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
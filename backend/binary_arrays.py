@@ -0,0 +1,181 @@
+import gzip
+import json
+import hashlib
+import struct
+import numpy as np
+from flask import Response, request
+
+# Binary envelope for shipping NumPy arrays to the browser:
+#
+#   bytes 0-3   magic b'NDA1'
+#   bytes 4-7   little-endian uint32 length of the JSON header
+#   header      UTF-8 JSON {"arrays": {name: {"dtype", "shape", "offset"}}, ...metadata},
+#               space-padded so the first array starts on an 8-byte boundary
+#   arrays      raw little-endian C-order data, each starting at its absolute "offset"
+#               (a multiple of 8, so typed-array views need no copy)
+#
+# Volumes are sent in a 'dense' layout (one 'data' array) or, when few voxels are
+# nonzero, a 'sparse' one: 'deltas' (uint32 gaps between the C-order linear indices of
+# the nonzero voxels, the first one being its index) and their 'values'.
+#
+# frontend/src/lib/binaryArrays.ts parses it.
+
+MAGIC = b'NDA1'
+ALIGNMENT = 8
+
+# Content types the envelope is served as
+CONTENT_TYPE = 'application/octet-stream'
+
+# Fast gzip level: sparse volumes compress well even at low levels
+GZIP_LEVEL = 5
+
+# Quantized encodings: dtype per encoding name, float32 is sent as is
+QUANTIZED_DTYPES = {'uint8': np.uint8, 'uint16': np.uint16}
+
+# Volume layouts; 'auto' picks whichever is smaller for the volume at hand
+VOLUME_LAYOUTS = ['auto', 'dense', 'sparse']
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def pack_arrays(arrays, **metadata):
+    """
+    Pack named arrays and JSON-serializable metadata into one binary envelope.
+
+    Args:
+        arrays (dict): Name -> array; converted to little-endian C order
+        **metadata: Extra header fields, e.g. dims or affine
+
+    Returns:
+        bytes: The envelope
+    """
+    prepared = {
+        name: np.ascontiguousarray(array, dtype=np.asarray(array).dtype.newbyteorder('<'))
+        for name, array in arrays.items()
+    }
+
+    # Offsets depend on the header length, which depends on the offsets: lay out the
+    # arrays relative to the data start, then shift them once the header is sized
+    layout = {}
+    relative = 0
+    for name, array in prepared.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': relative}
+        relative = _aligned(relative + array.nbytes)
+
+    def encode_header(data_start):
+        header = {
+            'arrays': {name: {**entry, 'offset': entry['offset'] + data_start} for name, entry in layout.items()},
+            **metadata
+        }
+        return json.dumps(header, separators=(',', ':')).encode('utf-8')
+
+    # Reserve room for the widest offsets, then pad the header to that size
+    data_start = _aligned(len(MAGIC) + 4 + len(encode_header(0)) + 16 * max(len(layout), 1))
+    header = encode_header(data_start)
+    header = header + b' ' * (data_start - len(MAGIC) - 4 - len(header))
+
+    chunks = [MAGIC, struct.pack('<I', len(header)), header]
+    position = data_start
+    for name, array in prepared.items():
+        offset = layout[name]['offset'] + data_start
+        chunks.append(b'\0' * (offset - position))
+        chunks.append(array.tobytes())
+        position = offset + array.nbytes
+    return b''.join(chunks)
+
+def quantize(values, encoding):
+    """
+    Quantize values in [0, 1] to an encoding from QUANTIZED_DTYPES (or keep float32).
+
+    Returns:
+        tuple: (array, scale); the client recovers values as array * scale
+    """
+    if encoding == 'float32':
+        return np.asarray(values, dtype=np.float32), 1.0
+    dtype = QUANTIZED_DTYPES[encoding]
+    levels = np.iinfo(dtype).max
+    quantized = np.rint(np.clip(values, 0, 1) * levels).astype(dtype)
+    return quantized, 1.0 / levels
+
+def prefers_sparse(volume):
+    """Whether the sparse layout is smaller: 4 index bytes plus a value per nonzero voxel, against a value per voxel."""
+    return np.count_nonzero(volume) * (4 + volume.itemsize) < volume.size * volume.itemsize
+
+def pack_volume(volume, layout='auto', **metadata):
+    """
+    Pack a volume in the dense or sparse layout, with dims and layout in the header.
+
+    Args:
+        volume (ndarray): Volume to send, already in its wire dtype (see quantize)
+        layout (str): 'dense', 'sparse' or 'auto'
+        **metadata: Extra header fields, e.g. affine or scale
+
+    Returns:
+        bytes: The envelope
+    """
+    if layout == 'auto':
+        layout = 'sparse' if prefers_sparse(volume) else 'dense'
+    if layout == 'dense':
+        return pack_arrays({'data': volume}, layout='dense', dims=list(volume.shape), **metadata)
+
+    flat = volume.ravel()
+    indices = np.flatnonzero(flat)
+    # Gaps between consecutive indices are small in clustered masks and gzip well
+    deltas = np.diff(indices, prepend=0).astype(np.uint32)
+    return pack_arrays(
+        {'deltas': deltas, 'values': flat[indices]},
+        layout='sparse', dims=list(volume.shape), count=int(indices.size), **metadata
+    )
+
+def payload_etag(payload):
+    """Strong ETag for a payload: a hash of its bytes."""
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+def _cache_headers(response, max_age):
+    response.headers['Cache-Control'] = f"public, max-age={max_age}" if max_age else 'no-cache'
+    response.vary.add('Accept-Encoding')
+
+def _accepts_gzip():
+    return 'gzip' in request.accept_encodings
+
+def not_modified(etag, max_age=0, compress=False):
+    """
+    A 304 response if the client already holds the representation with this ETag, else
+    None, so callers can skip loading and encoding the payload altogether.
+    """
+    if compress and _accepts_gzip():
+        etag = f"{etag}-gz"
+    if not request.if_none_match.contains(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    _cache_headers(response, max_age)
+    return response
+
+def binary_response(payload, etag=None, max_age=0, content_type=CONTENT_TYPE, compress=False):
+    """
+    Serve a packed payload with a strong ETag, answering 304 when the client's copy is current.
+
+    Args:
+        payload (bytes): Envelope from pack_arrays (or any bytes)
+        etag (str, optional): ETag to send; defaults to payload_etag(payload)
+        max_age (int): Seconds clients may reuse the payload without revalidating;
+            0 makes them revalidate every time (Cache-Control: no-cache)
+        content_type (str): Response content type
+        compress (bool): gzip the payload (Content-Encoding) if the client accepts it
+    """
+    etag = etag or payload_etag(payload)
+    gzipped = compress and _accepts_gzip()
+    if gzipped:
+        # Each encoding is its own representation, so it needs its own strong ETag
+        etag = f"{etag}-gz"
+        if request.if_none_match.contains(etag):
+            return not_modified(etag, max_age)
+        payload = gzip.compress(payload, GZIP_LEVEL)
+
+    response = Response(payload, mimetype=content_type)
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    _cache_headers(response, max_age)
+    return response.make_conditional(request)
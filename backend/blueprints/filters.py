@@ -1,23 +1,44 @@
 from flask import Blueprint, jsonify, request, current_app, session
 import os
-import sys
-from db_loading.generate_display_nifti import generate_display_nifti, get_filtered_tumor_ids, get_filtered_mri_ids, get_filtered_dose_ids
-from models import Patients, TumorMask, DoseMask, MRIMask, NiftiData
-from app import db
-from sqlalchemy import distinct
-from datetime import date
+import json
+import hashlib
+from db_loading.generate_display_nifti import generate_display_nifti
+from db_loading.aggregate_cache import (
+    MASK_CACHE_SUBDIRS, unlink_filter, release_filter, get_statistic_link_path, find_filter_aggregate, criteria_cache_key,
+    normalize_criteria
+)
+from db_loading.criteria_compiler import cohort_counts_query
+from db_loading.columnar_index import get_columnar_index
+from db_loading.voxel_statistics import parse_statistic, get_percentile_range
+from db_loading.filter_options import get_cached_filter_options
 
 filters = Blueprint('filters', __name__, url_prefix='/api')
 
+# Cached statistics are keyed by dataset version; the TTL only reclaims stale entries
+STATISTICS_CACHE_TTL = 24 * 60 * 60
+
 def get_user_id():
     """Get the current user's ID from the session."""
     return session.get('user_id', 'anonymous')
 
-def get_user_filters_key():
-    """Get the Redis key for the current user's filters."""
-    user_id = get_user_id()
+def get_user_filters_key(user_id=None):
+    """Get the Redis key for a user's filters, the current user's by default."""
+    user_id = user_id or get_user_id()
     return f'stored_filters:{user_id}'
 
+def get_filter_result_key(user_id, filter_id):
+    """
+    Get the Redis key for the outcome of a filter's latest aggregation job.
+    
+    Kept apart from the user's filters so a finishing job never rewrites them.
+    """
+    return f'filter_result:{user_id}:{filter_id}'
+
+def filter_criteria_key(criteria):
+    """Hash of a filter's normalized criteria, telling apart the jobs of successive edits of a filter."""
+    encoded = json.dumps(normalize_criteria(criteria), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:32]
+
 def get_default_filters():
     """Create a fresh copy of default filters for each request."""
     return {
@@ -27,16 +48,15 @@ def get_default_filters():
         }
     }
 
-def get_stored_filters():
+def get_stored_filters(filters_key=None):
     """Get filters stored in Redis for the current user, fallback to default if none exist."""
+    filters_key = filters_key or get_user_filters_key()
     try:
         from app import redis_cache
         # Try to get filters from Redis for the current user
-        filters_key = get_user_filters_key()
         stored_filters = redis_cache.get_path(filters_key)
         
         if stored_filters:
-            import json
             # Handle Redis returning bytes
             if isinstance(stored_filters, bytes):
                 stored_filters = stored_filters.decode('utf-8')
@@ -45,173 +65,165 @@ def get_stored_filters():
             # Return default filters if none stored for this user
             return get_default_filters()
     except Exception as e:
-        print(f"Error getting stored filters for user {get_user_id()}: {e}")
+        print(f"Error getting stored filters {filters_key}: {e}")
         return get_default_filters()
 
-def store_filters(filters_dict):
+def store_filters(filters_dict, filters_key=None):
     """Store filters in Redis for the current user."""
+    filters_key = filters_key or get_user_filters_key()
     try:
         from app import redis_cache
-        import json
-        filters_key = get_user_filters_key()
         redis_cache.set_path(filters_key, json.dumps(filters_dict))
     except Exception as e:
-        print(f"Error storing filters for user {get_user_id()}: {e}")
+        print(f"Error storing filters {filters_key}: {e}")
 
-def get_filter_options():
-    """Generate filter options based on actual database data."""
-    try:
-        # Patient demographic filters
-        origin_cancers = db.session.query(distinct(Patients.origin_cancer)).all()
-        origin_cancer_options = [cancer[0] for cancer in origin_cancers if cancer[0]]
-        
-        sex_options = ['M', 'F']
-        
-        # Age ranges - calculate from DOB
-        current_date = date.today()
-        age_ranges = [
-            {'label': 'Under 30', 'min': 0, 'max': 29},
-            {'label': '30-39', 'min': 30, 'max': 39},
-            {'label': '40-49', 'min': 40, 'max': 49},
-            {'label': '50-59', 'min': 50, 'max': 59},
-            {'label': '60-69', 'min': 60, 'max': 69},
-            {'label': '70-79', 'min': 70, 'max': 79},
-            {'label': '80+', 'min': 80, 'max': 150}
-        ]
-        
-        # Tumor count ranges
-        tumor_count_ranges = [
-            {'label': 'Single (1)', 'min': 1, 'max': 1},
-            {'label': '2-3 tumors', 'min': 2, 'max': 3},
-            {'label': '4-5 tumors', 'min': 4, 'max': 5}
-        ]
-        
-        # Height ranges (cm)
-        height_ranges = [
-            {'label': 'Under 150cm', 'min': 0, 'max': 149.9},
-            {'label': '150-159cm', 'min': 150, 'max': 159.9},
-            {'label': '160-169cm', 'min': 160, 'max': 169.9},
-            {'label': '170-179cm', 'min': 170, 'max': 179.9},
-            {'label': '180-189cm', 'min': 180, 'max': 189.9},
-            {'label': '190cm+', 'min': 190, 'max': 250}
-        ]
-        
-        # Weight ranges (kg)
-        weight_ranges = [
-            {'label': 'Under 50kg', 'min': 0, 'max': 49.9},
-            {'label': '50-59kg', 'min': 50, 'max': 59.9},
-            {'label': '60-69kg', 'min': 60, 'max': 69.9},
-            {'label': '70-79kg', 'min': 70, 'max': 79.9},
-            {'label': '80-89kg', 'min': 80, 'max': 89.9},
-            {'label': '90kg+', 'min': 90, 'max': 200}
-        ]
-        
-        # Blood pressure ranges
-        bp_systolic_ranges = [
-            {'label': 'Normal (<120)', 'min': 0, 'max': 119},
-            {'label': 'Elevated (120-129)', 'min': 120, 'max': 129},
-            {'label': 'Stage 1 (130-139)', 'min': 130, 'max': 139},
-            {'label': 'Stage 2 (140-179)', 'min': 140, 'max': 179},
-            {'label': 'Crisis (180+)', 'min': 180, 'max': 300}
-        ]
-        
-        bp_diastolic_ranges = [
-            {'label': 'Normal (<80)', 'min': 0, 'max': 79},
-            {'label': 'Stage 1 (80-89)', 'min': 80, 'max': 89},
-            {'label': 'Stage 2 (90-119)', 'min': 90, 'max': 119},
-            {'label': 'Crisis (120+)', 'min': 120, 'max': 200}
-        ]
-        
-        # Tumor-specific filters
-        tumor_locations = db.session.query(distinct(TumorMask.location)).all()
-        tumor_location_options = [location[0] for location in tumor_locations if location[0]]
-        
-        # Tumor volume ranges (mm³)
-        tumor_volume_ranges = [
-            {'label': 'Very Small (<20mm³)', 'min': 0, 'max': 19.9},
-            {'label': 'Small (20-50mm³)', 'min': 20, 'max': 49.9},
-            {'label': 'Medium (50-100mm³)', 'min': 50, 'max': 99.9},
-            {'label': 'Large (100-200mm³)', 'min': 100, 'max': 199.9},
-            {'label': 'Very Large (200mm³+)', 'min': 200, 'max': 1000}
-        ]
-        
-        # Dose ranges
-        dose_ranges = [
-            {'label': 'Low dose (<30)', 'min': 0, 'max': 29},
-            {'label': 'Medium dose (30-50)', 'min': 30, 'max': 50},
-            {'label': 'High dose (51-70)', 'min': 51, 'max': 70}
-        ]
+def get_filter_results(user_id, active_filters):
+    """
+    Record the outputs of finished aggregation jobs on the user's filters, skipping
+    results computed for criteria the filter no longer has.
+    """
+    from app import redis_cache
+    for filter_id, stored_filter in active_filters.items():
+        try:
+            result = redis_cache.get_json(get_filter_result_key(user_id, filter_id))
+        except Exception as e:
+            print(f"Error reading aggregation result for filter {filter_id}: {e}")
+            continue
+        if result and result['criteria_key'] == filter_criteria_key(stored_filter.get('criteria')):
+            stored_filter['nifti_path'] = result['nifti_path']
+            if result.get('statistic_paths'):
+                stored_filter['statistic_paths'] = result['statistic_paths']
+    return active_filters
+
+def build_filter_aggregate(user_id, filter_id, criteria, mask_type, statistics=None, progress=None):
+    """
+    Background job: generate a filter's display NIfTI (and any requested statistic maps)
+    and record their paths as the filter's result.
+    
+    Runs outside the request, so the user is passed in. The user's filters are only
+    read, to drop the result if the filter was deleted or its criteria changed while the
+    job ran: a newer job for the filter owns its output then.
+    """
+    filters_key = get_user_filters_key(user_id)
+    criteria_key = filter_criteria_key(criteria)
+    
+    def is_current():
+        stored_filter = get_stored_filters(filters_key).get(filter_id)
+        return stored_filter is not None and filter_criteria_key(stored_filter.get('criteria')) == criteria_key
+    
+    result_path = generate_display_nifti(
+        filter_id, criteria, mask_type, progress=progress, statistics=statistics, is_current=is_current, owner=user_id
+    )
+    
+    statistic_paths = {}
+    if result_path:
+        print(f"Successfully created NIfTI file at {result_path}")
+        cache_dir = os.path.join(current_app.config['FILESTORE_PATH'], MASK_CACHE_SUBDIRS.get(mask_type, 'tumor_mask_cache'))
+        for statistic in statistics or []:
+            statistic_path = get_statistic_link_path(cache_dir, user_id, filter_id, statistic)
+            if os.path.lexists(statistic_path):
+                statistic_paths[statistic] = statistic_path
         
-        return {
-            'patient_demographics': {
-                'origin_cancer': {'type': 'select', 'options': origin_cancer_options},
-                'sex': {'type': 'select', 'options': sex_options},
-                'age_range': {'type': 'range', 'options': age_ranges},
-                'height_range': {'type': 'range', 'options': height_ranges},
-                'weight_range': {'type': 'range', 'options': weight_ranges},
-                'tumor_count_range': {'type': 'range', 'options': tumor_count_ranges}
-            },
-            'clinical_data': {
-                'systolic_bp_range': {'type': 'range', 'options': bp_systolic_ranges},
-                'diastolic_bp_range': {'type': 'range', 'options': bp_diastolic_ranges}
-            },
-            'tumor_characteristics': {
-                'tumor_location': {'type': 'select', 'options': tumor_location_options},
-                'tumor_volume_range': {'type': 'range', 'options': tumor_volume_ranges}
-            },
-            'treatment_data': {
-                'dose_range': {'type': 'range', 'options': dose_ranges}
-            }
-        }
+        if is_current():
+            from app import redis_cache
+            try:
+                redis_cache.set_json(get_filter_result_key(user_id, filter_id), {
+                    'criteria_key': criteria_key,
+                    'nifti_path': result_path,
+                    'statistic_paths': statistic_paths
+                })
+            except Exception as e:
+                print(f"Error storing aggregation result for filter {filter_id}: {e}")
+    else:
+        print(f"No NIfTI file created for filter {filter_id}")
+    
+    return {'filter_id': filter_id, 'mask_type': mask_type, 'nifti_path': result_path, 'statistic_paths': statistic_paths}
+
+def forget_filter_result(filter_id):
+    """Drop the stored result of the current user's filter, e.g. when it is deleted."""
+    from app import redis_cache
+    try:
+        redis_cache.delete_path(get_filter_result_key(get_user_id(), filter_id))
+    except Exception as e:
+        print(f"Error removing aggregation result for filter {filter_id}: {e}")
+
+def enqueue_filter_aggregate(filter_id, criteria, mask_type, statistics=None):
+    """
+    Queue aggregation for a filter and return the job id, without waiting for it.
+    
+    If the job cannot be queued the aggregate is built synchronously instead and None
+    is returned, so the caller can show the result straight away.
+    """
+    from app import job_queue
+    user_id = get_user_id()
+    try:
+        return job_queue.submit(
+            build_filter_aggregate, user_id, filter_id, criteria, mask_type,
+            description=f"{mask_type} aggregate for filter {filter_id}",
+            statistics=statistics
+        )
     except Exception as e:
-        print(f"Error getting filter options: {e}")
-        return {}
+        print(f"Error queueing aggregation for filter {filter_id}, building it now: {e}")
+    build_filter_aggregate(user_id, filter_id, criteria, mask_type, statistics=statistics)
+    return None
+
+def get_requested_statistics():
+    """
+    Voxel-wise statistics requested alongside the filter, e.g. ["mean", "std", "p90"].
+    
+    Raises:
+        ValueError: If any requested statistic is not supported, or percentiles are
+            requested for a mask type whose value range is unknown
+    """
+    statistics = request.json.get('statistics') or []
+    for statistic in statistics:
+        parse_statistic(statistic)
+    mask_type = request.args.get('maskType', 'tumor')
+    get_percentile_range(os.path.join(current_app.config['FILESTORE_PATH'], 'voxel_store'), mask_type, statistics)
+    return statistics
+
+def get_cohort_counts(criteria):
+    """
+    Patient and mask counts of the cohorts matching criteria.
+    
+    Computed by one aggregate query and cached in Redis by criteria hash and dataset
+    version, so cached counts are dropped as soon as ingest bumps the version.
+    """
+    from app import redis_cache
+    cache_key = f"filter_statistics:{criteria_cache_key(criteria)}"
+    try:
+        cached = redis_cache.get_json(cache_key)
+        if cached is not None:
+            return cached
+    except Exception as e:
+        print(f"Error reading cached filter statistics: {e}")
+    
+    row = cohort_counts_query(criteria).one()
+    counts = {
+        'patients': row.total_patients,
+        'tumor': row.tumor_count,
+        'mri': row.mri_count,
+        'dose': row.dose_count
+    }
+    
+    try:
+        redis_cache.set_json(cache_key, counts, STATISTICS_CACHE_TTL)
+    except Exception as e:
+        print(f"Error caching filter statistics: {e}")
+    return counts
 
 def get_filter_statistics(criteria, mask_type='tumor'):
     """Calculate statistics based on current filter criteria."""
     try:
-        # Get filtered IDs for each mask type
-        tumor_ids = get_filtered_tumor_ids(criteria)
-        mri_ids = get_filtered_mri_ids(criteria)
-        dose_ids = get_filtered_dose_ids(criteria)
-        
-        # Get unique patient IDs from each mask type
-        tumor_patient_ids = set()
-        mri_patient_ids = set()
-        dose_patient_ids = set()
-        
-        if tumor_ids:
-            tumor_patients = db.session.query(distinct(NiftiData.patient_id)).join(
-                TumorMask, TumorMask.id == NiftiData.id
-            ).filter(TumorMask.id.in_(tumor_ids)).all()
-            tumor_patient_ids = {p[0] for p in tumor_patients}
-        
-        if mri_ids:
-            mri_patients = db.session.query(distinct(NiftiData.patient_id)).join(
-                MRIMask, MRIMask.id == NiftiData.id
-            ).filter(MRIMask.id.in_(mri_ids)).all()
-            mri_patient_ids = {p[0] for p in mri_patients}
-        
-        if dose_ids:
-            dose_patients = db.session.query(distinct(NiftiData.patient_id)).join(
-                DoseMask, DoseMask.id == NiftiData.id
-            ).filter(DoseMask.id.in_(dose_ids)).all()
-            dose_patient_ids = {p[0] for p in dose_patients}
-        
-        # Calculate total unique patients across all mask types
-        all_patient_ids = tumor_patient_ids.union(mri_patient_ids).union(dose_patient_ids)
+        counts = get_cohort_counts(criteria)
         
         return {
-            'total_patients': len(all_patient_ids),
-            'total_tumors': len(tumor_ids) if tumor_ids else 0,
-            'total_mris': len(mri_ids) if mri_ids else 0,
-            'total_dose_masks': len(dose_ids) if dose_ids else 0,
+            'total_patients': counts['patients'],
+            'total_tumors': counts['tumor'],
+            'total_mris': counts['mri'],
+            'total_dose_masks': counts['dose'],
             'current_mask_type': mask_type,
-            'current_mask_count': {
-                'tumor': len(tumor_ids) if tumor_ids else 0,
-                'mri': len(mri_ids) if mri_ids else 0,
-                'dose': len(dose_ids) if dose_ids else 0
-            }.get(mask_type, 0)
+            'current_mask_count': counts.get(mask_type, 0)
         }
         
     except Exception as e:
@@ -229,7 +241,15 @@ def get_filter_statistics(criteria, mask_type='tumor'):
 # Get available filter options
 @filters.route('/filter-options', methods=['GET'])
 def get_filter_options_endpoint():
-    return jsonify(get_filter_options())
+    """Filter options for the current dataset version; answers 304 if the client's ETag is current."""
+    options, etag = get_cached_filter_options()
+    response = jsonify(options)
+    if etag:
+        response.set_etag(etag)
+        # Clients may keep the payload but must revalidate it, so a version bump shows up at once
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    return response
 
 # Get filter statistics for current or specified filter
 @filters.route('/filter-statistics', methods=['GET'])
@@ -267,11 +287,55 @@ def get_filter_statistics_endpoint(filter_id=None):
         print(f"Error getting filter statistics for user {get_user_id()}: {e}")
         return jsonify({'error': f'Failed to get statistics: {str(e)}'}), 500
 
+# Live cohort counts for criteria that are still being edited
+@filters.route('/filter-preview', methods=['POST'])
+def get_filter_preview():
+    """
+    Count the cohorts matching the posted criteria from the in-memory columnar index,
+    without touching the database, so the UI can update counts as options are toggled.
+    """
+    try:
+        criteria = (request.json or {}).get('criteria', {})
+        mask_type = request.args.get('maskType', 'tumor')
+        
+        index = get_columnar_index()
+        preview = index.evaluate(criteria)
+        return jsonify({
+            'total_patients': preview.patient_count(),
+            'total_tumors': preview.count('tumor'),
+            'total_mris': preview.count('mri'),
+            'total_dose_masks': preview.count('dose'),
+            'current_mask_type': mask_type,
+            'current_mask_count': preview.count(mask_type) if mask_type in index.masks else 0,
+            'dataset_version': index.version
+        })
+    except Exception as e:
+        print(f"Error previewing filter for user {get_user_id()}: {e}")
+        return jsonify({'error': f'Failed to preview filter: {str(e)}'}), 500
+
+@filters.route('/filter-facets', methods=['POST'])
+def get_filter_facets():
+    """
+    For every option of every filter, the patient and mask counts the posted criteria
+    would give with that option toggled, from the in-memory columnar index.
+    """
+    try:
+        criteria = (request.json or {}).get('criteria', {})
+        
+        index = get_columnar_index()
+        return jsonify({
+            'facets': index.facet_counts(criteria, get_cached_filter_options()[0]),
+            'dataset_version': index.version
+        })
+    except Exception as e:
+        print(f"Error computing filter facets for user {get_user_id()}: {e}")
+        return jsonify({'error': f'Failed to compute filter facets: {str(e)}'}), 500
+
 # get all active filters
 @filters.route('/filters', methods=['GET'])
 def get_filters():
     active_filters = get_stored_filters() # Get filters from Redis
-    return jsonify(active_filters)
+    return jsonify(get_filter_results(get_user_id(), active_filters))
 
 # create new filter
 @filters.route('/filters', methods=['POST'])
@@ -282,28 +346,29 @@ def create_filter():
     
     if not id or not name:
         return jsonify({ 'error': 'error: invalid filter' }), 400
+    
+    try:
+        statistics = get_requested_statistics()
+    except ValueError as e:
+        return jsonify({ 'error': f'error: {e}' }), 400
 
     active_filters = get_stored_filters() # Get filters from Redis
     active_filters[id] = { 'name': name, 'criteria': criteria }
+    if statistics:
+        active_filters[id]['statistics'] = statistics
+
+    # Store the updated filters back to Redis
+    store_filters(active_filters)
     
-    # Generate the NIfTI file using the new criteria format and mask type from query parameter
+    # Generate the NIfTI file in the background using the new criteria format and mask type from query parameter
+    job_id = None
     try:
         mask_type = request.args.get('maskType', 'tumor')  # Get from query parameter, default to tumor
-        result_path = generate_display_nifti(id, criteria, mask_type)
-        
-        if result_path:
-            print(f"Successfully created NIfTI file at {result_path}")
-            active_filters[id]['nifti_path'] = result_path
-        else:
-            print(f"Failed to create NIfTI file for filter {id}")
-            
+        job_id = enqueue_filter_aggregate(id, criteria, mask_type, statistics)
     except Exception as e:
-        print(f"An error occurred while generating the NIfTI file: {e}")
+        print(f"An error occurred while queueing the NIfTI file generation: {e}")
 
-    # Store the updated filters back to Redis
-    store_filters(active_filters)
-
-    return jsonify({ 'message': 'success: filter added' }), 201
+    return jsonify({ 'message': 'success: filter added', 'job_id': job_id }), 201
 
 # modify filter
 @filters.route('/filters/<id>', methods=['PUT'])
@@ -311,36 +376,43 @@ def modify_filter(id):
     name = request.json.get('name')
     criteria = request.json.get('criteria', {})
     
+    try:
+        statistics = get_requested_statistics()
+    except ValueError as e:
+        return jsonify({ 'error': f'error: {e}' }), 400
+    
     active_filters = get_stored_filters() # Get filters from Redis
     if id in active_filters:
+        # Keep the filter's statistics unless the request sets them; an empty list clears them
+        if 'statistics' not in request.json:
+            statistics = active_filters[id].get('statistics', [])
         active_filters[id] = { 'name': name, 'criteria': criteria }
+        if statistics:
+            active_filters[id]['statistics'] = statistics
         
         # Regenerate the NIfTI file with updated criteria and mask type from query parameter
+        mask_type = request.args.get('maskType', 'tumor')  # Get from query parameter, default to tumor
         try:
-            mask_type = request.args.get('maskType', 'tumor')  # Get from query parameter, default to tumor
-            
-            # Remove all mask type cache files for this filter
+            # Unlink this filter's aggregate for every mask type. The shared blobs stay referenced
+            # until the filter is regenerated, so they can be updated incrementally.
             filestore_path = current_app.config['FILESTORE_PATH']
-            cache_dirs = ['tumor_mask_cache', 'mri_mask_cache', 'dose_mask_cache']
-            for cache_dir in cache_dirs:
-                cache_path = os.path.join(filestore_path, cache_dir, f"{id}.nii.gz")
-                if os.path.exists(cache_path):
-                    os.remove(cache_path)
+            for mask_cache_dir in MASK_CACHE_SUBDIRS.values():
+                unlink_filter(os.path.join(filestore_path, mask_cache_dir), get_user_id(), id)
                     
-            result_path = generate_display_nifti(id, criteria, mask_type)
-            
-            if result_path:
-                print(f"Successfully updated NIfTI file at {result_path}")
-                active_filters[id]['nifti_path'] = result_path
-            else:
-                print(f"Failed to update NIfTI file for filter {id}")
-                
         except Exception as e:
-            print(f"An error occurred while updating the NIfTI file: {e}")
+            print(f"An error occurred while removing the outdated NIfTI files: {e}")
             
         # Store the updated filters back to Redis
         store_filters(active_filters)
-        return jsonify({ 'message': 'success: filter modified' }), 200
+        
+        # Regenerate the NIfTI file in the background
+        job_id = None
+        try:
+            job_id = enqueue_filter_aggregate(id, criteria, mask_type, statistics)
+        except Exception as e:
+            print(f"An error occurred while queueing the NIfTI file update: {e}")
+            
+        return jsonify({ 'message': 'success: filter modified', 'job_id': job_id }), 200
     else:
         return jsonify({ 'error': 'error: filter not found'}), 404
 
@@ -354,17 +426,16 @@ def delete_filter(id):
         # Clean up associated NIfTI files from all mask type caches
         try:
             filestore_path = current_app.config['FILESTORE_PATH']
-            cache_dirs = ['tumor_mask_cache', 'mri_mask_cache', 'dose_mask_cache']
-            for cache_dir in cache_dirs:
-                cache_path = os.path.join(filestore_path, cache_dir, f"{id}.nii.gz")
-                if os.path.exists(cache_path):
-                    os.remove(cache_path)
-                    print(f"Removed cached NIfTI file: {cache_path}")
+            # Aggregates are shared between filters with identical criteria, so only
+            # this filter's reference is dropped; unreferenced blobs are removed
+            for mask_type, mask_cache_dir in MASK_CACHE_SUBDIRS.items():
+                release_filter(os.path.join(filestore_path, mask_cache_dir), mask_type, get_user_id(), id)
         except Exception as e:
             print(f"Error cleaning up NIfTI files: {e}")
             
         # Store the updated filters back to Redis
         store_filters(active_filters)
+        forget_filter_result(id)
         return jsonify({ 'message': 'success: filter deleted' }), 200
 
     return jsonify({ 'error': 'error: filter not found' }), 404
@@ -385,18 +456,13 @@ def set_current_filter(id):
         
         # Generate NIfTI file for this mask type if it doesn't exist
         try:
-            cache_subdirs = {
-                'tumor': 'tumor_mask_cache',
-                'mri': 'mri_mask_cache', 
-                'dose': 'dose_mask_cache'
-            }
             filestore_path = current_app.config['FILESTORE_PATH']
-            cache_subdir = cache_subdirs.get(mask_type, 'tumor_mask_cache')
-            cache_path = os.path.join(filestore_path, cache_subdir, f"{id}.nii.gz")
+            cache_subdir = MASK_CACHE_SUBDIRS.get(mask_type, 'tumor_mask_cache')
+            cache_path = find_filter_aggregate(os.path.join(filestore_path, cache_subdir), get_user_id(), id)
             
             print(f"Checking cache path: {cache_path}")
             
-            if not os.path.exists(cache_path):
+            if cache_path is None:
                 print(f"Generating {mask_type} mask for filter {id}")
                 # Since we don't have the filter criteria here, we'll just create an empty file
                 # In a real implementation, you'd look up the filter criteria from the database
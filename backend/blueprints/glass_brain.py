@@ -2,44 +2,172 @@ import nibabel as nib
 import numpy as np
 from flask import Blueprint, jsonify, current_app, request
 import os
-from templateflow import api as tf
+import json
+import uuid
+import threading
+from binary_arrays import (
+    QUANTIZED_DTYPES, VOLUME_LAYOUTS, pack_arrays, pack_volume, payload_etag, quantize, binary_response, not_modified
+)
+from db_loading.aggregate_cache import (
+    FILTER_ID_PATTERN, MASK_CACHE_SUBDIRS, get_dataset_version, get_blob_key, get_isosurface_blob_path, find_filter_aggregate
+)
+from db_loading.isosurface import normalize_level, get_isosurface
+from db_loading.parallel_reduction import read_mask_volume
+from db_loading.voxel_store import open_voxel_stores
+from surface_bundle import LOD_DENSITIES, load_combined_fsaverage_pial
+from blueprints.filters import get_user_id
 
 glass_brain_bp = Blueprint('glass_brain', __name__, url_prefix='/api/glass_brain')
 
-def _load_combined_fsaverage_pial():
-    """Helper function to load and combine fsaverage pial surfaces."""
-    lh_path = tf.get('fsaverage', density='164k', hemi='L', suffix='pial', extension='surf.gii')
-    rh_path = tf.get('fsaverage', density='164k', hemi='R', suffix='pial', extension='surf.gii')
+# The template surface never changes while the app runs, so clients may reuse it for a day
+SURFACE_MAX_AGE = 24 * 60 * 60
 
-    lh_gii = nib.load(lh_path)
-    rh_gii = nib.load(rh_path)
+# Combined surface and its encodings per level of detail, loaded once per process. Under
+# gunicorn --preload, wsgi.py fills it in the master so every worker shares the pages
+# copy-on-write.
+_surfaces = {}
+_surface_lock = threading.Lock()
 
-    lh_vertices, lh_faces = lh_gii.darrays[0].data, lh_gii.darrays[1].data
-    rh_vertices, rh_faces = rh_gii.darrays[0].data, rh_gii.darrays[1].data
+def get_brain_surface(lod=0):
+    """
+    The combined fsaverage pial surface at a level of detail and its encodings, built
+    once per process.
+    
+    Args:
+        lod (int): 0 (full 164k density) to 3 (3k density), see surface_bundle.LOD_DENSITIES
+    
+    Returns:
+        dict: vertices (float32), faces (uint32), payload (binary_arrays envelope) and etag
+    """
+    if lod not in _surfaces:
+        with _surface_lock:
+            if lod not in _surfaces:
+                density = LOD_DENSITIES[lod]
+                vertices, faces = load_combined_fsaverage_pial(density)
+                payload = pack_arrays({'vertices': vertices, 'faces': faces}, lod=lod, density=density)
+                _surfaces[lod] = {'vertices': vertices, 'faces': faces, 'payload': payload, 'etag': payload_etag(payload)}
+    return _surfaces[lod]
 
-    num_lh_verts = lh_vertices.shape[0]
-    combined_vertices = np.vstack((lh_vertices, rh_vertices))
-    rh_faces_offset = rh_faces + num_lh_verts
-    combined_faces = np.vstack((lh_faces, rh_faces_offset))
+def get_brain_surface_json(lod=0):
+    """The surface as the legacy JSON body, encoded on first use and kept."""
+    surface = get_brain_surface(lod)
+    if 'json' not in surface:
+        with _surface_lock:
+            if 'json' not in surface:
+                surface['json'] = json.dumps({
+                    "vertices": surface['vertices'].tolist(),
+                    "faces": surface['faces'].tolist()
+                }, separators=(',', ':')).encode('utf-8')
+    return surface['json']
 
-    return combined_vertices, combined_faces
+def preload_brain_surface():
+    """Load every level of detail ahead of the first request; failures are logged and retried on demand."""
+    for lod in range(len(LOD_DENSITIES)):
+        try:
+            surface = get_brain_surface(lod)
+            print(f"Preloaded brain surface LOD {lod}: {len(surface['vertices'])} vertices, {len(surface['faces'])} faces")
+        except Exception as e:
+            print(f"Could not preload brain surface LOD {lod}: {e}")
 
 @glass_brain_bp.route('/brain_surface')
 def get_brain_surface_mesh():
-    """API endpoint to get the vertex and face data for the brain shell."""
+    """
+    API endpoint to get the vertex and face data for the brain shell.
+    
+    ?lod=0..3 picks the level of detail, from the full 164k fsaverage (default) down to
+    the 3k-vertex fsaverage4, so clients can show a coarse shell first and refine it.
+    ?format=binary returns the binary_arrays envelope (float32 vertices, uint32 faces)
+    with a strong ETag; the default JSON lists are kept for older clients.
+    """
+    lod = request.args.get('lod', 0, type=int)
+    if lod is None or not 0 <= lod < len(LOD_DENSITIES):
+        return jsonify({"error": f"lod must be between 0 and {len(LOD_DENSITIES) - 1}"}), 400
+    
     try:
-        vertices, faces = _load_combined_fsaverage_pial()
-        return jsonify({
-            "vertices": vertices.tolist(),
-            "faces": faces.tolist()
-        })
+        surface = get_brain_surface(lod)
+        if request.args.get('format') == 'binary':
+            return binary_response(surface['payload'], surface['etag'], max_age=SURFACE_MAX_AGE)
+        
+        return binary_response(
+            get_brain_surface_json(lod), f"{surface['etag']}-json",
+            max_age=SURFACE_MAX_AGE, content_type='application/json'
+        )
     except Exception as e:
         current_app.logger.error(f"Error in /brain_surface: {e}")
         return jsonify({"error": "Failed to load brain surface data."}), 500
 
+# Encodings of the binary volume_data response
+VOLUME_ENCODINGS = ['float32'] + list(QUANTIZED_DTYPES)
+
+# Most isosurface levels one request may ask for
+MAX_ISOSURFACE_LEVELS = 8
+
+def normalize_volume(volume):
+    """
+    Scale a volume to [0, 1].
+    
+    Returns:
+        tuple: (normalized float32 volume, original min, original max)
+    """
+    volume = np.asarray(volume, dtype=np.float32)
+    min_val, max_val = float(np.min(volume)), float(np.max(volume))
+    if max_val > min_val:
+        normalized_data = (volume - min_val) / (max_val - min_val)
+    else:
+        normalized_data = np.zeros(volume.shape, dtype=np.float32)
+    return normalized_data, min_val, max_val
+
+def load_normalized_volume(nifti_file_path):
+    """
+    Load a NIfTI volume scaled to [0, 1].
+    
+    Returns:
+        tuple: (normalized float32 volume, affine, original min, original max)
+    """
+    nii_img = nib.load(nifti_file_path)
+    normalized_data, min_val, max_val = normalize_volume(nii_img.get_fdata(dtype=np.float32))
+    return normalized_data, nii_img.affine, min_val, max_val
+
+def get_volume_format():
+    """
+    The (encoding, layout) requested for a binary volume.
+    
+    Raises:
+        ValueError: If either is not supported
+    """
+    encoding = request.args.get('encoding', 'float32')
+    layout = request.args.get('layout', 'auto')
+    if encoding not in VOLUME_ENCODINGS:
+        raise ValueError(f"encoding must be one of {', '.join(VOLUME_ENCODINGS)}")
+    if layout not in VOLUME_LAYOUTS:
+        raise ValueError(f"layout must be one of {', '.join(VOLUME_LAYOUTS)}")
+    return encoding, layout
+
+def volume_payload(normalized_data, affine, min_val, max_val, encoding, layout):
+    """Quantize a normalized volume and pack it in the requested layout."""
+    data, scale = quantize(normalized_data, encoding)
+    return pack_volume(data, layout, affine=np.asarray(affine).tolist(), scale=scale, min=min_val, max=max_val)
+
 @glass_brain_bp.route('/volume_data')
 def get_volume_data():
-    """API endpoint to load a NIfTI volume and return its data and affine."""
+    """
+    API endpoint to load a NIfTI volume and return its data and affine.
+    
+    ?format=binary returns the binary_arrays envelope instead of JSON lists: the
+    normalized volume in ?encoding=float32 (default), uint16 or uint8 (values are
+    data * scale), with dims, affine, scale and the original min/max in the header.
+    ?layout=auto (default) sends only the nonzero voxels when that is smaller, see
+    binary_arrays.pack_volume; dense or sparse force one layout. It is gzipped when
+    the client accepts it, and its ETag follows the aggregate file, so an unchanged
+    volume is answered with 304 without being read.
+    """
+    binary = request.args.get('format') == 'binary'
+    if binary:
+        try:
+            encoding, layout = get_volume_format()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    
     try:
         # Get mask type from query parameter, default to tumor if not specified
         mask_type = request.args.get('maskType', 'tumor')
@@ -48,39 +176,113 @@ def get_volume_data():
         # This will be updated when we implement proper user sessions
         current_filter_id = 'default_id'
 
-        # Map mask types to cache directories
-        cache_subdirs = {
-            'tumor': 'tumor_mask_cache',
-            'mri': 'mri_mask_cache', 
-            'dose': 'dose_mask_cache'
-        }
-        
-        cache_subdir = cache_subdirs.get(mask_type, 'tumor_mask_cache')
+        cache_subdir = MASK_CACHE_SUBDIRS.get(mask_type, 'tumor_mask_cache')
         
         filestore_path = current_app.config['FILESTORE_PATH']
-        nifti_file_path = os.path.join(
-            filestore_path, 
-            cache_subdir,
-            f"{current_filter_id}.nii.gz"
-        )
-        if not os.path.exists(nifti_file_path):
-            return jsonify({"error": f"Mask file not found at: {nifti_file_path}"}), 404
+        nifti_file_path = find_filter_aggregate(os.path.join(filestore_path, cache_subdir), get_user_id(), current_filter_id)
+        if nifti_file_path is None:
+            return jsonify({"error": f"No {mask_type} aggregate for filter {current_filter_id}"}), 404
         
-        nii_img = nib.load(nifti_file_path)
-        nii_data = nii_img.get_fdata(dtype=np.float32)
-
-        min_val, max_val = np.min(nii_data), np.max(nii_data)
-        if max_val > min_val:
-             normalized_data = (nii_data - min_val) / (max_val - min_val)
-        else:
-             normalized_data = np.zeros(nii_data.shape, dtype=np.float32)
-
+        if binary:
+            # The filter link points at a content-addressed blob, so its stat identifies the data
+            stat = os.stat(nifti_file_path)
+            etag = f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}-{encoding}-{layout}"
+            cached = not_modified(etag, compress=True)
+            if cached is not None:
+                return cached
+            
+            payload = volume_payload(*load_normalized_volume(nifti_file_path), encoding, layout)
+            return binary_response(payload, etag, compress=True)
+        
+        normalized_data, affine, _, _ = load_normalized_volume(nifti_file_path)
         return jsonify({
-            "dims": nii_data.shape,
+            "dims": normalized_data.shape,
             "rawData": normalized_data.flatten().tolist(),
-            "affine": nii_img.affine.tolist(),
+            "affine": affine.tolist(),
         })
 
     except Exception as e:
         current_app.logger.error(f"Error in /volume_data: {e}")
-        return jsonify({"error": "Failed to load volume data."}), 500 
\ No newline at end of file
+        return jsonify({"error": "Failed to load volume data."}), 500 
+
+@glass_brain_bp.route('/mask/<mask_id>')
+def get_mask_volume(mask_id):
+    """
+    API endpoint to get one raw mask in the binary volume format of /volume_data
+    (?encoding and ?layout as there, sparse by default for sparse masks).
+    """
+    try:
+        mask_id = str(uuid.UUID(mask_id))
+    except ValueError:
+        return jsonify({"error": "Invalid mask id"}), 400
+    try:
+        encoding, layout = get_volume_format()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        # Masks never change within a dataset version
+        etag = f"{mask_id}-{get_dataset_version()}-{encoding}-{layout}"
+        cached = not_modified(etag, compress=True)
+        if cached is not None:
+            return cached
+        
+        filestore_path = current_app.config['FILESTORE_PATH']
+        stores = open_voxel_stores(os.path.join(filestore_path, 'voxel_store'))
+        loaded = read_mask_volume(os.path.join(filestore_path, 'test_db_nifti', f"{mask_id}.nii.gz"), stores)
+        if loaded is None:
+            return jsonify({"error": f"Mask {mask_id} not found"}), 404
+        
+        volume, affine = loaded
+        normalized_data, min_val, max_val = normalize_volume(volume)
+        payload = volume_payload(normalized_data, affine, min_val, max_val, encoding, layout)
+        return binary_response(payload, etag, compress=True)
+    except Exception as e:
+        current_app.logger.error(f"Error in /mask/{mask_id}: {e}")
+        return jsonify({"error": "Failed to load mask data."}), 500
+
+@glass_brain_bp.route('/isosurface')
+def get_isosurface_meshes():
+    """
+    API endpoint to get isosurface meshes of a filter's aggregate.
+    
+    ?levels=0.1,0.5 are fractions of the aggregate's value range (default 0.5),
+    ?maskType and ?filterId pick the aggregate (defaults tumor and default_id). Returns
+    the binary_arrays envelope with float32 world-space vertices_<i> and uint32
+    faces_<i> per level i, listed in the header's levels. Meshes are cached per
+    aggregate blob and level, so repeated views only read them back.
+    """
+    mask_type = request.args.get('maskType', 'tumor')
+    filter_id = request.args.get('filterId', 'default_id')
+    if not FILTER_ID_PATTERN.match(filter_id):
+        return jsonify({"error": f"Invalid filter id: {filter_id}"}), 400
+    try:
+        levels = [normalize_level(level) for level in request.args.get('levels', '0.5').split(',') if level.strip()]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not levels or len(levels) > MAX_ISOSURFACE_LEVELS:
+        return jsonify({"error": f"Request between 1 and {MAX_ISOSURFACE_LEVELS} levels"}), 400
+    
+    try:
+        cache_dir = os.path.join(current_app.config['FILESTORE_PATH'], MASK_CACHE_SUBDIRS.get(mask_type, 'tumor_mask_cache'))
+        owner = get_user_id()
+        aggregate_path = find_filter_aggregate(cache_dir, owner, filter_id)
+        key = get_blob_key(cache_dir, owner, filter_id)
+        if key is None or aggregate_path is None:
+            return jsonify({"error": f"No aggregate for filter {filter_id}"}), 404
+        
+        # Blobs are content-addressed, so the key and levels identify the meshes
+        etag = f"{key}-iso-{'_'.join(f'{level:g}' for level in levels)}"
+        cached = not_modified(etag, compress=True)
+        if cached is not None:
+            return cached
+        
+        arrays = {}
+        for i, level in enumerate(levels):
+            vertices, faces = get_isosurface(aggregate_path, get_isosurface_blob_path(cache_dir, key, level), level)
+            arrays[f'vertices_{i}'] = vertices
+            arrays[f'faces_{i}'] = faces
+        return binary_response(pack_arrays(arrays, levels=levels), etag, compress=True)
+    except Exception as e:
+        current_app.logger.error(f"Error in /isosurface: {e}")
+        return jsonify({"error": "Failed to extract isosurface."}), 500
@@ -0,0 +1,26 @@
+from flask import Blueprint, jsonify, current_app
+from app import job_queue
+
+jobs = Blueprint('jobs', __name__, url_prefix='/api')
+
+@jobs.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Get the state of a background job.
+    
+    Returns:
+        JSON response with the job's state ('queued', 'running', 'finished' or 'failed'),
+        processed/total counts, ETA in seconds and result or error
+    """
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify(job)
+        
+    except Exception as e:
+        current_app.logger.error(f"Error getting job {job_id}: {e}")
+        return jsonify({
+            'error': 'Failed to get job status',
+            'message': str(e)
+        }), 500
@@ -7,9 +7,17 @@ import cortex
 import os
 import shutil
 from app import redis_cache
+from single_flight import single_flight
+from db_loading.aggregate_cache import MASK_CACHE_SUBDIRS, find_filter_aggregate, get_blob_key
+from blueprints.filters import get_user_id
 
 viewer = Blueprint('viewer', __name__, url_prefix='/api')
 
+# Longest a request waits for another worker's viewer build, well below gunicorn's
+# 120 s worker timeout; after that the client is asked to retry
+VIEWER_LOCK_TIMEOUT = 45
+VIEWER_RETRY_AFTER = 5
+
 @viewer.route('/viewer/<uuid:nifti_id_str>/<path:nifti_dir>')
 @viewer.route('/viewer')
 def req_visualize_brain(nifti_id_str=None, nifti_dir=None):
@@ -34,7 +42,6 @@ def req_visualize_brain(nifti_id_str=None, nifti_dir=None):
             filestore_path, 'viewer_cache',
             str(nifti_id_str),
         ))
-        redis_cache.set_path(redis_key, out_path)
 
         nifti_file_path = os.path.join(
             filestore_path,
@@ -57,7 +64,23 @@ def req_visualize_brain(nifti_id_str=None, nifti_dir=None):
         
         current_app.logger.info(f"Using filter ID: {current_filter_id}, mask type: {mask_type}")
 
-        redis_key = f'viewer_cache:{current_filter_id}_{mask_type}'
+        cache_subdir = MASK_CACHE_SUBDIRS.get(mask_type, 'tumor_mask_cache')
+
+        # Use the Docker volume path for NIfTI files with mask type subdirectory:
+        # the user's own aggregate for the filter, else the shared precomputed one
+        filestore_path = current_app.config['FILESTORE_PATH']
+        cache_dir = os.path.join(filestore_path, cache_subdir)
+        owner = get_user_id()
+        nifti_file_path = find_filter_aggregate(cache_dir, owner, current_filter_id)
+        if nifti_file_path is None:
+            current_app.logger.error(f"No {mask_type} aggregate for filter {current_filter_id}")
+            from flask import abort
+            abort(404)
+
+        # A user's aggregate is a content-addressed blob, so its key names the viewer and
+        # users with the same cohort share it; the precomputed aggregate has one viewer
+        viewer_id = get_blob_key(cache_dir, owner, current_filter_id) or current_filter_id
+        redis_key = f'viewer_cache:{viewer_id}_{mask_type}'
         if redis_cache.path_exists(redis_key):
             out_path = redis_cache.get_path(redis_key)
             # Ensure out_path is a string, not bytes
@@ -65,64 +88,50 @@ def req_visualize_brain(nifti_id_str=None, nifti_dir=None):
                 out_path = out_path.decode('utf-8')
             return send_from_directory(out_path, 'index.html') # already cached, so we return
 
-        # Map mask types to cache directories
-        cache_subdirs = {
-            'tumor': 'tumor_mask_cache',
-            'mri': 'mri_mask_cache', 
-            'dose': 'dose_mask_cache'
-        }
-
-        cache_subdir = cache_subdirs.get(mask_type, 'tumor_mask_cache')
-
-        filestore_path = current_app.config['FILESTORE_PATH']
         out_path = os.path.abspath(os.path.join(
             filestore_path, 'viewer_cache',
-            current_filter_id,
+            viewer_id,
             mask_type,
         ))
-        redis_cache.set_path(redis_key, out_path)
-
-        # Use the Docker volume path for NIfTI files with mask type subdirectory
-        nifti_file_path = os.path.join(
-            filestore_path, 
-            cache_subdir,
-            f"{current_filter_id}.nii.gz"
-        )
-        
-        # Check if file exists before trying to load it
-        current_app.logger.info(f"Checking for NIfTI file at: {nifti_file_path}")
-        if not os.path.exists(nifti_file_path):
-            current_app.logger.error(f"NIfTI file not found at: {nifti_file_path}")
-            from flask import abort
-            abort(404)
 
     try:
-        current_nii = load_nifti(nifti_file_path)
-        current_nii_volume_data = current_nii[0]
-
         # Use a shared directory for common files and session-specific for index.html
         filestore_path = current_app.config['FILESTORE_PATH']
         shared_out_path = os.path.join(filestore_path, 'viewer_cache', 'pycortex_shared')
         session_out_path = out_path
-        
-        # Ensure both directories exist
-        os.makedirs(shared_out_path, exist_ok=True)
-        os.makedirs(session_out_path, exist_ok=True)
-        
-        current_nii_volume = cortex.Volume(current_nii_volume_data, subject='S1', xfmname='fullhead')
-
-        # Create the static viewer files in shared directory
-        cortex.webgl.make_static(outpath=shared_out_path, data={ 'test': current_nii_volume }, recache=True, template='custom_viewer.html')
-        
-        # Move only the index.html to the session-specific directory
-        shared_index = os.path.join(shared_out_path, 'index.html')
         session_index = os.path.join(session_out_path, 'index.html')
         
-        if os.path.exists(shared_index):
-            shutil.move(shared_index, session_index)
+        # pycortex builds into the shared directory, so only one worker builds at a time.
+        # Concurrent requests for the same viewer wait here and then serve the finished page.
+        with single_flight('viewer_build:pycortex_shared', timeout=VIEWER_LOCK_TIMEOUT):
+            if not os.path.exists(session_index):
+                current_nii = load_nifti(nifti_file_path, os.path.join(filestore_path, 'voxel_store'))
+                current_nii_volume_data = current_nii[0]
+                
+                # Ensure both directories exist
+                os.makedirs(shared_out_path, exist_ok=True)
+                os.makedirs(session_out_path, exist_ok=True)
+                
+                current_nii_volume = cortex.Volume(current_nii_volume_data, subject='S1', xfmname='fullhead')
+
+                # Create the static viewer files in shared directory
+                cortex.webgl.make_static(outpath=shared_out_path, data={ 'test': current_nii_volume }, recache=True, template='custom_viewer.html')
+                
+                # Move only the index.html to the session-specific directory
+                shared_index = os.path.join(shared_out_path, 'index.html')
+                
+                if os.path.exists(shared_index):
+                    shutil.move(shared_index, session_index)
+            
+            # Only advertise the cached viewer once its page exists
+            if os.path.exists(session_index):
+                redis_cache.set_path(redis_key, out_path)
         
         return send_from_directory(session_out_path, 'index.html')
         
+    except TimeoutError:
+        current_app.logger.info("Another viewer is being built, asking the client to retry")
+        return jsonify({'error': 'Viewer is being built, retry shortly'}), 503, {'Retry-After': str(VIEWER_RETRY_AFTER)}
     except Exception as e:
         current_app.logger.error(f"Error in /viewer: {e}")
         from flask import abort
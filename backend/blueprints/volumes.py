@@ -0,0 +1,166 @@
+from flask import Blueprint, jsonify, current_app, request
+import io
+import os
+import re
+import uuid
+import numpy as np
+from binary_arrays import VOLUME_LAYOUTS, pack_arrays, pack_volume, binary_response, not_modified
+from db_loading.aggregate_cache import FILTER_ID_PATTERN, MASK_CACHE_SUBDIRS, get_dataset_version, get_blob_key, get_blob_path
+from db_loading.volume_regions import open_volume, parse_axis, read_slice, parse_bbox, read_roi
+from db_loading.voxel_store import open_voxel_stores, lookup_mask
+from blueprints.filters import get_user_id
+
+volumes = Blueprint('volumes', __name__, url_prefix='/api/volumes')
+
+# Content keys of aggregate blobs, optionally with a statistic (e.g. '<key>.mean')
+BLOB_KEY_PATTERN = re.compile(r'^[0-9a-f]{32}(\.[A-Za-z0-9_.]+)?$')
+
+class VolumeNotFound(Exception):
+    pass
+
+def resolve_volume(key):
+    """
+    Open the volume a request addresses, for region reads.
+
+    ?source=aggregate (default): key is an aggregate blob key, or one of the current
+    user's filter ids whose aggregate link is followed to its blob (?maskType picks
+    the cache, default tumor).
+    ?source=mask: key is a raw mask id.
+
+    Returns:
+        tuple: (volume, affine, version) where version identifies the volume's content
+
+    Raises:
+        ValueError: If the key or source is malformed
+        VolumeNotFound: If there is no such volume
+    """
+    filestore_path = current_app.config['FILESTORE_PATH']
+    source = request.args.get('source', 'aggregate')
+
+    if source == 'mask':
+        mask_id = str(uuid.UUID(key))
+        dataset_version = get_dataset_version()
+        version = f"{mask_id}-{dataset_version}"
+        stored = lookup_mask(open_voxel_stores(os.path.join(filestore_path, 'voxel_store')), mask_id)
+        if stored is not None:
+            return stored + (version,)
+        opened = open_volume(
+            os.path.join(filestore_path, 'test_db_nifti', f"{mask_id}.nii.gz"),
+            os.path.join(filestore_path, 'volume_cache'),
+            dataset_version
+        )
+        if opened is None:
+            raise VolumeNotFound(f"Mask {mask_id} not found")
+        return opened + (version,)
+
+    if source != 'aggregate':
+        raise ValueError("source must be aggregate or mask")
+    mask_type = request.args.get('maskType', 'tumor')
+    if mask_type not in MASK_CACHE_SUBDIRS:
+        raise ValueError(f"maskType must be one of {', '.join(MASK_CACHE_SUBDIRS)}")
+    cache_dir = os.path.join(filestore_path, MASK_CACHE_SUBDIRS[mask_type])
+
+    if BLOB_KEY_PATTERN.match(key):
+        blob_key = key
+    elif FILTER_ID_PATTERN.match(key):
+        blob_key = get_blob_key(cache_dir, get_user_id(), key)
+    else:
+        raise ValueError(f"Invalid volume key: {key}")
+
+    # Blobs are content-addressed and never rewritten, so the key is the version
+    opened = open_volume(get_blob_path(cache_dir, blob_key)) if blob_key else None
+    if opened is None:
+        raise VolumeNotFound(f"No {mask_type} aggregate for {key}")
+    return opened + (blob_key,)
+
+def encode_png(image, vmin=None, vmax=None):
+    """Encode a 2D slice as an 8-bit grayscale PNG, windowed to [vmin, vmax] (default: the slice's range)."""
+    from PIL import Image
+
+    image = image.astype(np.float32)
+    vmin = float(np.min(image)) if vmin is None else vmin
+    vmax = float(np.max(image)) if vmax is None else vmax
+    scaled = np.zeros(image.shape, dtype=np.uint8)
+    if vmax > vmin:
+        scaled = (np.clip((image - vmin) / (vmax - vmin), 0, 1) * 255).round().astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(scaled).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+@volumes.route('/<key>/slice', methods=['GET'])
+def get_volume_slice(key):
+    """
+    One 2D slice of a volume, read from its memory map.
+
+    Query parameters: axis (z, y, x or 0-2 in array order), index, source/maskType
+    (see resolve_volume) and format: 'binary' (default, the binary_arrays envelope
+    with the slice in its stored dtype) or 'png' (8-bit grayscale, windowed by
+    optional vmin/vmax).
+    """
+    output = request.args.get('format', 'binary')
+    try:
+        axis = parse_axis(request.args.get('axis', 'z'))
+        index = request.args.get('index', type=int)
+        if index is None:
+            raise ValueError("index is required")
+        vmin = request.args.get('vmin', type=float)
+        vmax = request.args.get('vmax', type=float)
+        if output not in ('binary', 'png'):
+            raise ValueError("format must be binary or png")
+        volume, affine, version = resolve_volume(key)
+
+        etag = f"{version}-slice-{axis}-{index}-{output}-{vmin}-{vmax}"
+        cached = not_modified(etag, compress=output == 'binary')
+        if cached is not None:
+            return cached
+        image = read_slice(volume, axis, index)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except VolumeNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        current_app.logger.error(f"Error reading slice of volume {key}: {e}")
+        return jsonify({'error': 'Failed to read slice'}), 500
+
+    if output == 'png':
+        return binary_response(encode_png(image, vmin, vmax), etag, content_type='image/png')
+    payload = pack_arrays(
+        {'data': image}, dims=list(image.shape), axis=axis, index=index,
+        volume_dims=list(volume.shape), affine=np.asarray(affine).tolist()
+    )
+    return binary_response(payload, etag, compress=True)
+
+@volumes.route('/<key>/roi', methods=['GET'])
+def get_volume_roi(key):
+    """
+    The voxels of a volume inside a bounding box, read from its memory map.
+
+    Query parameters: bbox (inclusive z_min,z_max,y_min,y_max,x_min,x_max in array
+    order), layout (auto, dense or sparse, see binary_arrays.pack_volume) and
+    source/maskType (see resolve_volume). Returns the binary_arrays envelope with the
+    region in its stored dtype, its bbox and the volume's dims and affine.
+    """
+    try:
+        bbox = parse_bbox(request.args.get('bbox', ''))
+        layout = request.args.get('layout', 'auto')
+        if layout not in VOLUME_LAYOUTS:
+            raise ValueError(f"layout must be one of {', '.join(VOLUME_LAYOUTS)}")
+        volume, affine, version = resolve_volume(key)
+
+        etag = f"{version}-roi-{'_'.join(map(str, bbox))}-{layout}"
+        cached = not_modified(etag, compress=True)
+        if cached is not None:
+            return cached
+        region = read_roi(volume, bbox)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except VolumeNotFound as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        current_app.logger.error(f"Error reading region of volume {key}: {e}")
+        return jsonify({'error': 'Failed to read region'}), 500
+
+    payload = pack_volume(
+        region, layout, bbox=list(bbox), volume_dims=list(volume.shape), affine=np.asarray(affine).tolist()
+    )
+    return binary_response(payload, etag, compress=True)
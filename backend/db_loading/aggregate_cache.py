@@ -0,0 +1,294 @@
+"""
+Content-addressed cache for cohort aggregates.
+
+Aggregates are stored once per canonical (mask_type, criteria, dataset version) hash as
+``{cache_dir}/blobs/<key>.nii.gz``. Filter ids are only unique per user (every user has a
+'default_id'), so each filter gets a ``{cache_dir}/users/<owner>/<filter_id>.nii.gz``
+symlink to its blob, and references are recorded per (owner, filter id). Aggregates
+precomputed by generate_display_nifti's command line (``{cache_dir}/<filter_id>.nii.gz``)
+are shared and serve any owner without a filter of that id (see find_filter_aggregate).
+Voxel-wise statistic maps of the same cohort live next to the blob as
+``<key>.<statistic>.nii.gz``, linked as ``users/<owner>/<filter_id>.<statistic>.nii.gz``,
+and share the blob's lifetime, as do isosurface meshes extracted from it
+(``<key>.iso-<level>.npz``).
+Redis maps every filter to its key and keeps the set of filters referencing each key; a
+blob is only deleted once no filter references it.
+
+Blobs are built, linked and removed while holding their aggregate lock (see
+aggregate_lock_name), so a blob cannot disappear between being found and being linked.
+"""
+
+import os
+import re
+import glob
+import json
+import time
+import hashlib
+import threading
+from datetime import date
+
+from app import redis_cache
+from single_flight import single_flight
+
+BLOB_SUBDIR = 'blobs'
+USERS_SUBDIR = 'users'
+
+# Map mask types to cache directories
+MASK_CACHE_SUBDIRS = {
+    'tumor': 'tumor_mask_cache',
+    'mri': 'mri_mask_cache',
+    'dose': 'dose_mask_cache'
+}
+
+# How long a worker trusts a VersionedSnapshot before re-reading the dataset version
+VERSION_CHECK_SECONDS = 1.0
+
+# Filter ids that are safe to use in link paths; routes reject any other id from a client
+FILTER_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Bump when the meaning of criteria changes, so aggregates cached under the old meaning are not reused
+CRITERIA_VERSION = 2
+
+def get_dataset_version():
+    """Current dataset version, bumped by ingest tools whenever patients or masks change."""
+    try:
+        return redis_cache.get_dataset_version()
+    except Exception as e:
+        print(f"Error reading dataset version: {e}")
+        return '0'
+
+class VersionedSnapshot:
+    """
+    Worker-local value built for the current dataset version by build(version). The
+    version is re-read at most every VERSION_CHECK_SECONDS, and the value is rebuilt
+    by one thread once ingest has bumped it.
+    """
+    def __init__(self, build):
+        self.build = build
+        self._current = None # (dataset version, value)
+        self._lock = threading.Lock()
+        self._last_version_check = 0.0
+
+    def get(self):
+        """The value for the current dataset version; errors of build propagate."""
+        now = time.monotonic()
+        current = self._current
+        if current is not None and now - self._last_version_check < VERSION_CHECK_SECONDS:
+            return current[1]
+
+        version = get_dataset_version()
+        self._last_version_check = now
+        if current is None or current[0] != version:
+            with self._lock:
+                current = self._current
+                if current is None or current[0] != version:
+                    current = (version, self.build(version))
+                    self._current = current
+        return current[1]
+
+def _normalize_item(item):
+    """Reduce a selected option to what the query actually uses: its label or its bounds."""
+    if isinstance(item, dict):
+        if 'min' in item or 'max' in item:
+            return {'min': item.get('min'), 'max': item.get('max')}
+        return item.get('label', str(item))
+    return item
+
+def normalize_criteria(criteria):
+    """
+    Canonical form of a criteria dict: empty sections and filters dropped, options
+    reduced to labels or bounds, de-duplicated and sorted.
+    """
+    normalized = {}
+    for section, section_criteria in (criteria or {}).items():
+        if not section_criteria:
+            continue
+        for key, selected in section_criteria.items():
+            if not selected:
+                continue
+            items = {json.dumps(_normalize_item(item), sort_keys=True) for item in selected}
+            normalized.setdefault(section, {})[key] = [json.loads(item) for item in sorted(items)]
+    return normalized
+
+def criteria_cache_key(criteria, dataset_version=None, **scope):
+    """
+    Hash identifying a result derived from the cohort matching criteria in the current
+    dataset version; scope keyword arguments name what was derived (e.g. mask_type).
+    """
+    normalized = normalize_criteria(criteria)
+    payload = {
+        **scope,
+        'criteria': normalized,
+        'criteria_version': CRITERIA_VERSION,
+        'dataset_version': dataset_version if dataset_version is not None else get_dataset_version()
+    }
+    # Age filters are relative to today, so their cohorts change from day to day
+    if normalized.get('patient_demographics', {}).get('age_range'):
+        payload['as_of'] = date.today().isoformat()
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:32]
+
+def aggregate_cache_key(mask_type, criteria, dataset_version=None):
+    """Hash identifying the aggregate of mask_type over the masks matching criteria."""
+    return criteria_cache_key(criteria, dataset_version, mask_type=mask_type)
+
+def get_blob_path(cache_dir, key):
+    return os.path.join(cache_dir, BLOB_SUBDIR, f"{key}.nii.gz")
+
+def get_owner_dir(cache_dir, owner):
+    return os.path.join(cache_dir, USERS_SUBDIR, owner)
+
+def get_filter_link_path(cache_dir, owner, filter_id):
+    return os.path.join(get_owner_dir(cache_dir, owner), f"{filter_id}.nii.gz")
+
+def get_shared_aggregate_path(cache_dir, filter_id):
+    return os.path.join(cache_dir, f"{filter_id}.nii.gz")
+
+def find_filter_aggregate(cache_dir, owner, filter_id):
+    """Path of the owner's aggregate for the filter, else the shared precomputed one, else None."""
+    for path in (get_filter_link_path(cache_dir, owner, filter_id), get_shared_aggregate_path(cache_dir, filter_id)):
+        if os.path.exists(path):
+            return path
+    return None
+
+def get_statistic_blob_path(cache_dir, key, statistic):
+    return get_blob_path(cache_dir, f"{key}.{statistic}")
+
+def get_statistic_link_path(cache_dir, owner, filter_id, statistic):
+    return get_filter_link_path(cache_dir, owner, f"{filter_id}.{statistic}")
+
+def get_isosurface_blob_path(cache_dir, key, level):
+    return os.path.join(cache_dir, BLOB_SUBDIR, f"{key}.iso-{level:g}.npz")
+
+def get_blob_key(cache_dir, owner, filter_id):
+    """Content key of the blob the owner's filter links to, or None if it has no blob link."""
+    link_path = get_filter_link_path(cache_dir, owner, filter_id)
+    if not os.path.islink(link_path):
+        return None
+    name = os.path.basename(os.readlink(link_path))
+    return name[:-len('.nii.gz')] if name.endswith('.nii.gz') else None
+
+def aggregate_lock_name(mask_type, key):
+    """single_flight lock held while the blob for key is built, linked or removed."""
+    return f"aggregate:{mask_type}:{key}"
+
+def _ref_member(owner, filter_id):
+    return f'{owner}:{filter_id}'
+
+def _filter_key_name(mask_type, owner, filter_id):
+    return f'aggregate_key:{mask_type}:{_ref_member(owner, filter_id)}'
+
+def _refs_key_name(mask_type, key):
+    return f'aggregate_refs:{mask_type}:{key}'
+
+def get_filter_key(mask_type, owner, filter_id):
+    """Content key the owner's filter last pointed to, or None if unknown."""
+    try:
+        key = redis_cache.get_path(_filter_key_name(mask_type, owner, filter_id))
+    except Exception as e:
+        print(f"Error reading aggregate key for filter {filter_id}: {e}")
+        return None
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    return key
+
+def _remove_blob(cache_dir, key):
+    # The aggregate itself plus its running-sum state, statistic maps, isosurfaces and uncompressed copies
+    blob_path = get_blob_path(cache_dir, key)
+    paths = [blob_path] + glob.glob(os.path.join(glob.escape(os.path.dirname(blob_path)), f"{key}.*"))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            print(f"Removed unreferenced aggregate: {path}")
+
+def release_key(cache_dir, mask_type, key, owner, filter_id):
+    """
+    Drop the owner's filter's reference to key and delete the blob if nothing references it.
+
+    Must not be called while holding another aggregate lock.
+    """
+    refs_key = _refs_key_name(mask_type, key)
+    try:
+        remaining = redis_cache.remove_member(refs_key, _ref_member(owner, filter_id))
+    except Exception as e:
+        # Without reference counts we cannot tell whether the blob is shared, so keep it
+        print(f"Error releasing aggregate {key}: {e}")
+        return
+    if remaining:
+        return
+    with single_flight(aggregate_lock_name(mask_type, key)):
+        # A filter may have linked the blob since the reference was dropped
+        try:
+            if redis_cache.count_members(refs_key) == 0:
+                _remove_blob(cache_dir, key)
+        except Exception as e:
+            print(f"Error releasing aggregate {key}: {e}")
+
+def _link_blob(cache_dir, link_path, blob_name):
+    # Replace the link atomically, so readers see either the old blob or the new one
+    os.makedirs(os.path.dirname(link_path), exist_ok=True)
+    tmp_path = f"{link_path}.{os.getpid()}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    target = os.path.join(cache_dir, BLOB_SUBDIR, blob_name)
+    os.symlink(os.path.relpath(target, os.path.dirname(link_path)), tmp_path)
+    os.replace(tmp_path, link_path)
+
+def link_filter(cache_dir, mask_type, owner, filter_id, key):
+    """
+    Point the filter's aggregate path at the blob for key and take the owner's
+    reference to it.
+
+    Must be called holding the aggregate lock for key. The reference to the filter's
+    previous blob is not released here, as that takes the previous blob's lock: pass
+    the returned key to release_key once the lock is released.
+
+    Returns:
+        tuple: (path to the filter's aggregate (a symlink to the blob), the key the
+               filter pointed to before if it still needs releasing, else None)
+    """
+    link_path = get_filter_link_path(cache_dir, owner, filter_id)
+    _link_blob(cache_dir, link_path, f"{key}.nii.gz")
+
+    previous_key = get_filter_key(mask_type, owner, filter_id)
+    try:
+        redis_cache.add_member(_refs_key_name(mask_type, key), _ref_member(owner, filter_id))
+        redis_cache.set_path(_filter_key_name(mask_type, owner, filter_id), key)
+    except Exception as e:
+        print(f"Error recording aggregate reference for filter {filter_id}: {e}")
+        return link_path, None
+
+    return link_path, previous_key if previous_key != key else None
+
+def link_statistic(cache_dir, owner, filter_id, key, statistic):
+    """
+    Point the owner's filter's statistic map path at the statistic blob for key. The
+    blob is kept alive by the filter's reference to key, taken in link_filter.
+
+    Returns:
+        str: Path to the filter's statistic map (a symlink to the blob)
+    """
+    link_path = get_statistic_link_path(cache_dir, owner, filter_id, statistic)
+    _link_blob(cache_dir, link_path, f"{key}.{statistic}.nii.gz")
+    return link_path
+
+def unlink_filter(cache_dir, owner, filter_id):
+    """Remove the owner's filter's aggregate and statistic map paths but keep its reference, e.g. when its criteria changed."""
+    link_path = get_filter_link_path(cache_dir, owner, filter_id)
+    owner_dir = get_owner_dir(cache_dir, owner)
+    statistic_links = glob.glob(os.path.join(glob.escape(owner_dir), f"{glob.escape(filter_id)}.*.nii.gz"))
+    for path in [link_path] + statistic_links:
+        if os.path.lexists(path):
+            os.remove(path)
+
+def release_filter(cache_dir, mask_type, owner, filter_id):
+    """Remove the filter's aggregate path and the owner's reference; the blob goes once it is unreferenced."""
+    unlink_filter(cache_dir, owner, filter_id)
+    key = get_filter_key(mask_type, owner, filter_id)
+    if key is None:
+        return
+    try:
+        redis_cache.delete_path(_filter_key_name(mask_type, owner, filter_id))
+    except Exception as e:
+        print(f"Error removing aggregate key for filter {filter_id}: {e}")
+    release_key(cache_dir, mask_type, key, owner, filter_id)
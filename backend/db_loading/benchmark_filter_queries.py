@@ -0,0 +1,130 @@
+"""
+Benchmark the cohort filter queries with EXPLAIN ANALYZE.
+
+Run once before and once after applying a migration, saving each run, then compare:
+
+    python -m db_loading.benchmark_filter_queries --save before.json
+    alembic upgrade head
+    python -m db_loading.benchmark_filter_queries --save after.json --compare before.json
+"""
+
+import json
+import argparse
+import statistics
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app import app, db
+from models import Patients, TumorMask
+from db_loading.criteria_compiler import mask_ids_query, patient_ids_query, cohort_counts_query
+
+def _first_value(column):
+    row = db.session.query(column).distinct().order_by(column).first()
+    return row[0] if row else None
+
+def get_benchmark_queries():
+    """Representative compiled queries for the filter hot paths, named for the report."""
+    origin_cancer = _first_value(Patients.origin_cancer)
+    location = _first_value(TumorMask.location)
+
+    demographics = {
+        'patient_demographics': {
+            'origin_cancer': [origin_cancer],
+            'sex': ['F'],
+            'age_range': [{'label': '50-59', 'min': 50, 'max': 59}]
+        }
+    }
+    tumor_criteria = {
+        **demographics,
+        'tumor_characteristics': {
+            'tumor_location': [location],
+            'tumor_volume_range': [{'label': 'Small', 'min': 0, 'max': 50}]
+        }
+    }
+    dose_criteria = {**demographics, 'treatment_data': {'dose_range': [{'label': 'High', 'min': 50, 'max': 70}]}}
+
+    return {
+        'tumor ids (no filters)': mask_ids_query('tumor', {}),
+        'tumor ids (demographics)': mask_ids_query('tumor', demographics),
+        'tumor ids (location + volume)': mask_ids_query('tumor', tumor_criteria),
+        'tumor ids (dose range)': mask_ids_query('tumor', dose_criteria),
+        'mri ids (demographics)': mask_ids_query('mri', demographics),
+        'mri ids (age at diagnosis)': mask_ids_query('mri', {
+            'patient_demographics': {'age_at_diagnosis_range': [{'label': '50-59', 'min': 50, 'max': 59}]}
+        }),
+        'dose ids (dose range)': mask_ids_query('dose', dose_criteria),
+        'patient ids (all filters)': patient_ids_query({**tumor_criteria, **dose_criteria}),
+        'cohort counts (all filters)': cohort_counts_query({**tumor_criteria, **dose_criteria}),
+    }
+
+def _scan_nodes(plan, nodes=None):
+    """(node type, relation or index) of every scan in a JSON plan tree."""
+    nodes = [] if nodes is None else nodes
+    if 'Scan' in plan['Node Type']:
+        nodes.append(f"{plan['Node Type']} on {plan.get('Index Name') or plan.get('Relation Name') or '?'}")
+    for child in plan.get('Plans', []):
+        _scan_nodes(child, nodes)
+    return nodes
+
+def explain_analyze(query, runs=5):
+    """
+    Run EXPLAIN (ANALYZE, BUFFERS) on a query several times.
+
+    Returns:
+        dict: Median planning/execution time in ms and the scans of the last plan
+    """
+    # Expand in_() lists into one bound parameter per value; left as postcompile
+    # placeholders they reach Postgres as literal text and EXPLAIN fails
+    compiled = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    sql = f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {compiled}"
+    connection = db.session.connection()
+
+    planning, execution = [], []
+    plan = None
+    for _ in range(runs):
+        result = connection.exec_driver_sql(sql, compiled.params).scalar()
+        plan = result[0] if isinstance(result, list) else json.loads(result)[0]
+        planning.append(plan['Planning Time'])
+        execution.append(plan['Execution Time'])
+
+    return {
+        'planning_ms': statistics.median(planning),
+        'execution_ms': statistics.median(execution),
+        'scans': _scan_nodes(plan['Plan'])
+    }
+
+def run_benchmark(runs=5):
+    results = {}
+    for name, query in get_benchmark_queries().items():
+        results[name] = explain_analyze(query, runs)
+        print(f"\n{name}: {results[name]['execution_ms']:.2f} ms (planning {results[name]['planning_ms']:.2f} ms)")
+        for scan in results[name]['scans']:
+            print(f"    {scan}")
+    return results
+
+def print_comparison(before, after):
+    print(f"\n{'query':<32} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for name, result in after.items():
+        if name not in before:
+            continue
+        old, new = before[name]['execution_ms'], result['execution_ms']
+        speedup = old / new if new else float('inf')
+        print(f"{name:<32} {old:>10.2f} {new:>10.2f} {speedup:>7.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='EXPLAIN ANALYZE runs per query (median is reported)')
+    parser.add_argument('--save', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare against results saved by an earlier run')
+    args = parser.parse_args()
+
+    with app.app_context():
+        results = run_benchmark(args.runs)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
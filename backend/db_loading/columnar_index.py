@@ -0,0 +1,275 @@
+"""
+Worker-local columnar snapshot of the patient and mask metadata.
+
+The filterable columns of Patients and of every mask table are held as NumPy arrays
+(categoricals dictionary-encoded), and criteria are evaluated as vectorized boolean
+masks with the same semantics as criteria_compiler, one mask per filter so the
+counts for toggling any single option (facet_counts) reuse all the other filters.
+A snapshot is stamped with the dataset version it was loaded at and is reloaded once
+ingest bumps the version, so cohort ids and counts for live previews need no
+database round trip.
+"""
+
+import time
+from datetime import date
+
+import numpy as np
+
+from app import db
+from models import Patients, NiftiData
+from db_loading.aggregate_cache import VersionedSnapshot
+from db_loading.criteria_compiler import (
+    MASK_MODELS, PATIENT_SELECT_FILTERS, PATIENT_RANGE_FILTERS, MASK_SELECT_FILTERS, MASK_RANGE_FILTERS,
+    get_selected, option_labels, years_before
+)
+
+# Table name of the patient-level filters in filter_tables()
+PATIENTS = 'patients'
+AGE_FILTER = ('patient_demographics', 'age_range')
+
+class CategoricalColumn:
+    """Dictionary-encoded column: codes index into categories."""
+    def __init__(self, values):
+        self.categories, codes = np.unique(np.array([str(value) for value in values], dtype=object), return_inverse=True)
+        self.codes = codes.astype(np.int32)
+
+    def isin(self, labels):
+        labels = set(labels)
+        wanted = [code for code, category in enumerate(self.categories) if category in labels]
+        return np.isin(self.codes, wanted)
+
+def _encode_columns(rows, names, categorical):
+    """Turn query rows (id first, then names) into named column arrays."""
+    columns = {}
+    for position, name in enumerate(names, start=1):
+        values = [row[position] for row in rows]
+        if name in categorical:
+            columns[name] = CategoricalColumn(values)
+        elif name == 'dob':
+            columns[name] = np.array(values, dtype='datetime64[D]')
+        else:
+            columns[name] = np.array(values, dtype=np.float64)
+    return columns
+
+def _range_match(values, ranges, default_min, default_max):
+    """OR of the selected [min, max] ranges over a numeric column."""
+    in_any = np.zeros(len(values), dtype=bool)
+    for item in ranges:
+        in_any |= (values >= item.get('min', default_min)) & (values <= item.get('max', default_max))
+    return in_any
+
+class MaskTable:
+    def __init__(self, ids, patient_index, columns):
+        self.ids = ids
+        self.patient_index = patient_index
+        self.columns = columns
+
+class ColumnarIndex:
+    def __init__(self, version, patient_ids, patient_columns, masks):
+        self.version = version
+        self.patient_ids = patient_ids
+        self.patient_columns = patient_columns
+        self.masks = masks
+        self.filter_tables = self._filter_tables()
+
+    def _filter_tables(self):
+        """(section, key) -> table holding the filtered column: PATIENTS or a mask type."""
+        tables = {filter_key: PATIENTS for filter_key in PATIENT_SELECT_FILTERS}
+        tables.update({filter_key: PATIENTS for filter_key in PATIENT_RANGE_FILTERS})
+        tables[AGE_FILTER] = PATIENTS
+        for mask_type in self.masks:
+            tables.update({filter_key: mask_type for filter_key in MASK_SELECT_FILTERS[mask_type]})
+            tables.update({filter_key: mask_type for filter_key in MASK_RANGE_FILTERS[mask_type]})
+        return tables
+
+    def filter_match(self, section, key, selected, on_date=None):
+        """
+        Evaluate one filter over its table.
+
+        Returns:
+            tuple: (table, boolean mask over its rows), or None if nothing is selected
+                   or the filter is unknown
+        """
+        table = self.filter_tables.get((section, key))
+        if table is None or not selected:
+            return None
+        columns, size = (
+            (self.patient_columns, len(self.patient_ids)) if table == PATIENTS
+            else (self.masks[table].columns, len(self.masks[table].ids))
+        )
+        select_filters = PATIENT_SELECT_FILTERS if table == PATIENTS else MASK_SELECT_FILTERS[table]
+        range_filters = PATIENT_RANGE_FILTERS if table == PATIENTS else MASK_RANGE_FILTERS[table]
+
+        if (section, key) in select_filters:
+            return table, columns[select_filters[(section, key)].key].isin(option_labels(selected))
+
+        ranges = [item for item in selected if isinstance(item, dict)]
+        if not ranges:
+            return None
+        if (section, key) == AGE_FILTER:
+            # Completed years on on_date as a dob range, see criteria_compiler.age_predicate
+            on_date = on_date or date.today()
+            dob = columns['dob']
+            in_any = np.zeros(size, dtype=bool)
+            for item in ranges:
+                latest = np.datetime64(years_before(on_date, item.get('min', 0)))
+                earliest = np.datetime64(years_before(on_date, item.get('max', 150) + 1))
+                in_any |= (dob <= latest) & (dob > earliest)
+            return table, in_any
+
+        column, default_min, default_max = range_filters[(section, key)]
+        return table, _range_match(columns[column.key], ranges, default_min, default_max)
+
+    def filter_matches(self, criteria, on_date=None):
+        """(section, key) -> (table, boolean mask) for every filter with a selection in criteria."""
+        matches = {}
+        for section, key in self.filter_tables:
+            match = self.filter_match(section, key, get_selected(criteria or {}, section, key), on_date)
+            if match is not None:
+                matches[(section, key)] = match
+        return matches
+
+    def combine(self, matches):
+        """
+        Combine per-filter matches with the semantics of criteria_compiler.mask_ids_query.
+
+        Returns:
+            CohortPreview: Matching masks of every mask type
+        """
+        patients = np.ones(len(self.patient_ids), dtype=bool)
+        own = {mask_type: None for mask_type in self.masks}
+        for table, match in matches.values():
+            if table == PATIENTS:
+                patients &= match
+            else:
+                own[table] = match.copy() if own[table] is None else own[table] & match
+
+        # Patients with at least one mask passing that mask type's own filters
+        has_matching = {}
+        for mask_type, matches_own in own.items():
+            if matches_own is not None:
+                has_mask = np.zeros(len(self.patient_ids), dtype=bool)
+                has_mask[self.masks[mask_type].patient_index[matches_own]] = True
+                has_matching[mask_type] = has_mask
+
+        cohorts = {}
+        for mask_type, table in self.masks.items():
+            patient_ok = patients.copy()
+            for other_type, has_mask in has_matching.items():
+                if other_type != mask_type:
+                    patient_ok &= has_mask
+            cohort = patient_ok[table.patient_index]
+            if own[mask_type] is not None:
+                cohort &= own[mask_type]
+            cohorts[mask_type] = cohort
+        return CohortPreview(self, cohorts)
+
+    def evaluate(self, criteria, on_date=None):
+        """
+        Evaluate criteria with the semantics of criteria_compiler.mask_ids_query.
+
+        Returns:
+            CohortPreview: Matching masks of every mask type
+        """
+        return self.combine(self.filter_matches(criteria, on_date))
+
+    def facet_counts(self, criteria, filter_options, on_date=None):
+        """
+        Counts of the cohorts each option would give if it were toggled in criteria.
+
+        Every filter is evaluated once; toggling an option only re-evaluates that one
+        filter before combining, so no option needs a query of its own.
+
+        Args:
+            criteria (dict): Current structured filter criteria
+            filter_options (dict): section -> key -> {'type', 'options'}, as served by /api/filter-options
+
+        Returns:
+            dict: section -> key -> list of {'label', 'selected', 'patients', <mask_type>...}
+        """
+        criteria = criteria or {}
+        matches = self.filter_matches(criteria, on_date)
+        facets = {}
+        for section, section_options in filter_options.items():
+            for key, definition in section_options.items():
+                selected = get_selected(criteria, section, key)
+                selected_labels = set(option_labels(selected))
+                counts = []
+                for option in definition.get('options', []):
+                    label = option_labels([option])[0]
+                    is_selected = label in selected_labels
+                    toggled = (
+                        [item for item in selected if option_labels([item])[0] != label] if is_selected
+                        else list(selected) + [option]
+                    )
+                    toggled_matches = dict(matches)
+                    toggled_matches.pop((section, key), None)
+                    match = self.filter_match(section, key, toggled, on_date)
+                    if match is not None:
+                        toggled_matches[(section, key)] = match
+
+                    preview = self.combine(toggled_matches)
+                    counts.append({
+                        'label': label,
+                        'selected': is_selected,
+                        'patients': preview.patient_count(),
+                        **{mask_type: preview.count(mask_type) for mask_type in self.masks}
+                    })
+                facets.setdefault(section, {})[key] = counts
+        return facets
+
+class CohortPreview:
+    """Matching masks of every mask type for one criteria evaluation."""
+    def __init__(self, index, cohorts):
+        self.index = index
+        self.cohorts = cohorts
+
+    def count(self, mask_type):
+        return int(np.count_nonzero(self.cohorts[mask_type]))
+
+    def mask_ids(self, mask_type):
+        return self.index.masks[mask_type].ids[self.cohorts[mask_type]].tolist()
+
+    def patient_count(self):
+        """Distinct patients with a mask in any cohort, like cohort_counts_query's total_patients."""
+        in_any = np.zeros(len(self.index.patient_ids), dtype=bool)
+        for mask_type, matches in self.cohorts.items():
+            in_any[self.index.masks[mask_type].patient_index[matches]] = True
+        return int(np.count_nonzero(in_any))
+
+def build_columnar_index(version):
+    """Load the filterable metadata into a ColumnarIndex stamped with version."""
+    start = time.perf_counter()
+    categorical = {column.key for column in PATIENT_SELECT_FILTERS.values()}
+    names = sorted(categorical | {column.key for column, _, _ in PATIENT_RANGE_FILTERS.values()} | {'dob'})
+    rows = db.session.query(Patients.id, *[getattr(Patients, name) for name in names]).all()
+    patient_ids = np.array([str(row[0]) for row in rows], dtype=object)
+    position = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+    patient_columns = _encode_columns(rows, names, categorical)
+
+    masks = {}
+    for mask_type, (model, series_type) in MASK_MODELS.items():
+        mask_categorical = {column.key for column in MASK_SELECT_FILTERS[mask_type].values()}
+        mask_names = sorted(mask_categorical | {column.key for column, _, _ in MASK_RANGE_FILTERS[mask_type].values()})
+        mask_rows = db.session.query(
+            NiftiData.id, *[getattr(model, name) for name in mask_names], NiftiData.patient_id
+        ).join(
+            model, model.id == NiftiData.id
+        ).filter(
+            NiftiData.series_type == series_type
+        ).order_by(NiftiData.id).all()
+        masks[mask_type] = MaskTable(
+            np.array([str(row[0]) for row in mask_rows], dtype=object),
+            np.array([position[str(row[-1])] for row in mask_rows], dtype=np.int64),
+            _encode_columns(mask_rows, mask_names, mask_categorical)
+        )
+
+    print(f"Loaded columnar index for dataset version {version}: {len(patient_ids)} patients, "
+          f"{sum(len(table.ids) for table in masks.values())} masks in {time.perf_counter() - start:.2f}s")
+    return ColumnarIndex(version, patient_ids, patient_columns, masks)
+
+_index = VersionedSnapshot(build_columnar_index)
+
+def get_columnar_index():
+    """This worker's snapshot, reloaded when the dataset version has changed."""
+    return _index.get()
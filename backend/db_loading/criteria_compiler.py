@@ -0,0 +1,220 @@
+"""
+Compiles structured filter criteria into SQL predicates shared by every cohort query.
+
+Criteria compile into one predicate tree:
+
+- patient-level filters (demographics, clinical data) become predicates on Patients;
+- mask-level filters (tumor location and volume, dose range) become predicates on the
+  mask's own table when querying that mask type, and EXISTS subqueries otherwise, so
+  e.g. a dose range restricts the tumor cohort to patients with a matching dose mask.
+
+Patients matching all of it are exposed as a ``matching_patients`` CTE that the mask
+id queries join against, so each cohort is a single statement. The counts of every
+cohort come from one aggregate query (cohort_counts_query).
+"""
+
+from datetime import date
+
+from sqlalchemy.orm import aliased
+
+from app import db
+from models import Patients, TumorMask, NiftiData, DoseMask, MRIMask
+
+# Mask model and series type per mask type
+MASK_MODELS = {
+    'tumor': (TumorMask, 'tumor_mask'),
+    'mri': (MRIMask, 'mri_mask'),
+    'dose': (DoseMask, 'dose_mask')
+}
+
+# (section, key) -> column for filters selecting categories by label
+PATIENT_SELECT_FILTERS = {
+    ('patient_demographics', 'origin_cancer'): Patients.origin_cancer,
+    ('patient_demographics', 'sex'): Patients.sex,
+}
+
+# (section, key) -> (column, default min, default max) for filters selecting value ranges
+PATIENT_RANGE_FILTERS = {
+    ('patient_demographics', 'age_at_diagnosis_range'): (Patients.age_at_diagnosis, 0, 150),
+    ('patient_demographics', 'height_range'): (Patients.height_cm, 0, 250),
+    ('patient_demographics', 'weight_range'): (Patients.weight_kg, 0, 200),
+    ('patient_demographics', 'tumor_count_range'): (Patients.tumor_count, 1, 100),
+    ('clinical_data', 'systolic_bp_range'): (Patients.systolic_bp, 0, 300),
+    ('clinical_data', 'diastolic_bp_range'): (Patients.diastolic_bp, 0, 200),
+}
+
+# Filters on the mask tables, per mask type
+MASK_SELECT_FILTERS = {
+    'tumor': {('tumor_characteristics', 'tumor_location'): TumorMask.location},
+    'mri': {},
+    'dose': {},
+}
+
+MASK_RANGE_FILTERS = {
+    'tumor': {('tumor_characteristics', 'tumor_volume_range'): (TumorMask.volume_mm3, 0, 1000)},
+    'mri': {},
+    'dose': {('treatment_data', 'dose_range'): (DoseMask.max_dose, 0, 70)},
+}
+
+def get_selected(criteria, section, key):
+    return (criteria.get(section) or {}).get(key) or []
+
+def option_labels(selected):
+    return [item if isinstance(item, str) else item.get('label', str(item)) for item in selected]
+
+def _range_predicate(column, selected, default_min, default_max):
+    """OR of the selected [min, max] ranges, or None if no range was selected."""
+    bounds = [
+        column.between(item.get('min', default_min), item.get('max', default_max))
+        for item in selected if isinstance(item, dict)
+    ]
+    return db.or_(*bounds) if bounds else None
+
+def years_before(on_date, years):
+    """The same calendar day the given number of years earlier (29 February -> 28 February)."""
+    try:
+        return on_date.replace(year=on_date.year - years)
+    except ValueError:
+        return on_date.replace(year=on_date.year - years, day=28)
+
+def age_predicate(selected, on_date=None):
+    """
+    Age in completed years within any selected range, as a range on dob.
+
+    age >= min  <=>  dob <= on_date - min years
+    age <= max  <=>  dob >  on_date - (max + 1) years
+    """
+    on_date = on_date or date.today()
+    bounds = []
+    for item in selected:
+        if isinstance(item, dict):
+            min_age = item.get('min', 0)
+            max_age = item.get('max', 150)
+            bounds.append(db.and_(
+                Patients.dob <= years_before(on_date, min_age),
+                Patients.dob > years_before(on_date, max_age + 1)
+            ))
+    return db.or_(*bounds) if bounds else None
+
+def patient_predicates(criteria):
+    """Predicates on Patients for the patient-level filters in criteria."""
+    predicates = []
+    for (section, key), column in PATIENT_SELECT_FILTERS.items():
+        selected = get_selected(criteria, section, key)
+        if selected:
+            predicates.append(column.in_(option_labels(selected)))
+
+    age_filter = age_predicate(get_selected(criteria, 'patient_demographics', 'age_range'))
+    if age_filter is not None:
+        predicates.append(age_filter)
+
+    for (section, key), (column, default_min, default_max) in PATIENT_RANGE_FILTERS.items():
+        range_filter = _range_predicate(column, get_selected(criteria, section, key), default_min, default_max)
+        if range_filter is not None:
+            predicates.append(range_filter)
+    return predicates
+
+def mask_predicates(mask_type, criteria):
+    """Predicates on the mask table of mask_type for its mask-level filters in criteria."""
+    predicates = []
+    for (section, key), column in MASK_SELECT_FILTERS[mask_type].items():
+        selected = get_selected(criteria, section, key)
+        if selected:
+            predicates.append(column.in_(option_labels(selected)))
+
+    for (section, key), (column, default_min, default_max) in MASK_RANGE_FILTERS[mask_type].items():
+        range_filter = _range_predicate(column, get_selected(criteria, section, key), default_min, default_max)
+        if range_filter is not None:
+            predicates.append(range_filter)
+    return predicates
+
+def has_matching_mask(mask_type, predicates):
+    """EXISTS predicate: the patient has at least one mask of mask_type matching predicates."""
+    model, series_type = MASK_MODELS[mask_type]
+    nifti = aliased(NiftiData)
+    # Correlate only on the patient, so the mask table stays inside the subquery even when
+    # the enclosing query joins the same table
+    return db.exists().where(
+        nifti.patient_id == Patients.id,
+        nifti.series_type == series_type,
+        model.id == nifti.id,
+        *predicates
+    ).correlate(Patients)
+
+def cross_mask_predicates(criteria, exclude_mask_type=None):
+    """A has_matching_mask predicate for every mask type with mask-level filters except exclude_mask_type."""
+    predicates = []
+    for mask_type in MASK_MODELS:
+        if mask_type == exclude_mask_type:
+            continue
+        mask_filters = mask_predicates(mask_type, criteria)
+        if mask_filters:
+            predicates.append(has_matching_mask(mask_type, mask_filters))
+    return predicates
+
+def patient_filter(criteria, exclude_mask_type=None):
+    """
+    All predicates a patient must satisfy: patient-level filters, plus a matching mask
+    for every mask type with mask-level filters except exclude_mask_type.
+    """
+    criteria = criteria or {}
+    return patient_predicates(criteria) + cross_mask_predicates(criteria, exclude_mask_type)
+
+def matching_patients_cte(criteria, exclude_mask_type=None, name='matching_patients'):
+    """CTE of the ids of patients matching criteria, see patient_filter."""
+    return db.select(Patients.id).where(*patient_filter(criteria, exclude_mask_type)).cte(name)
+
+def mask_ids_query(mask_type, criteria):
+    """
+    Query of the ids of masks of mask_type matching criteria: masks passing their own
+    mask-level filters whose patient is in the matching_patients CTE.
+    """
+    criteria = criteria or {}
+    model, series_type = MASK_MODELS[mask_type]
+    patients = matching_patients_cte(criteria, exclude_mask_type=mask_type)
+    return db.session.query(model.id).join(
+        NiftiData, model.id == NiftiData.id
+    ).join(
+        patients, NiftiData.patient_id == patients.c.id
+    ).filter(
+        NiftiData.series_type == series_type,
+        *mask_predicates(mask_type, criteria)
+    )
+
+def patient_ids_query(criteria):
+    """Query of the ids of patients matching criteria, including all mask-level filters."""
+    return db.session.query(Patients.id).filter(*patient_filter(criteria))
+
+def mask_match_predicate(mask_type, criteria):
+    """
+    Predicate on a NiftiData row (joined to its patient and mask table) that holds when
+    the row is a mask in the mask_type cohort, i.e. a row mask_ids_query would return.
+    """
+    _, series_type = MASK_MODELS[mask_type]
+    return db.and_(
+        NiftiData.series_type == series_type,
+        *mask_predicates(mask_type, criteria),
+        *cross_mask_predicates(criteria, exclude_mask_type=mask_type)
+    )
+
+def cohort_counts_query(criteria):
+    """
+    One aggregate query counting every cohort at once with COUNT(...) FILTER (WHERE ...).
+
+    The row has total_patients (distinct patients with a mask in any cohort) and
+    <mask_type>_count for every mask type.
+    """
+    criteria = criteria or {}
+    matches = {mask_type: mask_match_predicate(mask_type, criteria) for mask_type in MASK_MODELS}
+    query = db.session.query(
+        db.func.count(db.distinct(NiftiData.patient_id)).filter(db.or_(*matches.values())).label('total_patients'),
+        *[
+            db.func.count(NiftiData.id).filter(match).label(f'{mask_type}_count')
+            for mask_type, match in matches.items()
+        ]
+    ).select_from(NiftiData).join(
+        Patients, NiftiData.patient_id == Patients.id
+    )
+    for model, _ in MASK_MODELS.values():
+        query = query.outerjoin(model, model.id == NiftiData.id)
+    return query.filter(*patient_predicates(criteria))
@@ -0,0 +1,314 @@
+"""
+Precomputed per-facet partial sums ("facet cube").
+
+Every mask is assigned to one cell of the cube: the combination of its value in each
+facet dimension (origin cancer, sex, age bucket, ...). The builder stores the summed
+volume of every populated cell, cropped to its nonzero bounding box, in one flat file
+that is memory-mapped at query time. Any criteria made only of those facets is then
+answered by adding up the matching cells instead of loading the raw mask NIfTIs.
+"""
+
+import os
+import json
+import uuid
+import numpy as np
+from datetime import date
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app import app, db
+from models import Patients, TumorMask, NiftiData, DoseMask, MRIMask
+from db_loading.filter_ranges import AGE_RANGES, TUMOR_COUNT_RANGES, TUMOR_VOLUME_RANGES, DOSE_RANGES, bucket_index, match_range_index
+from db_loading.parallel_reduction import accumulate_mask_files, accumulate_cropped_masks, accumulator_dtype, parallel_accumulate, bbox_slices
+from db_loading.aggregate_cache import get_dataset_version
+
+CUBE_DIR = '/app/filestore/facet_cube'
+MANIFEST_NAME = 'manifest.json'
+
+PATIENT_DIMENSIONS = [
+    {'section': 'patient_demographics', 'key': 'origin_cancer', 'field': 'origin_cancer'},
+    {'section': 'patient_demographics', 'key': 'sex', 'field': 'sex'},
+    {'section': 'patient_demographics', 'key': 'age_range', 'field': 'age', 'ranges': AGE_RANGES},
+    {'section': 'patient_demographics', 'key': 'tumor_count_range', 'field': 'tumor_count', 'ranges': TUMOR_COUNT_RANGES},
+]
+
+# Facet dimensions per mask type. Criteria using any other filter fall back to the raw path.
+CUBE_DIMENSIONS = {
+    'tumor': PATIENT_DIMENSIONS + [
+        {'section': 'tumor_characteristics', 'key': 'tumor_location', 'field': 'location'},
+        {'section': 'tumor_characteristics', 'key': 'tumor_volume_range', 'field': 'volume_mm3', 'ranges': TUMOR_VOLUME_RANGES},
+    ],
+    'mri': PATIENT_DIMENSIONS,
+    'dose': [
+        {'section': 'patient_demographics', 'key': 'origin_cancer', 'field': 'origin_cancer'},
+        {'section': 'patient_demographics', 'key': 'sex', 'field': 'sex'},
+        {'section': 'treatment_data', 'key': 'dose_range', 'field': 'max_dose', 'ranges': DOSE_RANGES},
+    ],
+}
+
+SERIES_TYPES = {'tumor': 'tumor_mask', 'mri': 'mri_mask', 'dose': 'dose_mask'}
+
+# Process-local cache of opened cubes: mask_type -> (manifest mtime, manifest, memmap)
+_loaded_cubes = {}
+
+def age_on(dob, on_date):
+    """Age in completed years on the given date."""
+    return on_date.year - dob.year - ((on_date.month, on_date.day) < (dob.month, dob.day))
+
+def _query_cube_rows(mask_type):
+    """Return one row per mask with the fields needed to place it in a cube cell."""
+    patient_columns = [NiftiData.id, Patients.origin_cancer, Patients.sex, Patients.dob, Patients.tumor_count]
+    query = db.session.query(NiftiData.id).join(
+        Patients, NiftiData.patient_id == Patients.id
+    ).filter(
+        NiftiData.series_type == SERIES_TYPES[mask_type]
+    )
+
+    if mask_type == 'tumor':
+        query = query.join(TumorMask, TumorMask.id == NiftiData.id).with_entities(
+            *patient_columns,
+            TumorMask.location, TumorMask.volume_mm3,
+            TumorMask.z_min, TumorMask.z_max,
+            TumorMask.y_min, TumorMask.y_max,
+            TumorMask.x_min, TumorMask.x_max
+        )
+    elif mask_type == 'dose':
+        query = query.join(DoseMask, DoseMask.id == NiftiData.id).with_entities(*patient_columns, DoseMask.max_dose)
+    else:
+        query = query.join(MRIMask, MRIMask.id == NiftiData.id).with_entities(*patient_columns)
+
+    # Order by id so that cell sums are reproducible between builds
+    return query.order_by(NiftiData.id).all()
+
+def _cell_key(row, dimensions, built_on):
+    """Coordinates of a mask in the cube: category label or bucket index per dimension."""
+    values = row._asdict()
+    values['age'] = age_on(row.dob, built_on)
+    key = []
+    for dimension in dimensions:
+        value = values[dimension['field']]
+        if 'ranges' in dimension:
+            key.append(bucket_index(value, dimension['ranges']))
+        else:
+            key.append(value)
+    return tuple(key)
+
+def build_facet_cube(mask_type, input_dir, cube_dir, num_workers=1, voxel_store_dir=None):
+    """
+    Build the facet cube for one mask type.
+
+    Args:
+        mask_type (str): 'tumor', 'mri' or 'dose'
+        input_dir (str): Directory containing the raw <uuid>.nii.gz masks
+        cube_dir (str): Root directory of the facet cubes
+        num_workers (int): Worker processes used to sum each cell
+        voxel_store_dir (str, optional): Packed voxel store to read masks from
+
+    Returns:
+        str: Path to the written manifest
+    """
+    dimensions = CUBE_DIMENSIONS[mask_type]
+    built_on = date.today()
+    out_dir = os.path.join(cube_dir, mask_type)
+    os.makedirs(out_dir, exist_ok=True)
+
+    rows = _query_cube_rows(mask_type)
+    print(f"Building {mask_type} facet cube from {len(rows)} masks")
+
+    cells = {}
+    for row in rows:
+        cells.setdefault(_cell_key(row, dimensions, built_on), []).append(row)
+    print(f"{len(cells)} populated {mask_type} cells")
+
+    # Every cell and any sum of cells fits the accumulator sized for the whole corpus
+    dtype = accumulator_dtype(mask_type, len(rows))
+    build_id = uuid.uuid4().hex
+    data_name = f"cells-{build_id}.dat"
+    manifest = {
+        'mask_type': mask_type,
+        'built_on': built_on.isoformat(),
+        'dataset_version': get_dataset_version(),
+        'dimensions': [dimension['key'] for dimension in dimensions],
+        'data_file': data_name,
+        'dtype': dtype.name,
+        'shape': None,
+        'affine': None,
+        'total_masks': len(rows),
+        'cells': []
+    }
+
+    offset = 0
+    with open(os.path.join(out_dir, data_name), 'wb') as data_file:
+        for key, cell_rows in cells.items():
+            nifti_paths = [os.path.join(input_dir, f"{row.id}.nii.gz") for row in cell_rows]
+            if mask_type == 'tumor':
+                items = [
+                    (path, (row.z_min, row.z_max, row.y_min, row.y_max, row.x_min, row.x_max))
+                    for path, row in zip(nifti_paths, cell_rows)
+                ]
+                accumulate = accumulate_cropped_masks
+            else:
+                items = nifti_paths
+                accumulate = accumulate_mask_files
+
+            volume, affine, _ = parallel_accumulate(
+                items, num_workers, mask_type, accumulate=accumulate,
+                voxel_store_dir=voxel_store_dir, dtype=dtype
+            )
+
+            cell = {'key': list(key), 'count': len(cell_rows), 'offset': offset, 'bbox': None}
+            if volume is not None:
+                if manifest['affine'] is None:
+                    manifest['shape'] = list(volume.shape)
+                    manifest['affine'] = np.asarray(affine).tolist()
+
+                # Store only the nonzero bounding box of the partial sum
+                nonzero = np.nonzero(volume)
+                if len(nonzero[0]) > 0:
+                    bbox = []
+                    for axis in nonzero:
+                        bbox.extend([int(axis.min()), int(axis.max())])
+                    block = np.ascontiguousarray(volume[bbox_slices(bbox)], dtype=dtype)
+                    data_file.write(block.tobytes())
+                    cell['bbox'] = bbox
+                    offset += block.size
+
+            manifest['cells'].append(cell)
+
+    # Swap in the new manifest atomically; readers holding the old data file keep their mapping
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    previous_data = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous_data = json.load(f).get('data_file')
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    if previous_data and previous_data != data_name:
+        try:
+            os.remove(os.path.join(out_dir, previous_data))
+        except OSError:
+            pass
+
+    print(f"Wrote {mask_type} facet cube to {out_dir} ({offset * dtype.itemsize / (1024 * 1024):.1f} MB)")
+    return manifest_path
+
+def _open_cube(cube_dir, mask_type):
+    """Load (and cache per process) the manifest and memory-mapped cell data for a mask type."""
+    manifest_path = os.path.join(cube_dir, mask_type, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None, None
+
+    mtime = os.path.getmtime(manifest_path)
+    cached = _loaded_cubes.get(mask_type)
+    if cached and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    data_path = os.path.join(cube_dir, mask_type, manifest['data_file'])
+    data = None
+    if os.path.getsize(data_path) > 0:
+        data = np.memmap(data_path, dtype=manifest['dtype'], mode='r')
+    _loaded_cubes[mask_type] = (mtime, manifest, data)
+    return manifest, data
+
+def _resolve_selection(criteria, dimensions, manifest):
+    """
+    Translate criteria into the allowed cell coordinates per dimension.
+
+    Returns:
+        list: One set of allowed values per dimension (None = unconstrained), or
+              None if the criteria cannot be answered from the cube
+    """
+    selection = [None] * len(dimensions)
+    index_of = {(d['section'], d['key']): i for i, d in enumerate(dimensions)}
+
+    for section, section_criteria in (criteria or {}).items():
+        if not section_criteria:
+            continue
+        for key, selected in section_criteria.items():
+            if not selected:
+                continue
+            i = index_of.get((section, key))
+            if i is None:
+                return None
+            dimension = dimensions[i]
+
+            if 'ranges' in dimension:
+                # Age buckets shift every day, so only a cube built today can answer them
+                if key == 'age_range' and manifest['built_on'] != date.today().isoformat():
+                    return None
+                indices = {match_range_index(item, dimension['ranges']) for item in selected}
+                if -1 in indices:
+                    return None
+                selection[i] = indices
+            else:
+                selection[i] = {item if isinstance(item, str) else item.get('label', str(item)) for item in selected}
+
+    return selection
+
+def sum_from_cube(cube_dir, mask_type, criteria):
+    """
+    Answer an aggregation from the facet cube, if the criteria allow it.
+
+    Args:
+        cube_dir (str): Root directory of the facet cubes
+        mask_type (str): 'tumor', 'mri' or 'dose'
+        criteria (dict): Structured filter criteria
+
+    Returns:
+        tuple: (combined_volume, affine, mask_count), or None if there is no cube for
+               this mask type or the criteria use filters the cube does not cover
+    """
+    dimensions = CUBE_DIMENSIONS.get(mask_type)
+    if dimensions is None:
+        return None
+
+    try:
+        manifest, data = _open_cube(cube_dir, mask_type)
+    except Exception as e:
+        print(f"Error opening {mask_type} facet cube: {e}")
+        return None
+    if manifest is None or manifest['dimensions'] != [d['key'] for d in dimensions]:
+        return None
+    # A cube built from older data is stale until it is rebuilt
+    if manifest.get('dataset_version') != get_dataset_version():
+        return None
+
+    selection = _resolve_selection(criteria, dimensions, manifest)
+    if selection is None:
+        return None
+
+    combined_volume = None
+    mask_count = 0
+    matched_cells = 0
+    for cell in manifest['cells']:
+        if any(allowed is not None and value not in allowed for value, allowed in zip(cell['key'], selection)):
+            continue
+        mask_count += cell['count']
+        matched_cells += 1
+        if cell['bbox'] is None:
+            continue
+        if combined_volume is None:
+            combined_volume = np.zeros(manifest['shape'], dtype=manifest['dtype'])
+        region = bbox_slices(cell['bbox'])
+        block_shape = combined_volume[region].shape
+        size = int(np.prod(block_shape))
+        combined_volume[region] += data[cell['offset']:cell['offset'] + size].reshape(block_shape)
+
+    print(f"Summed {matched_cells} {mask_type} facet cells covering {mask_count} masks")
+    affine = np.array(manifest['affine']) if combined_volume is not None else None
+    return combined_volume, affine, mask_count
+
+# Rebuild all cubes when run as main, e.g. after ingesting new data
+if __name__ == "__main__":
+    INPUT_DIR = '../filestore/test_db_nifti'
+    CUBE_DIR = '../filestore/facet_cube'
+    VOXEL_STORE_DIR = '../filestore/voxel_store'
+
+    with app.app_context():
+        for cube_mask_type in CUBE_DIMENSIONS:
+            build_facet_cube(cube_mask_type, INPUT_DIR, CUBE_DIR, app.config.get('AGGREGATION_WORKERS', 1), VOXEL_STORE_DIR)
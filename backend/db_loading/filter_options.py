@@ -0,0 +1,117 @@
+"""
+Filter options served by /api/filter-options, cached per dataset version.
+
+The payload only changes when ingest bumps the dataset version (new cancer types or
+tumor locations) or when the static range tables change in a deploy, so it is built
+once per (dataset version, range tables) and cached at two levels: worker memory,
+then Redis for the other workers. Each payload carries an ETag for conditional GETs.
+Ingest tools invalidate it by bumping the dataset version (bump_dataset_version).
+"""
+
+import json
+import hashlib
+
+from sqlalchemy import distinct
+
+from app import db, redis_cache
+from models import Patients, TumorMask
+from db_loading.aggregate_cache import VersionedSnapshot
+from db_loading.filter_ranges import (
+    SEX_OPTIONS, AGE_RANGES, AGE_AT_DIAGNOSIS_RANGES, TUMOR_COUNT_RANGES, HEIGHT_RANGES, WEIGHT_RANGES,
+    BP_SYSTOLIC_RANGES, BP_DIASTOLIC_RANGES, TUMOR_VOLUME_RANGES, DOSE_RANGES
+)
+
+# Entries are keyed by dataset version; the TTL only reclaims stale ones
+OPTIONS_CACHE_TTL = 24 * 60 * 60
+
+# Static part of the payload; its hash is part of the cache key, so a deploy that changes
+# a range table never serves options cached by the previous code
+STATIC_OPTIONS = {
+    'sex': SEX_OPTIONS,
+    'age_range': AGE_RANGES,
+    'age_at_diagnosis_range': AGE_AT_DIAGNOSIS_RANGES,
+    'height_range': HEIGHT_RANGES,
+    'weight_range': WEIGHT_RANGES,
+    'tumor_count_range': TUMOR_COUNT_RANGES,
+    'systolic_bp_range': BP_SYSTOLIC_RANGES,
+    'diastolic_bp_range': BP_DIASTOLIC_RANGES,
+    'tumor_volume_range': TUMOR_VOLUME_RANGES,
+    'dose_range': DOSE_RANGES
+}
+STATIC_OPTIONS_HASH = hashlib.sha256(json.dumps(STATIC_OPTIONS, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def build_filter_options():
+    """Generate filter options based on actual database data."""
+    # Patient demographic filters
+    origin_cancers = db.session.query(distinct(Patients.origin_cancer)).order_by(Patients.origin_cancer).all()
+    origin_cancer_options = [cancer[0] for cancer in origin_cancers if cancer[0]]
+
+    # Tumor-specific filters
+    tumor_locations = db.session.query(distinct(TumorMask.location)).order_by(TumorMask.location).all()
+    tumor_location_options = [location[0] for location in tumor_locations if location[0]]
+
+    return {
+        'patient_demographics': {
+            'origin_cancer': {'type': 'select', 'options': origin_cancer_options},
+            'sex': {'type': 'select', 'options': SEX_OPTIONS},
+            'age_range': {'type': 'range', 'options': AGE_RANGES},
+            'age_at_diagnosis_range': {'type': 'range', 'options': AGE_AT_DIAGNOSIS_RANGES},
+            'height_range': {'type': 'range', 'options': HEIGHT_RANGES},
+            'weight_range': {'type': 'range', 'options': WEIGHT_RANGES},
+            'tumor_count_range': {'type': 'range', 'options': TUMOR_COUNT_RANGES}
+        },
+        'clinical_data': {
+            'systolic_bp_range': {'type': 'range', 'options': BP_SYSTOLIC_RANGES},
+            'diastolic_bp_range': {'type': 'range', 'options': BP_DIASTOLIC_RANGES}
+        },
+        'tumor_characteristics': {
+            'tumor_location': {'type': 'select', 'options': tumor_location_options},
+            'tumor_volume_range': {'type': 'range', 'options': TUMOR_VOLUME_RANGES}
+        },
+        'treatment_data': {
+            'dose_range': {'type': 'range', 'options': DOSE_RANGES}
+        }
+    }
+
+def _options_cache_key(version):
+    return f"filter_options:{version}:{STATIC_OPTIONS_HASH}"
+
+def _load_payload(version):
+    """The options payload of version from Redis, or built from the database and stored."""
+    cache_key = _options_cache_key(version)
+    try:
+        payload = redis_cache.get_json(cache_key)
+        if payload is not None:
+            return payload
+    except Exception as e:
+        print(f"Error reading cached filter options: {e}")
+
+    options = build_filter_options()
+    encoded = json.dumps(options, sort_keys=True, separators=(',', ':'))
+    payload = {
+        'etag': f"{version}-{hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]}",
+        'options': options
+    }
+    try:
+        redis_cache.set_json(cache_key, payload, OPTIONS_CACHE_TTL)
+    except Exception as e:
+        print(f"Error caching filter options: {e}")
+    return payload
+
+# {'etag', 'options'} for the current dataset version
+_payload = VersionedSnapshot(_load_payload)
+
+def get_cached_filter_options():
+    """
+    Filter options for the current dataset version, from worker memory, then Redis,
+    then the database.
+
+    Returns:
+        tuple: (options, etag); options is empty if they could not be built
+    """
+    try:
+        payload = _payload.get()
+    except Exception as e:
+        print(f"Error getting filter options: {e}")
+        return {}, None
+    return payload['options'], payload['etag']
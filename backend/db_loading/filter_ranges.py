@@ -0,0 +1,97 @@
+"""
+Bucket definitions for the range filters offered in the UI.
+
+These tables are shared by the filter options endpoint and the facet cube so that
+a cube cell always corresponds to exactly one selectable option.
+"""
+
+SEX_OPTIONS = ['M', 'F']
+
+# Age ranges - calculated from DOB
+AGE_RANGES = [
+    {'label': 'Under 30', 'min': 0, 'max': 29},
+    {'label': '30-39', 'min': 30, 'max': 39},
+    {'label': '40-49', 'min': 40, 'max': 49},
+    {'label': '50-59', 'min': 50, 'max': 59},
+    {'label': '60-69', 'min': 60, 'max': 69},
+    {'label': '70-79', 'min': 70, 'max': 79},
+    {'label': '80+', 'min': 80, 'max': 150}
+]
+
+# Age at original diagnosis ranges - from the generated patients.age_at_diagnosis column
+AGE_AT_DIAGNOSIS_RANGES = AGE_RANGES
+
+# Tumor count ranges
+TUMOR_COUNT_RANGES = [
+    {'label': 'Single (1)', 'min': 1, 'max': 1},
+    {'label': '2-3 tumors', 'min': 2, 'max': 3},
+    {'label': '4-5 tumors', 'min': 4, 'max': 5}
+]
+
+# Height ranges (cm)
+HEIGHT_RANGES = [
+    {'label': 'Under 150cm', 'min': 0, 'max': 149.9},
+    {'label': '150-159cm', 'min': 150, 'max': 159.9},
+    {'label': '160-169cm', 'min': 160, 'max': 169.9},
+    {'label': '170-179cm', 'min': 170, 'max': 179.9},
+    {'label': '180-189cm', 'min': 180, 'max': 189.9},
+    {'label': '190cm+', 'min': 190, 'max': 250}
+]
+
+# Weight ranges (kg)
+WEIGHT_RANGES = [
+    {'label': 'Under 50kg', 'min': 0, 'max': 49.9},
+    {'label': '50-59kg', 'min': 50, 'max': 59.9},
+    {'label': '60-69kg', 'min': 60, 'max': 69.9},
+    {'label': '70-79kg', 'min': 70, 'max': 79.9},
+    {'label': '80-89kg', 'min': 80, 'max': 89.9},
+    {'label': '90kg+', 'min': 90, 'max': 200}
+]
+
+# Blood pressure ranges
+BP_SYSTOLIC_RANGES = [
+    {'label': 'Normal (<120)', 'min': 0, 'max': 119},
+    {'label': 'Elevated (120-129)', 'min': 120, 'max': 129},
+    {'label': 'Stage 1 (130-139)', 'min': 130, 'max': 139},
+    {'label': 'Stage 2 (140-179)', 'min': 140, 'max': 179},
+    {'label': 'Crisis (180+)', 'min': 180, 'max': 300}
+]
+
+BP_DIASTOLIC_RANGES = [
+    {'label': 'Normal (<80)', 'min': 0, 'max': 79},
+    {'label': 'Stage 1 (80-89)', 'min': 80, 'max': 89},
+    {'label': 'Stage 2 (90-119)', 'min': 90, 'max': 119},
+    {'label': 'Crisis (120+)', 'min': 120, 'max': 200}
+]
+
+# Tumor volume ranges (mm³)
+TUMOR_VOLUME_RANGES = [
+    {'label': 'Very Small (<20mm³)', 'min': 0, 'max': 19.9},
+    {'label': 'Small (20-50mm³)', 'min': 20, 'max': 49.9},
+    {'label': 'Medium (50-100mm³)', 'min': 50, 'max': 99.9},
+    {'label': 'Large (100-200mm³)', 'min': 100, 'max': 199.9},
+    {'label': 'Very Large (200mm³+)', 'min': 200, 'max': 1000}
+]
+
+# Dose ranges
+DOSE_RANGES = [
+    {'label': 'Low dose (<30)', 'min': 0, 'max': 29},
+    {'label': 'Medium dose (30-50)', 'min': 30, 'max': 50},
+    {'label': 'High dose (51-70)', 'min': 51, 'max': 70}
+]
+
+def bucket_index(value, ranges):
+    """Return the index of the range containing value (inclusive bounds), or -1 if none does."""
+    for i, value_range in enumerate(ranges):
+        if value_range['min'] <= value <= value_range['max']:
+            return i
+    return -1
+
+def match_range_index(selected, ranges):
+    """Return the index of the predefined range with the same bounds as selected, or -1."""
+    if not isinstance(selected, dict):
+        return -1
+    for i, value_range in enumerate(ranges):
+        if selected.get('min') == value_range['min'] and selected.get('max') == value_range['max']:
+            return i
+    return -1
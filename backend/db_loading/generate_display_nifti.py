@@ -3,13 +3,23 @@ import uuid
 import numpy as np
 import nibabel as nib
 from scipy.ndimage import gaussian_filter
-from datetime import date, timedelta
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from app import app, db
-from models import Patients, TumorMask, NiftiData, DoseMask, MRIMask
+from models import TumorMask
+from db_loading.criteria_compiler import mask_ids_query, patient_ids_query, cohort_counts_query
+from db_loading.parallel_reduction import (
+    accumulate_mask_files, accumulate_cropped_masks, accumulator_dtype, parallel_accumulate, stream_accumulate
+)
+from db_loading.facet_cube import sum_from_cube
+from single_flight import single_flight
+from db_loading.voxel_statistics import get_percentile_range, accumulate_with_statistics, merge_statistics
+from db_loading.aggregate_cache import (
+    BLOB_SUBDIR, aggregate_cache_key, aggregate_lock_name, get_blob_path, get_filter_key, link_filter,
+    release_key, get_statistic_blob_path, link_statistic
+)
 
 # Directory paths for Docker volumes - relative to the /app working directory
 # These will be overridden by environment variables when running in the app context
@@ -18,378 +28,135 @@ TUMOR_CACHE_DIR = '/app/filestore/tumor_mask_cache'
 MRI_CACHE_DIR = '/app/filestore/mri_mask_cache'
 DOSE_CACHE_DIR = '/app/filestore/dose_mask_cache'
 OUT_DIR = '/app/filestore/nifti_display_cache'
+CUBE_DIR = '/app/filestore/facet_cube'
+VOXEL_STORE_DIR = '/app/filestore/voxel_store'
 
-def get_filtered_tumor_ids(criteria):
+# Rows fetched per round trip from the server-side cursor of a cohort query
+ID_BATCH_SIZE = 1000
+
+TUMOR_BBOX_COLUMNS = (
+    TumorMask.z_min, TumorMask.z_max,
+    TumorMask.y_min, TumorMask.y_max,
+    TumorMask.x_min, TumorMask.x_max
+)
+
+def iter_mask_id_batches(mask_type, criteria, batch_size=ID_BATCH_SIZE, with_bboxes=False):
     """
-    Query the database and return tumor IDs that match the filter criteria.
+    Stream the IDs of masks of mask_type matching the filter criteria from a
+    server-side cursor, batch_size rows per round trip, without materializing the cohort.
+    
+    Must be consumed inside an app context; the cursor stays open until the generator
+    is exhausted or closed.
     
     Args:
+        mask_type (str): Type of mask ('tumor', 'mri', or 'dose')
         criteria (dict): Structured filter criteria based on database models
+        batch_size (int): Rows per batch
+        with_bboxes (bool): Also stream each tumor mask's stored bounding box
     
-    Returns:
-        List of tumor mask IDs that match the filter criteria
+    Yields:
+        list: Mask IDs, or (mask ID, bbox) tuples with with_bboxes where bbox is an
+              inclusive (z_min, z_max, y_min, y_max, x_min, x_max) box or None
     """
+    query = mask_ids_query(mask_type, criteria)
+    if with_bboxes:
+        query = query.add_columns(*TUMOR_BBOX_COLUMNS)
+    result = db.session.execute(query.statement, execution_options={'yield_per': batch_size})
     try:
-        # Join patients and tumor masks
-        query = db.session.query(TumorMask.id).join(
-            NiftiData, TumorMask.id == NiftiData.id
-        ).join(
-            Patients, NiftiData.patient_id == Patients.id
-        ).filter(
-            NiftiData.series_type == 'tumor_mask'
-        )
-        
-        # Apply patient demographic filters
-        if criteria.get('patient_demographics'):
-            demographics = criteria['patient_demographics']
-            
-            # Origin cancer filter
-            if demographics.get('origin_cancer'):
-                origin_cancers = [item if isinstance(item, str) else item.get('label', str(item)) 
-                                for item in demographics['origin_cancer']]
-                query = query.filter(Patients.origin_cancer.in_(origin_cancers))
-            
-            # Sex filter
-            if demographics.get('sex'):
-                sexes = [item if isinstance(item, str) else item.get('label', str(item)) 
-                        for item in demographics['sex']]
-                query = query.filter(Patients.sex.in_(sexes))
-            
-            # Age range filter
-            if demographics.get('age_range'):
-                age_filters = []
-                current_date = date.today()
-                for age_range in demographics['age_range']:
-                    if isinstance(age_range, dict):
-                        min_age = age_range.get('min', 0)
-                        max_age = age_range.get('max', 150)
-                        # Calculate birth year range
-                        max_birth_year = current_date.year - min_age
-                        min_birth_year = current_date.year - max_age
-                        age_filters.append(
-                            db.extract('year', Patients.dob).between(min_birth_year, max_birth_year)
-                        )
-                if age_filters:
-                    query = query.filter(db.or_(*age_filters))
-            
-            # Height range filter
-            if demographics.get('height_range'):
-                height_filters = []
-                for height_range in demographics['height_range']:
-                    if isinstance(height_range, dict):
-                        min_height = height_range.get('min', 0)
-                        max_height = height_range.get('max', 250)
-                        height_filters.append(
-                            Patients.height_cm.between(min_height, max_height)
-                        )
-                if height_filters:
-                    query = query.filter(db.or_(*height_filters))
-            
-            # Weight range filter
-            if demographics.get('weight_range'):
-                weight_filters = []
-                for weight_range in demographics['weight_range']:
-                    if isinstance(weight_range, dict):
-                        min_weight = weight_range.get('min', 0)
-                        max_weight = weight_range.get('max', 200)
-                        weight_filters.append(
-                            Patients.weight_kg.between(min_weight, max_weight)
-                        )
-                if weight_filters:
-                    query = query.filter(db.or_(*weight_filters))
-            
-            # Tumor count range filter
-            if demographics.get('tumor_count_range'):
-                count_filters = []
-                for count_range in demographics['tumor_count_range']:
-                    if isinstance(count_range, dict):
-                        min_count = count_range.get('min', 1)
-                        max_count = count_range.get('max', 100)
-                        count_filters.append(
-                            Patients.tumor_count.between(min_count, max_count)
-                        )
-                if count_filters:
-                    query = query.filter(db.or_(*count_filters))
-        
-        # Apply clinical data filters
-        if criteria.get('clinical_data'):
-            clinical = criteria['clinical_data']
-            
-            # Systolic BP filter
-            if clinical.get('systolic_bp_range'):
-                bp_filters = []
-                for bp_range in clinical['systolic_bp_range']:
-                    if isinstance(bp_range, dict):
-                        min_bp = bp_range.get('min', 0)
-                        max_bp = bp_range.get('max', 300)
-                        bp_filters.append(
-                            Patients.systolic_bp.between(min_bp, max_bp)
-                        )
-                if bp_filters:
-                    query = query.filter(db.or_(*bp_filters))
-            
-            # Diastolic BP filter
-            if clinical.get('diastolic_bp_range'):
-                bp_filters = []
-                for bp_range in clinical['diastolic_bp_range']:
-                    if isinstance(bp_range, dict):
-                        min_bp = bp_range.get('min', 0)
-                        max_bp = bp_range.get('max', 200)
-                        bp_filters.append(
-                            Patients.diastolic_bp.between(min_bp, max_bp)
-                        )
-                if bp_filters:
-                    query = query.filter(db.or_(*bp_filters))
-        
-        # Apply tumor characteristic filters
-        if criteria.get('tumor_characteristics'):
-            tumor_chars = criteria['tumor_characteristics']
-            
-            # Tumor location filter
-            if tumor_chars.get('tumor_location'):
-                locations = [item if isinstance(item, str) else item.get('label', str(item)) 
-                           for item in tumor_chars['tumor_location']]
-                query = query.filter(TumorMask.location.in_(locations))
-            
-            # Tumor volume filter
-            if tumor_chars.get('tumor_volume_range'):
-                volume_filters = []
-                for volume_range in tumor_chars['tumor_volume_range']:
-                    if isinstance(volume_range, dict):
-                        min_volume = volume_range.get('min', 0)
-                        max_volume = volume_range.get('max', 1000)
-                        volume_filters.append(
-                            TumorMask.volume_mm3.between(min_volume, max_volume)
-                        )
-                if volume_filters:
-                    query = query.filter(db.or_(*volume_filters))
-        
-        # Apply treatment data filters
-        if criteria.get('treatment_data'):
-            treatment = criteria['treatment_data']
-            
-            # Dose range filter - need to join with DoseMask
-            if treatment.get('dose_range'):
-                # Join with dose mask data through patient relationship
-                dose_query = db.session.query(Patients.id).join(
-                    NiftiData, NiftiData.patient_id == Patients.id
-                ).join(
-                    DoseMask, DoseMask.id == NiftiData.id
-                ).filter(
-                    NiftiData.series_type == 'dose_mask'
-                )
-                
-                dose_filters = []
-                for dose_range in treatment['dose_range']:
-                    if isinstance(dose_range, dict):
-                        min_dose = dose_range.get('min', 0)
-                        max_dose = dose_range.get('max', 70)
-                        dose_filters.append(
-                            DoseMask.max_dose.between(min_dose, max_dose)
-                        )
-                if dose_filters:
-                    dose_query = dose_query.filter(db.or_(*dose_filters))
-                
-                # Get patient IDs that match dose criteria
-                dose_patient_ids = [result.id for result in dose_query.all()]
-                if dose_patient_ids:
-                    query = query.filter(Patients.id.in_(dose_patient_ids))
-                else:
-                    # No patients match dose criteria, return empty result
-                    return []
-        
-        # Execute query and return IDs
-        results = query.all()
-        return [str(result.id) for result in results]
-        
-    except Exception as e:
-        print(f"Error in filtering: {e}")
-        return []
+        for rows in result.partitions():
+            if with_bboxes:
+                yield [(str(row[0]), None if row[1] is None else tuple(row[1:])) for row in rows]
+            else:
+                yield [str(row[0]) for row in rows]
+    finally:
+        result.close()
 
-def get_filtered_mri_ids(criteria):
+def get_filtered_mask_ids(mask_type, criteria):
     """
-    Query the database and return MRI IDs that match the filter criteria.
+    Query the database and return the IDs of masks of mask_type that match the filter criteria.
+    
+    All mask types share one criteria compiler, so demographic, clinical and cross-mask
+    filters mean the same thing for every cohort and each cohort is a single query.
     
     Args:
+        mask_type (str): Type of mask ('tumor', 'mri', or 'dose')
         criteria (dict): Structured filter criteria based on database models
     
     Returns:
-        List of MRI mask IDs that match the filter criteria
+        List of mask IDs that match the filter criteria
     """
     try:
-        # Join patients and MRI masks
-        query = db.session.query(MRIMask.id).join(
-            NiftiData, MRIMask.id == NiftiData.id
-        ).join(
-            Patients, NiftiData.patient_id == Patients.id
-        ).filter(
-            NiftiData.series_type == 'mri_mask'
-        )
-        
-        # Apply patient demographic filters
-        if criteria.get('patient_demographics'):
-            demographics = criteria['patient_demographics']
-            
-            # Origin cancer filter
-            if demographics.get('origin_cancer'):
-                cancers = [item if isinstance(item, str) else item['label'] for item in demographics['origin_cancer']]
-                query = query.filter(Patients.origin_cancer.in_(cancers))
-            
-            # Sex filter
-            if demographics.get('sex'):
-                sexes = [item if isinstance(item, str) else item['label'] for item in demographics['sex']]
-                query = query.filter(Patients.sex.in_(sexes))
-            
-            # Age range filter
-            if demographics.get('age_range'):
-                age_filters = []
-                for age_range in demographics['age_range']:
-                    if isinstance(age_range, dict):
-                        min_age = age_range.get('min', 0)
-                        max_age = age_range.get('max', 150)
-                        current_date = date.today()
-                        min_birth_date = current_date - timedelta(days=(max_age + 1) * 365.25)
-                        max_birth_date = current_date - timedelta(days=min_age * 365.25)
-                        age_filters.append(
-                            Patients.dob.between(min_birth_date, max_birth_date)
-                        )
-                if age_filters:
-                    query = query.filter(db.or_(*age_filters))
-            
-            # Height range filter
-            if demographics.get('height_range'):
-                height_filters = []
-                for height_range in demographics['height_range']:
-                    if isinstance(height_range, dict):
-                        min_height = height_range.get('min', 0)
-                        max_height = height_range.get('max', 250)
-                        height_filters.append(
-                            Patients.height_cm.between(min_height, max_height)
-                        )
-                if height_filters:
-                    query = query.filter(db.or_(*height_filters))
-            
-            # Weight range filter
-            if demographics.get('weight_range'):
-                weight_filters = []
-                for weight_range in demographics['weight_range']:
-                    if isinstance(weight_range, dict):
-                        min_weight = weight_range.get('min', 0)
-                        max_weight = weight_range.get('max', 200)
-                        weight_filters.append(
-                            Patients.weight_kg.between(min_weight, max_weight)
-                        )
-                if weight_filters:
-                    query = query.filter(db.or_(*weight_filters))
-            
-            # Tumor count range filter
-            if demographics.get('tumor_count_range'):
-                count_filters = []
-                for count_range in demographics['tumor_count_range']:
-                    if isinstance(count_range, dict):
-                        min_count = count_range.get('min', 1)
-                        max_count = count_range.get('max', 5)
-                        count_filters.append(
-                            Patients.tumor_count.between(min_count, max_count)
-                        )
-                if count_filters:
-                    query = query.filter(db.or_(*count_filters))
-        
-        # Apply clinical data filters
-        if criteria.get('clinical_data'):
-            clinical = criteria['clinical_data']
-            
-            # Systolic BP filter
-            if clinical.get('systolic_bp_range'):
-                bp_filters = []
-                for bp_range in clinical['systolic_bp_range']:
-                    if isinstance(bp_range, dict):
-                        min_bp = bp_range.get('min', 0)
-                        max_bp = bp_range.get('max', 300)
-                        bp_filters.append(
-                            Patients.systolic_bp.between(min_bp, max_bp)
-                        )
-                if bp_filters:
-                    query = query.filter(db.or_(*bp_filters))
-            
-            # Diastolic BP filter
-            if clinical.get('diastolic_bp_range'):
-                bp_filters = []
-                for bp_range in clinical['diastolic_bp_range']:
-                    if isinstance(bp_range, dict):
-                        min_bp = bp_range.get('min', 0)
-                        max_bp = bp_range.get('max', 200)
-                        bp_filters.append(
-                            Patients.diastolic_bp.between(min_bp, max_bp)
-                        )
-                if bp_filters:
-                    query = query.filter(db.or_(*bp_filters))
-        
-        # Execute query and return IDs
-        results = query.all()
-        return [str(result.id) for result in results]
-        
+        return [mask_id for batch in iter_mask_id_batches(mask_type, criteria) for mask_id in batch]
     except Exception as e:
-        print(f"Error in filtering MRI masks: {e}")
+        print(f"Error in filtering {mask_type} masks: {e}")
         return []
 
-def get_filtered_dose_ids(criteria):
+def count_filtered_masks(mask_type, criteria):
     """
-    Query the database and return dose IDs that match the filter criteria.
-    
-    Args:
-        criteria (dict): Structured filter criteria based on database models
+    Count the masks of mask_type matching the filter criteria with one aggregate query,
+    so streamed aggregation can report its total up front.
     
     Returns:
-        List of dose mask IDs that match the filter criteria
+        int: Number of matching masks, or None if they could not be counted
     """
     try:
-        # Join patients and dose masks
-        query = db.session.query(DoseMask.id).join(
-            NiftiData, DoseMask.id == NiftiData.id
-        ).join(
-            Patients, NiftiData.patient_id == Patients.id
-        ).filter(
-            NiftiData.series_type == 'dose_mask'
-        )
-        
-        # Apply patient demographic filters (same as above but abbreviated for dose masks)
-        if criteria.get('patient_demographics'):
-            demographics = criteria['patient_demographics']
-            
-            if demographics.get('origin_cancer'):
-                cancers = [item if isinstance(item, str) else item['label'] for item in demographics['origin_cancer']]
-                query = query.filter(Patients.origin_cancer.in_(cancers))
-            
-            if demographics.get('sex'):
-                sexes = [item if isinstance(item, str) else item['label'] for item in demographics['sex']]
-                query = query.filter(Patients.sex.in_(sexes))
-        
-        # Apply treatment data filters specific to dose masks
-        if criteria.get('treatment_data'):
-            treatment = criteria['treatment_data']
-            
-            # Dose range filter
-            if treatment.get('dose_range'):
-                dose_filters = []
-                for dose_range in treatment['dose_range']:
-                    if isinstance(dose_range, dict):
-                        min_dose = dose_range.get('min', 0)
-                        max_dose = dose_range.get('max', 70)
-                        dose_filters.append(
-                            DoseMask.max_dose.between(min_dose, max_dose)
-                        )
-                if dose_filters:
-                    query = query.filter(db.or_(*dose_filters))
-        
-        # Execute query and return IDs
-        results = query.all()
-        return [str(result.id) for result in results]
-        
+        return getattr(cohort_counts_query(criteria).one(), f'{mask_type}_count')
+    except Exception as e:
+        print(f"Error counting {mask_type} masks: {e}")
+        return None
+
+def get_filtered_tumor_ids(criteria):
+    """Query the database and return tumor IDs that match the filter criteria."""
+    return get_filtered_mask_ids('tumor', criteria)
+
+def get_filtered_mri_ids(criteria):
+    """Query the database and return MRI IDs that match the filter criteria."""
+    return get_filtered_mask_ids('mri', criteria)
+
+def get_filtered_dose_ids(criteria):
+    """Query the database and return dose IDs that match the filter criteria."""
+    return get_filtered_mask_ids('dose', criteria)
+
+def get_filtered_patient_ids(criteria):
+    """Query the database and return the IDs of patients matching the filter criteria."""
+    try:
+        return [str(result.id) for result in patient_ids_query(criteria).all()]
     except Exception as e:
-        print(f"Error in filtering dose masks: {e}")
+        print(f"Error in filtering patients: {e}")
         return []
 
+# Map mask types to their query functions and log descriptions
+MASK_QUERIES = {
+    'tumor': (get_filtered_tumor_ids, 'tumor'),
+    'mri': (get_filtered_mri_ids, 'MRI'),
+    'dose': (get_filtered_dose_ids, 'dose')
+}
+
+def get_tumor_bounding_boxes(id_list, chunk_size=5000):
+    """
+    Look up the stored bounding boxes of the given tumor masks.
+    
+    Args:
+        id_list (list): Tumor mask IDs
+        chunk_size (int): Maximum number of IDs per IN (...) query
+    
+    Returns:
+        dict: Mask ID -> inclusive (z_min, z_max, y_min, y_max, x_min, x_max) box
+              in array axis order (volumes are stored as (z, y, x))
+    """
+    bboxes = {}
+    for start in range(0, len(id_list), chunk_size):
+        chunk = id_list[start:start + chunk_size]
+        rows = db.session.query(
+            TumorMask.id,
+            TumorMask.z_min, TumorMask.z_max,
+            TumorMask.y_min, TumorMask.y_max,
+            TumorMask.x_min, TumorMask.x_max
+        ).filter(TumorMask.id.in_(chunk)).all()
+        for row in rows:
+            bboxes[str(row.id)] = (row.z_min, row.z_max, row.y_min, row.y_max, row.x_min, row.x_max)
+    return bboxes
+
 def get_filestore_paths():
     """
     Get filestore paths from app context or use defaults.
@@ -402,7 +169,9 @@ def get_filestore_paths():
             'tumor_cache_dir': os.path.join(filestore_path, 'tumor_mask_cache'),
             'mri_cache_dir': os.path.join(filestore_path, 'mri_mask_cache'),
             'dose_cache_dir': os.path.join(filestore_path, 'dose_mask_cache'),
-            'out_dir': os.path.join(filestore_path, 'nifti_display_cache')
+            'out_dir': os.path.join(filestore_path, 'nifti_display_cache'),
+            'cube_dir': os.path.join(filestore_path, 'facet_cube'),
+            'voxel_store_dir': os.path.join(filestore_path, 'voxel_store')
         }
     except RuntimeError:
         # Not in app context, use default paths
@@ -411,117 +180,443 @@ def get_filestore_paths():
             'tumor_cache_dir': TUMOR_CACHE_DIR,
             'mri_cache_dir': MRI_CACHE_DIR,
             'dose_cache_dir': DOSE_CACHE_DIR,
-            'out_dir': OUT_DIR
+            'out_dir': OUT_DIR,
+            'cube_dir': CUBE_DIR,
+            'voxel_store_dir': VOXEL_STORE_DIR
+        }
+
+def sum_mask_ids(id_list, mask_type='tumor', num_workers=None, progress=None):
+    """
+    Sum the raw NIfTI volumes of the given masks.
+    
+    Args:
+        id_list (list): Mask IDs to sum
+        mask_type (str): Type of mask to sum ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to sum the masks;
+            defaults to the AGGREGATION_WORKERS app setting (1 = serial)
+        progress (callable, optional): Called as progress(processed, total)
+    
+    Returns:
+        tuple: (combined_volume, affine), affine is None when no file could be loaded;
+               the volume has the dtype chosen by accumulator_dtype
+    """
+    paths = get_filestore_paths()
+    _, description = MASK_QUERIES.get(mask_type, MASK_QUERIES['tumor'])
+    
+    # Tumor masks only cover a few dozen voxels, so only their bounding boxes are summed
+    bboxes = None
+    if mask_type == 'tumor':
+        try:
+            with app.app_context():
+                bboxes = get_tumor_bounding_boxes(id_list)
+        except Exception as e:
+            print(f"Error loading tumor bounding boxes, summing full volumes instead: {e}")
+    
+    if num_workers is None:
+        num_workers = app.config.get('AGGREGATION_WORKERS', 1)
+
+    print(f"Processing {len(id_list)} {description} files...")
+
+    # Integer counts for tumors, float32 for MRI and dose, instead of float64 everywhere
+    dtype = accumulator_dtype(mask_type, len(id_list))
+    
+    # Load and accumulate all the mask NIfTI volumes, in parallel shards for large cohorts
+    nifti_paths = [os.path.join(paths['input_dir'], f"{mask_id}.nii.gz") for mask_id in id_list]
+    if bboxes is not None:
+        items = [(path, bboxes.get(mask_id)) for path, mask_id in zip(nifti_paths, id_list)]
+        accumulate = accumulate_cropped_masks
+    else:
+        items = nifti_paths
+        accumulate = accumulate_mask_files
+    
+    if num_workers > 1:
+        combined_volume, first_affine, _ = parallel_accumulate(
+            items, num_workers, description, accumulate=accumulate, progress=progress,
+            voxel_store_dir=paths['voxel_store_dir'], dtype=dtype
+        )
+    else:
+        combined_volume, first_affine, _ = accumulate(items, description, progress, voxel_store_dir=paths['voxel_store_dir'], dtype=dtype)
+    
+    return combined_volume, first_affine
+
+def stream_sum_mask_ids(criteria, mask_type='tumor', num_workers=None, progress=None, statistics=None):
+    """
+    Sum the raw NIfTI volumes of the masks matching the criteria while their IDs are
+    still streaming in, see iter_mask_id_batches and stream_accumulate.
+    
+    Args:
+        criteria (dict): Structured filter criteria based on database models
+        mask_type (str): Type of mask to sum ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to sum the masks;
+            defaults to the AGGREGATION_WORKERS app setting (1 = serial)
+        progress (callable, optional): Called as progress(processed, total)
+        statistics (list, optional): Voxel-wise statistics to compute from the same
+            reads, see voxel_statistics.parse_statistic
+    
+    Returns:
+        tuple: (combined_volume, affine, id_list, statistics_state), affine is None when
+               no file could be loaded; id_list holds the cohort's IDs for the aggregate
+               state; statistics_state is a voxel_statistics.VoxelStatistics, or None
+               without statistics
+    """
+    paths = get_filestore_paths()
+    _, description = MASK_QUERIES.get(mask_type, MASK_QUERIES['tumor'])
+    if num_workers is None:
+        num_workers = app.config.get('AGGREGATION_WORKERS', 1)
+    
+    # Tumor masks are summed over their bounding boxes, which stream in with the IDs
+    with_bboxes = mask_type == 'tumor'
+    id_list = []
+    
+    # The cursor only tells how many masks there are once it is exhausted, so count them
+    # first to report progress against a total (and an ETA) from the first batch on
+    expected_count = None
+    if progress:
+        with app.app_context():
+            expected_count = count_filtered_masks(mask_type, criteria)
+    
+    def item_batches():
+        with app.app_context():
+            for batch in iter_mask_id_batches(mask_type, criteria, with_bboxes=with_bboxes):
+                if with_bboxes:
+                    id_list.extend(mask_id for mask_id, _ in batch)
+                    yield [(os.path.join(paths['input_dir'], f"{mask_id}.nii.gz"), bbox) for mask_id, bbox in batch]
+                else:
+                    id_list.extend(batch)
+                    yield [os.path.join(paths['input_dir'], f"{mask_id}.nii.gz") for mask_id in batch]
+    
+    if statistics:
+        # Every mask read for the sum also updates the statistics, so the cohort is read once
+        reducer = {
+            'accumulate': accumulate_with_statistics,
+            'merge': merge_statistics,
+            'statistics': list(statistics),
+            'value_range': get_percentile_range(paths['voxel_store_dir'], mask_type, statistics)
         }
+    else:
+        reducer = {'accumulate': accumulate_cropped_masks if with_bboxes else accumulate_mask_files}
+    
+    combined_volume, first_affine, _, _, statistics_state = stream_accumulate(
+        item_batches(), mask_type, num_workers, description,
+        progress=progress, voxel_store_dir=paths['voxel_store_dir'], expected_count=expected_count, **reducer
+    )
+    return combined_volume, first_affine, id_list, statistics_state
+
+def save_nifti_atomic(volume, affine, out_path):
+    """Save a volume in its own dtype, renaming it into place so readers never see a partial file."""
+    output_img = nib.Nifti1Image(volume, affine)
+    output_img.set_data_dtype(volume.dtype)
+    tmp_path = f"{out_path[:-len('.nii.gz')]}.{os.getpid()}.tmp.nii.gz"
+    nib.save(output_img, tmp_path)
+    os.replace(tmp_path, out_path)
+
+def get_state_path(blob_path):
+    """Path of the running-sum sidecar kept next to a cached aggregate blob."""
+    return blob_path[:-len('.nii.gz')] + '.state.npz'
 
-def generate_display_nifti(filter_id, criteria, mask_type='tumor'):
+def load_aggregate_state(state_path):
+    """
+    Load the unclipped running sum and member IDs saved for a filter.
+    
+    Returns:
+        tuple: (combined_volume, affine, id_list), or None if no usable state exists
+    """
+    if not os.path.exists(state_path):
+        return None
+    try:
+        with np.load(state_path, allow_pickle=False) as state:
+            return state['sum'], state['affine'], [str(mask_id) for mask_id in state['ids']]
+    except Exception as e:
+        print(f"Error loading aggregate state {state_path}: {e}")
+        return None
+
+def save_aggregate_state(state_path, combined_volume, affine, id_list):
+    """Atomically save the unclipped running sum and member IDs for a filter."""
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, sum=combined_volume, affine=affine, ids=np.array(id_list, dtype=str))
+    os.replace(tmp_path, state_path)
+
+def apply_membership_changes(state, id_list, mask_type='tumor', num_workers=None, progress=None):
+    """
+    Update a saved running sum to a new member list by adding the masks that joined
+    and subtracting the masks that left.
+    
+    Args:
+        state (tuple): (combined_volume, affine, old_id_list) from load_aggregate_state
+        id_list (list): New member IDs
+        mask_type (str): Type of mask ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to sum the changed masks
+        progress (callable, optional): Called as progress(processed, total)
+    
+    Returns:
+        tuple: (combined_volume, affine), or (None, None) when recomputing from
+               scratch would be cheaper than applying the changes
+    """
+    combined_volume, affine, old_ids = state
+    old_set = set(old_ids)
+    new_set = set(id_list)
+    added = [mask_id for mask_id in id_list if mask_id not in old_set]
+    removed = [mask_id for mask_id in old_ids if mask_id not in new_set]
+    
+    if len(added) + len(removed) >= len(id_list):
+        return None, None
+    
+    print(f"Updating aggregate incrementally: +{len(added)} / -{len(removed)} masks")
+    # Widen the saved sum if the cohort grew past what its dtype can count
+    combined_volume = combined_volume.astype(
+        np.promote_types(combined_volume.dtype, accumulator_dtype(mask_type, len(id_list))), copy=False
+    )
+    total = len(added) + len(removed)
+    done = 0
+    for changed_ids, sign in ((added, 1), (removed, -1)):
+        if not changed_ids:
+            continue
+        offset = done
+        delta, _ = sum_mask_ids(
+            changed_ids, mask_type, num_workers,
+            progress and (lambda processed, _total: progress(offset + processed, total))
+        )
+        done += len(changed_ids)
+        if delta is None:
+            continue
+        if delta.shape != combined_volume.shape:
+            return None, None
+        if sign > 0:
+            np.add(combined_volume, delta, out=combined_volume, casting='unsafe')
+        else:
+            # Removed masks were part of the saved sum, so unsigned counts cannot underflow
+            np.subtract(combined_volume, delta, out=combined_volume, casting='unsafe')
+    
+    return combined_volume, affine
+
+def build_aggregate_blob(blob_path, owner, filter_id, criteria, mask_type='tumor', num_workers=None, progress=None,
+                         statistics=None):
+    """
+    Compute the aggregate of the masks matching the criteria and save it at blob_path.
+    
+    Args:
+        blob_path (str): Content-addressed output path of the aggregate
+        owner (str): User the filter belongs to
+        filter_id (str): Filter requesting the aggregate; its previous aggregate is
+            reused when only a few members changed
+        criteria (dict): Structured filter criteria based on database models
+        mask_type (str): Type of mask to aggregate ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to sum the masks
+        progress (callable, optional): Called as progress(processed, total) while masks are summed
+        statistics (list, optional): Statistic maps to compute in the same pass and save
+            next to the blob when the cohort's masks are all read anyway; only then, as
+            the cube and incremental updates do not read every mask
+    
+    Returns:
+        int: Number of masks in the aggregate, 0 if nothing was written
+    """
+    paths = get_filestore_paths()
+    query_func, description = MASK_QUERIES.get(mask_type, MASK_QUERIES['tumor'])
+    cache_dir = os.path.dirname(os.path.dirname(blob_path))
+    
+    # Criteria made only of predefined facet buckets are answered from the precomputed cube
+    cube_result = sum_from_cube(paths['cube_dir'], mask_type, criteria)
+    if cube_result is not None:
+        combined_volume, first_affine, mask_count = cube_result
+        if mask_count == 0:
+            print(f"No matching {description} records found for the filter criteria")
+            return 0
+    else:
+        state = None
+        previous_key = get_filter_key(mask_type, owner, filter_id)
+        if previous_key:
+            state = load_aggregate_state(get_state_path(get_blob_path(cache_dir, previous_key)))
+        
+        first_affine = None
+        statistics_state = None
+        if state is not None:
+            # Reusing the filter's previous running sum needs the whole member list to diff against
+            with app.app_context():
+                id_list = query_func(criteria)
+            if id_list:
+                combined_volume, first_affine = apply_membership_changes(state, id_list, mask_type, num_workers, progress)
+                if first_affine is None:
+                    combined_volume, first_affine = sum_mask_ids(id_list, mask_type, num_workers, progress)
+        else:
+            # Start loading volumes as soon as the first IDs arrive from the cursor
+            combined_volume, first_affine, id_list, statistics_state = stream_sum_mask_ids(
+                criteria, mask_type, num_workers, progress, statistics
+            )
+        
+        if not id_list:
+            print(f"No matching {description} records found for the filter criteria")
+            return 0
+        mask_count = len(id_list)
+        if first_affine is not None:
+            save_aggregate_state(get_state_path(blob_path), combined_volume, first_affine, id_list)
+        if statistics_state is not None and first_affine is not None:
+            key = os.path.basename(blob_path)[:-len('.nii.gz')]
+            for statistic, volume in statistics_state.results().items():
+                save_nifti_atomic(volume, first_affine, get_statistic_blob_path(cache_dir, key, statistic))
+    
+    if first_affine is None:
+        print(f"No valid {description} NIfTI files found to process")
+        return 0
+    
+    # Clip values to prevent overflow
+    combined_volume = np.clip(combined_volume, 0, mask_count)
+    
+    # Create and save the new NIfTI in the accumulator's compact dtype
+    save_nifti_atomic(combined_volume, first_affine, blob_path)
+    
+    return mask_count
+
+def build_statistic_blobs(cache_dir, key, criteria, statistics, mask_type='tumor', num_workers=None, progress=None):
+    """
+    Compute voxel-wise statistic maps of the masks matching the criteria in one
+    streaming pass and save each one next to the aggregate blob for key.
+    
+    Only needed when the aggregate already exists or came from the cube or an
+    incremental update; a fresh aggregate computes its statistics while it is summed.
+    
+    Args:
+        cache_dir (str): Aggregate cache directory of the mask type
+        key (str): Content key of the cohort's aggregate
+        criteria (dict): Structured filter criteria based on database models
+        statistics (list): Statistic names, see voxel_statistics.parse_statistic
+        mask_type (str): Type of mask ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to read the masks
+        progress (callable, optional): Called as progress(processed, total)
+    
+    Returns:
+        int: Number of masks the maps were computed over, 0 if nothing was written
+    """
+    _, description = MASK_QUERIES.get(mask_type, MASK_QUERIES['tumor'])
+    
+    _, first_affine, id_list, state = stream_sum_mask_ids(criteria, mask_type, num_workers, progress, statistics)
+    if not id_list:
+        print(f"No matching {description} records found for the filter criteria")
+        return 0
+    if first_affine is None:
+        print(f"No valid {description} NIfTI files found to process")
+        return 0
+    
+    for statistic, volume in state.results().items():
+        save_nifti_atomic(volume, first_affine, get_statistic_blob_path(cache_dir, key, statistic))
+    return state.count
+
+def missing_statistics(cache_dir, key, statistics):
+    """The statistics of which no map has been saved yet for the cohort with the given key."""
+    return [s for s in statistics or [] if not os.path.exists(get_statistic_blob_path(cache_dir, key, s))]
+
+def generate_statistic_maps(cache_dir, filter_id, key, criteria, statistics, mask_type='tumor', num_workers=None,
+                            progress=None, owner='anonymous'):
+    """
+    Make sure the requested statistic maps exist for the cohort with the given key and
+    link them for the owner's filter. Missing maps are all computed in one pass.
+    
+    Returns:
+        dict: Statistic name -> path of the filter's statistic map
+    """
+    def missing():
+        return missing_statistics(cache_dir, key, statistics)
+    
+    if missing():
+        with single_flight(f"statistics:{mask_type}:{key}"):
+            to_build = missing()
+            if to_build:
+                build_statistic_blobs(cache_dir, key, criteria, to_build, mask_type, num_workers, progress)
+    
+    return {
+        statistic: link_statistic(cache_dir, owner, filter_id, key, statistic)
+        for statistic in statistics
+        if os.path.exists(get_statistic_blob_path(cache_dir, key, statistic))
+    }
+
+def generate_display_nifti(filter_id, criteria, mask_type='tumor', num_workers=None, progress=None, statistics=None,
+                           is_current=None, owner='anonymous'):
     """
     Generate a display NIfTI file by averaging all the mask NIfTI files
     that correspond to the IDs matching the filter criteria.
     
+    The aggregate is cached by a hash of the mask type, normalized criteria and
+    dataset version, and {cache_dir}/users/{owner}/{filter_id}.nii.gz links to it.
+    Requested statistic maps are linked next to it as {filter_id}.<statistic>.nii.gz.
+    
     Args:
-        filter_id (str): Unique ID for this filter combination, used to name the output file
+        filter_id (str): Unique ID for this filter combination, used to name the output link
         criteria (dict): Structured filter criteria based on database models
         mask_type (str): Type of mask to generate ('tumor', 'mri', or 'dose')
+        num_workers (int, optional): Worker processes used to sum the masks;
+            defaults to the AGGREGATION_WORKERS app setting (1 = serial)
+        progress (callable, optional): Called as progress(processed, total) while masks are summed
+        statistics (list, optional): Voxel-wise statistics to compute as well, e.g.
+            ['mean', 'std', 'p90'], see voxel_statistics.parse_statistic
+        is_current (callable, optional): Checked before the filter is linked to the
+            aggregate; when it returns False the request was superseded (e.g. the
+            filter was edited again) and the filter's links are left to the newer one
+        owner (str): User the filter belongs to, as filter ids are only unique per user
     
     Returns:
-        str: Path to the generated NIfTI file
+        str: Path to the generated NIfTI file, or None if nothing was linked
     """
     # Get paths from app context or use defaults
     paths = get_filestore_paths()
     
-    # Map mask types to cache directories and query functions
+    # Map mask types to cache directories
     mask_config = {
         'tumor': {
             'cache_dir': paths['tumor_cache_dir'],
-            'query_func': get_filtered_tumor_ids,
             'description': 'tumor'
         },
         'mri': {
             'cache_dir': paths['mri_cache_dir'],
-            'query_func': get_filtered_mri_ids,
             'description': 'MRI'
         },
         'dose': {
             'cache_dir': paths['dose_cache_dir'],
-            'query_func': get_filtered_dose_ids,
             'description': 'dose'
         }
     }
     
     config = mask_config.get(mask_type, mask_config['tumor'])
     cache_dir = config['cache_dir']
-    query_func = config['query_func']
     description = config['description']
     
-    # Make sure output directory exists
-    os.makedirs(cache_dir, exist_ok=True)
+    # Make sure output directories exist
+    os.makedirs(os.path.join(cache_dir, BLOB_SUBDIR), exist_ok=True)
     
-    # Generate output file path
-    out_path = os.path.join(cache_dir, f"{filter_id}.nii.gz")
+    # Aggregates are stored once per canonical criteria hash and shared by every filter that asks for them
+    key = aggregate_cache_key(mask_type, criteria)
+    blob_path = get_blob_path(cache_dir, key)
     
-    # Check if this filter has already been processed
-    if os.path.exists(out_path):
-        print(f"Display NIfTI already exists for filter {filter_id} ({mask_type})")
-        return out_path
-    
-    # Use the appropriate filter function to get list of mask IDs that match the criteria
-    with app.app_context():
-        id_list = query_func(criteria)
-        
-    if not id_list:
-        print(f"No matching {description} records found for the filter criteria")
-        return None
+    def superseded():
+        if is_current is not None and not is_current():
+            print(f"Filter {filter_id} changed while its {description} aggregate was built, not linking it")
+            return True
+        return False
     
-    print(f"Processing {len(id_list)} {description} files...")
-    
-    # Keep track of successful loads
-    first_affine = None
-    
-    # Load and accumulate all the mask NIfTI volumes
-    for i, mask_id in enumerate(id_list):
-        nifti_path = os.path.join(paths['input_dir'], f"{mask_id}.nii.gz")
+    # Only one worker builds a given aggregate; concurrent requests wait for it and share the result.
+    # Linking under the same lock keeps the blob from being removed between finding and linking it.
+    with single_flight(aggregate_lock_name(mask_type, key)):
+        mask_count = None
+        if os.path.exists(blob_path):
+            print(f"Display NIfTI already exists for filter {filter_id} ({mask_type}) as {key}")
+        else:
+            mask_count = build_aggregate_blob(
+                blob_path, owner, filter_id, criteria, mask_type, num_workers, progress,
+                statistics=missing_statistics(cache_dir, key, statistics)
+            )
+            if not mask_count:
+                return None
         
-        if not os.path.exists(nifti_path):
-            print(f"Warning: {description.title()} NIfTI file not found for ID {mask_id}")
-            continue
-            
-        try:
-            img = nib.load(nifti_path)
-            vol = img.get_fdata()
-            
-            # Store the first affine to use for output
-            if first_affine is None:
-                first_affine = img.affine
-                # Initialize combined volume with first volume shape
-                combined_volume = np.zeros_like(vol)
-                
-            # Ensure all volumes have the same shape before adding
-            if vol.shape == combined_volume.shape:
-                combined_volume += vol
-            
-            # Clear volume from memory immediately after use
-            del vol, img
-            
-            # Print progress for large datasets
-            if (i + 1) % 50 == 0:
-                print(f"Processed {i + 1}/{len(id_list)} {description} files...")
-                
-        except Exception as e:
-            print(f"Error loading {description} NIfTI for ID {mask_id}: {e}")
-    
-    if first_affine is None:
-        print(f"No valid {description} NIfTI files found to process")
-        return None
-    
-    # Clip values to prevent overflow
-    combined_volume = np.clip(combined_volume, 0, len(id_list))
+        if superseded():
+            return None
+        out_path, previous_key = link_filter(cache_dir, mask_type, owner, filter_id, key)
     
-    # Create and save the new NIfTI
-    output_img = nib.Nifti1Image(combined_volume, first_affine)
-    nib.save(output_img, out_path)
+    if mask_count:
+        print(f"Created collective {description} display NIfTI at {out_path} from {mask_count} {description} volumes")
+    if previous_key:
+        release_key(cache_dir, mask_type, previous_key, owner, filter_id)
     
-    print(f"Created collective {description} display NIfTI at {out_path} from {len(id_list)} {description} volumes")
+    if statistics:
+        generate_statistic_maps(cache_dir, filter_id, key, criteria, statistics, mask_type, num_workers, progress, owner)
     return out_path
 
 # Generate collective view of all tumors when run as main
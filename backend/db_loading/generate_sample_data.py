@@ -8,7 +8,7 @@ from models import Patients, NiftiData, TumorMask, DoseMask, MRIMask
 
 load_dotenv()
 
-from app import app, db
+from app import app, db, redis_cache
 
 origin_cancer_choices = [
     "Lung",
@@ -201,6 +201,14 @@ def generate_sample_data(n):
         patient_samples.append(patient)
     db.session.add_all(patient_samples)
     db.session.commit()
+    bump_dataset_version()
+
+def bump_dataset_version():
+    """Invalidate cached aggregates and statistics derived from the previous data."""
+    try:
+        print(f"Dataset version is now {redis_cache.bump_dataset_version()}")
+    except Exception as e:
+        print(f"Could not bump dataset version: {e}")
 
 if __name__ == "__main__":
     with app.app_context():
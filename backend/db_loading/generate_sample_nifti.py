@@ -4,6 +4,7 @@ import numpy as np
 import nibabel as nib
 from scipy.ndimage import gaussian_filter
 from models import Patients, NiftiData, TumorMask, MRIMask, DoseMask
+from db_loading.parallel_reduction import crop_sidecar_path, bbox_slices
 from datetime import date, timedelta
 import random
 import gc  # For garbage collection
@@ -12,8 +13,11 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from app import app, db
+from db_loading.generate_sample_data import bump_dataset_version
+from db_loading.generate_voxel_store import generate_voxel_stores
 
 OUT_DIR = "../filestore/test_db_nifti"
+STORE_DIR = "../filestore/voxel_store"
 SHAPE   = (31, 100, 100)  # (z, y, x) - 31 slices in z-direction
 CURRENT_DATE = date(2025, 6, 3)
 BATCH_SIZE = 100  # Process patients in batches to manage memory
@@ -165,6 +169,12 @@ def save_nifti_fast(volume, filename):
     nifti_img = nib.Nifti1Image(volume, affine)
     nib.save(nifti_img, filename)
 
+def save_tumor_crop(volume, tumor, filename):
+    """Save the tumor's bounding box as an uncompressed sidecar used for sparse aggregation."""
+    bounds = tumor["bounds"]
+    bbox = (bounds["z"][0], bounds["z"][1], bounds["y"][0], bounds["y"][1], bounds["x"][0], bounds["x"][1])
+    np.save(crop_sidecar_path(filename), volume[bbox_slices(bbox)])
+
 def create_mri_volume(tumors, timepoint_index=0, base_seed=None):
     """Create an MRI volume with realistic intensity values and tumor enhancement."""
     # Set seed for reproducible but varying results across timepoints
@@ -320,6 +330,7 @@ def process_patient_batch(patients_batch, batch_num):
             # Create filename and save
             tumor_filename = f"{OUT_DIR}/{tumor_id}.nii.gz"
             save_nifti_fast(tumor_volume_data, tumor_filename)
+            save_tumor_crop(tumor_volume_data, tumor, tumor_filename)
             
             # Create database objects
             nifti_data_objects.append(NiftiData(
@@ -438,5 +449,9 @@ with app.app_context():
         # Force garbage collection between batches
         gc.collect()
     
+    # Pack the new masks into the uncompressed voxel store read by aggregation
+    generate_voxel_stores(OUT_DIR, STORE_DIR)
+    
+    bump_dataset_version()
     print("All patients processed successfully!")
             
\ No newline at end of file
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import nibabel as nib
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app import app, db
+from models import TumorMask
+from db_loading.parallel_reduction import crop_sidecar_path, bbox_slices
+
+INPUT_DIR = '../filestore/test_db_nifti'
+
+def generate_tumor_crops(input_dir, overwrite=False):
+    """
+    Write a cropped ``_crop.npy`` sidecar next to every tumor mask NIfTI, using the
+    bounding box stored on its TumorMask row. Sparse tumor aggregation reads these
+    small uncompressed blocks instead of inflating the full volume.
+    
+    Args:
+        input_dir (str): Directory containing the <uuid>.nii.gz tumor masks
+        overwrite (bool): Rewrite sidecars that already exist
+    
+    Returns:
+        int: Number of sidecars written
+    """
+    tumors = db.session.query(
+        TumorMask.id,
+        TumorMask.z_min, TumorMask.z_max,
+        TumorMask.y_min, TumorMask.y_max,
+        TumorMask.x_min, TumorMask.x_max
+    ).all()
+    print(f"Found {len(tumors)} tumor masks")
+    
+    written = 0
+    for i, tumor in enumerate(tumors):
+        nifti_path = os.path.join(input_dir, f"{tumor.id}.nii.gz")
+        sidecar_path = crop_sidecar_path(nifti_path)
+        
+        if not os.path.exists(nifti_path):
+            print(f"Warning: Tumor NIfTI file not found for ID {tumor.id}")
+            continue
+        if os.path.exists(sidecar_path) and not overwrite:
+            continue
+        
+        try:
+            bbox = (tumor.z_min, tumor.z_max, tumor.y_min, tumor.y_max, tumor.x_min, tumor.x_max)
+            img = nib.load(nifti_path)
+            np.save(sidecar_path, np.asanyarray(img.dataobj[bbox_slices(bbox)]))
+            written += 1
+        except Exception as e:
+            print(f"Error writing crop for tumor {tumor.id}: {e}")
+        
+        if (i + 1) % 500 == 0:
+            print(f"Processed {i + 1}/{len(tumors)} tumor masks...")
+    
+    print(f"Wrote {written} tumor crop sidecars to {input_dir}")
+    return written
+
+if __name__ == "__main__":
+    with app.app_context():
+        generate_tumor_crops(INPUT_DIR)
@@ -0,0 +1,117 @@
+import os
+import json
+import uuid
+import numpy as np
+import nibabel as nib
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from app import app, db
+from models import NiftiData
+from db_loading.voxel_store import SERIES_TYPES, get_index_path
+
+INPUT_DIR = '../filestore/test_db_nifti'
+STORE_DIR = '../filestore/voxel_store'
+
+# Largest difference between two affines still treated as the same voxel grid (mm)
+AFFINE_TOLERANCE = 1e-4
+
+def generate_voxel_store(series_type, input_dir, store_dir):
+    """
+    Pack every mask of one series type into a single uncompressed data file that
+    readers memory-map, and swap in its id index atomically.
+
+    Args:
+        series_type (str): 'tumor_mask', 'mri_mask' or 'dose_mask'
+        input_dir (str): Directory containing the <uuid>.nii.gz masks
+        store_dir (str): Directory of the voxel store
+
+    Returns:
+        int: Number of masks packed
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    mask_ids = [
+        str(row.id) for row in db.session.query(NiftiData.id).filter(
+            NiftiData.series_type == series_type
+        ).order_by(NiftiData.id).all()
+    ]
+    print(f"Packing {len(mask_ids)} {series_type} volumes")
+
+    data_name = f"{series_type}-{uuid.uuid4().hex}.dat"
+    index = {
+        'series_type': series_type,
+        'data_file': data_name,
+        'dtype': None,
+        'shape': None,
+        'affine': None,
+        'value_range': None,
+        'ids': []
+    }
+
+    with open(os.path.join(store_dir, data_name), 'wb') as data_file:
+        for i, mask_id in enumerate(mask_ids):
+            nifti_path = os.path.join(input_dir, f"{mask_id}.nii.gz")
+            if not os.path.exists(nifti_path):
+                print(f"Warning: {series_type} NIfTI file not found for ID {mask_id}")
+                continue
+
+            try:
+                img = nib.load(nifti_path)
+                volume = np.asanyarray(img.dataobj)
+
+                # The first volume fixes the layout of the whole file
+                if index['shape'] is None:
+                    index['dtype'] = volume.dtype.str
+                    index['shape'] = list(volume.shape)
+                    index['affine'] = img.affine.tolist()
+
+                if list(volume.shape) != index['shape']:
+                    print(f"Warning: Skipping {series_type} {mask_id} with mismatched shape {volume.shape}")
+                    continue
+                # The store keeps one affine for all its masks; skipped masks are read from their NIfTI
+                if not np.allclose(img.affine, index['affine'], atol=AFFINE_TOLERANCE):
+                    print(f"Warning: Skipping {series_type} {mask_id} with mismatched affine")
+                    continue
+
+                data_file.write(np.ascontiguousarray(volume, dtype=index['dtype']).tobytes())
+                index['ids'].append(mask_id)
+                # Lets percentile histograms cover the values that actually occur
+                low, high = float(volume.min()), float(volume.max())
+                if index['value_range'] is not None:
+                    low, high = min(low, index['value_range'][0]), max(high, index['value_range'][1])
+                index['value_range'] = [low, high]
+            except Exception as e:
+                print(f"Error packing {series_type} NIfTI at {nifti_path}: {e}")
+
+            if (i + 1) % 500 == 0:
+                print(f"Packed {i + 1}/{len(mask_ids)} {series_type} volumes...")
+
+    # Swap in the new index atomically; readers holding the old data file keep their mapping
+    index_path = get_index_path(store_dir, series_type)
+    previous_data = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous_data = json.load(f).get('data_file')
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    if previous_data and previous_data != data_name:
+        try:
+            os.remove(os.path.join(store_dir, previous_data))
+        except OSError:
+            pass
+
+    size_mb = os.path.getsize(os.path.join(store_dir, data_name)) / (1024 * 1024)
+    print(f"Wrote {len(index['ids'])} {series_type} volumes to {store_dir} ({size_mb:.1f} MB)")
+    return len(index['ids'])
+
+def generate_voxel_stores(input_dir, store_dir):
+    """Rebuild the store of every series type."""
+    for series_type in SERIES_TYPES:
+        generate_voxel_store(series_type, input_dir, store_dir)
+
+if __name__ == "__main__":
+    with app.app_context():
+        generate_voxel_stores(INPUT_DIR, STORE_DIR)
@@ -0,0 +1,76 @@
+"""
+Isosurface meshes of cohort aggregates.
+
+Marching cubes runs on the aggregate at a level given as a fraction of its value
+range, the vertices are mapped to world space by the NIfTI affine, and each mesh is
+cached next to the aggregate blob (see aggregate_cache.get_isosurface_blob_path), so
+it is extracted once per aggregate and level and removed together with the blob.
+"""
+
+import os
+import numpy as np
+import nibabel as nib
+from nibabel.affines import apply_affine
+from skimage.measure import marching_cubes
+
+# Levels are rounded so equivalent requests share one cached mesh
+LEVEL_DECIMALS = 3
+
+def normalize_level(level):
+    """
+    Round a requested level, a fraction of the aggregate's value range.
+
+    Raises:
+        ValueError: If the level is not strictly between 0 and 1
+    """
+    level = round(float(level), LEVEL_DECIMALS)
+    if not 0 < level < 1:
+        raise ValueError(f"Isosurface level must be between 0 and 1: {level}")
+    return level
+
+def extract_isosurface(volume, affine, level, step_size=1):
+    """
+    Extract the isosurface of a volume at a fraction of its value range.
+
+    Args:
+        volume (ndarray): Aggregate volume in array order
+        affine (ndarray): Voxel-to-world affine of the volume
+        level (float): Fraction of the value range, see normalize_level
+        step_size (int): Voxel step of marching cubes; larger gives coarser meshes
+
+    Returns:
+        tuple: (vertices, faces) as float32 world coordinates and uint32 vertex
+               indices; both empty if the level is outside the volume's values
+    """
+    volume = np.asarray(volume, dtype=np.float32)
+    min_val, max_val = float(volume.min()), float(volume.max())
+    absolute = min_val + level * (max_val - min_val)
+    if not min_val < absolute < max_val:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.uint32)
+
+    vertices, faces, _, _ = marching_cubes(volume, level=absolute, step_size=step_size, allow_degenerate=False)
+    return apply_affine(affine, vertices).astype(np.float32), faces.astype(np.uint32)
+
+def get_isosurface(aggregate_path, mesh_path, level):
+    """
+    The isosurface of the aggregate at level, from mesh_path when it was extracted
+    before, else extracted now and saved there atomically.
+
+    Returns:
+        tuple: (vertices, faces), see extract_isosurface
+    """
+    if os.path.exists(mesh_path):
+        try:
+            with np.load(mesh_path, allow_pickle=False) as mesh:
+                return mesh['vertices'], mesh['faces']
+        except Exception as e:
+            print(f"Error loading cached isosurface {mesh_path}, extracting it again: {e}")
+
+    img = nib.load(aggregate_path)
+    vertices, faces = extract_isosurface(img.get_fdata(dtype=np.float32), img.affine, level)
+
+    tmp_path = f"{mesh_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, vertices=vertices, faces=faces)
+    os.replace(tmp_path, mesh_path)
+    return vertices, faces
@@ -1,9 +1,18 @@
+import numpy as np
 import nibabel as nib
 
-def load_nifti(compressed_nifti_path):
+from db_loading.voxel_store import open_voxel_stores, lookup_mask, mask_id_from_path
+
+def load_nifti(compressed_nifti_path, voxel_store_dir=None):
+    # Raw masks packed into the voxel store are read from its memory map without inflating the
+    # file, then cast so callers get float32 like from get_fdata whichever path is taken
+    stored = lookup_mask(open_voxel_stores(voxel_store_dir), mask_id_from_path(compressed_nifti_path))
+    if stored is not None:
+        volume_data, affine = stored
+        return volume_data.astype(np.float32), affine
+
     nifti_img = nib.load(compressed_nifti_path)
-    volume_data = nifti_img.get_fdata()
+    volume_data = nifti_img.get_fdata(dtype=np.float32)
     affine = nifti_img.affine
 
     return volume_data, affine
-
@@ -0,0 +1,398 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+import numpy as np
+import nibabel as nib
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from db_loading.voxel_store import open_voxel_stores, lookup_mask, mask_id_from_path
+
+# This module, and the voxel_store module it imports, are deliberately free of
+# Flask/database imports so that worker processes can be started cheaply (spawn
+# re-imports only numpy + nibabel).
+
+# Minimum number of masks handed to a single worker. Smaller cohorts are
+# summed serially because pool dispatch would cost more than it saves.
+DEFAULT_SHARD_SIZE = 64
+
+_pool = None
+_pool_workers = 0
+# Background jobs aggregate on several threads; only one of them may create the pool
+_pool_lock = threading.Lock()
+
+def accumulator_dtype(mask_type, mask_count):
+    """
+    Smallest dtype that holds the sum of mask_count masks: exact integer counts for
+    binary tumor masks, float32 for the continuous MRI and dose values.
+    """
+    if mask_type == 'tumor':
+        return np.dtype(np.uint16) if mask_count <= np.iinfo(np.uint16).max else np.dtype(np.uint32)
+    return np.dtype(np.float32)
+
+def _add_into(combined_volume, block, region=Ellipsis):
+    # unsafe casting lets masks saved as float still add into integer count volumes
+    np.add(combined_volume[region], block, out=combined_volume[region], casting='unsafe')
+
+def read_mask_volume(nifti_path, stores, description='mask'):
+    """
+    Read one raw mask in its stored dtype, from the voxel store when it holds the mask.
+
+    Args:
+        nifti_path (str): Path of the mask's <uuid>.nii.gz file
+        stores (list): Stores from open_voxel_stores (may be empty)
+        description (str): Human readable mask type used in log messages
+
+    Returns:
+        tuple: (volume, affine), or None if the mask file does not exist
+    """
+    stored = lookup_mask(stores, mask_id_from_path(nifti_path))
+    if stored is not None:
+        # Zero-copy view into the memory-mapped store
+        return stored
+    if not os.path.exists(nifti_path):
+        print(f"Warning: {description.title()} NIfTI file not found at {nifti_path}")
+        return None
+    # Read in the stored dtype rather than inflating to float64
+    img = nib.load(nifti_path)
+    return np.asanyarray(img.dataobj), img.affine
+
+def accumulate_mask_files(nifti_paths, description='mask', progress=None, voxel_store_dir=None, dtype=np.float64):
+    """
+    Sum a list of NIfTI volumes into a single volume.
+
+    Args:
+        nifti_paths (list): Paths of the NIfTI files to add together
+        description (str): Human readable mask type used in log messages
+        progress (callable, optional): Called as progress(processed, total)
+        voxel_store_dir (str, optional): Packed voxel store to read masks from
+            instead of inflating their NIfTI files
+        dtype: Accumulator dtype, see accumulator_dtype
+
+    Returns:
+        tuple: (combined_volume, affine, loaded_count), or (None, None, 0)
+               if none of the files could be loaded
+    """
+    combined_volume = None
+    first_affine = None
+    loaded_count = 0
+    stores = open_voxel_stores(voxel_store_dir)
+
+    for i, nifti_path in enumerate(nifti_paths):
+        try:
+            loaded = read_mask_volume(nifti_path, stores, description)
+            if loaded is None:
+                continue
+            vol, affine = loaded
+
+            # Store the first affine to use for output
+            if first_affine is None:
+                first_affine = affine
+                # Initialize combined volume with first volume shape
+                combined_volume = np.zeros(vol.shape, dtype=dtype)
+
+            # Ensure all volumes have the same shape before adding
+            if vol.shape == combined_volume.shape:
+                _add_into(combined_volume, vol)
+                loaded_count += 1
+
+            # Clear volume from memory immediately after use
+            del vol
+
+            # Print progress for large datasets
+            if (i + 1) % 50 == 0:
+                print(f"Processed {i + 1}/{len(nifti_paths)} {description} files...")
+                if progress:
+                    progress(i + 1, len(nifti_paths))
+
+        except Exception as e:
+            print(f"Error loading {description} NIfTI at {nifti_path}: {e}")
+
+    if progress:
+        progress(len(nifti_paths), len(nifti_paths))
+    return combined_volume, first_affine, loaded_count
+
+def crop_sidecar_path(nifti_path):
+    """Path of the cropped bounding-box sidecar written next to a mask NIfTI at ingest."""
+    return nifti_path[:-len('.nii.gz')] + '_crop.npy'
+
+def bbox_slices(bbox):
+    """Convert an inclusive (z_min, z_max, y_min, y_max, x_min, x_max) box into array slices."""
+    z_min, z_max, y_min, y_max, x_min, x_max = bbox
+    return (slice(z_min, z_max + 1), slice(y_min, y_max + 1), slice(x_min, x_max + 1))
+
+def read_mask_region(nifti_path, bbox, stores, description='mask'):
+    """
+    Read the voxels of one mask inside its bounding box, in its stored dtype.
+
+    The block is sliced from the packed voxel store when the mask is in it, else read
+    from the mask's ``_crop.npy`` sidecar when present, otherwise sliced out of the
+    NIfTI data proxy, so the cost is proportional to the box, not the full volume.
+
+    Args:
+        nifti_path (str): Path of the mask's <uuid>.nii.gz file
+        bbox (tuple): Inclusive (z_min, z_max, y_min, y_max, x_min, x_max) box in
+            array order, or None to read the whole volume
+        stores (list): Stores from open_voxel_stores (may be empty)
+        description (str): Human readable mask type used in log messages
+
+    Returns:
+        tuple: (block, region, shape, affine) where region are the slices of the block
+               in the full volume of the given shape, or None if the mask file does not exist
+    """
+    stored = lookup_mask(stores, mask_id_from_path(nifti_path))
+    if stored is None and not os.path.exists(nifti_path):
+        print(f"Warning: {description.title()} NIfTI file not found at {nifti_path}")
+        return None
+
+    if stored is not None:
+        source, affine = stored
+    else:
+        img = nib.load(nifti_path)
+        source, affine = img.dataobj, img.affine
+    shape = tuple(source.shape)
+
+    if bbox is None:
+        return np.asanyarray(source), (slice(None),) * len(shape), shape, affine
+
+    region = bbox_slices(bbox)
+    region_shape = tuple(len(range(*axis.indices(size))) for axis, size in zip(region, shape))
+    block = None
+    if stored is None:
+        sidecar_path = crop_sidecar_path(nifti_path)
+        block = np.load(sidecar_path) if os.path.exists(sidecar_path) else None
+    if block is None or block.shape != region_shape:
+        block = np.asanyarray(source[region])
+    return block, region, shape, affine
+
+def accumulate_cropped_masks(items, description='tumor', progress=None, voxel_store_dir=None, dtype=np.float64):
+    """
+    Sum sparse masks by adding only the voxels inside each mask's bounding box, read
+    with read_mask_region.
+
+    Args:
+        items (list): (nifti_path, bbox) tuples where bbox is an inclusive
+            (z_min, z_max, y_min, y_max, x_min, x_max) box in array order,
+            or None to add the whole volume
+        description (str): Human readable mask type used in log messages
+        progress (callable, optional): Called as progress(processed, total)
+        voxel_store_dir (str, optional): Packed voxel store to read masks from
+        dtype: Accumulator dtype, see accumulator_dtype
+
+    Returns:
+        tuple: (combined_volume, affine, loaded_count), same as accumulate_mask_files
+    """
+    combined_volume = None
+    first_affine = None
+    loaded_count = 0
+    stores = open_voxel_stores(voxel_store_dir)
+
+    for i, (nifti_path, bbox) in enumerate(items):
+        try:
+            loaded = read_mask_region(nifti_path, bbox, stores, description)
+            if loaded is None:
+                continue
+            block, region, shape, affine = loaded
+
+            if first_affine is None:
+                first_affine = affine
+                combined_volume = np.zeros(shape, dtype=dtype)
+
+            if shape != combined_volume.shape:
+                continue
+
+            _add_into(combined_volume, block, region)
+            loaded_count += 1
+
+            del block
+
+            # Print progress for large datasets
+            if (i + 1) % 500 == 0:
+                print(f"Processed {i + 1}/{len(items)} {description} files...")
+                if progress:
+                    progress(i + 1, len(items))
+
+        except Exception as e:
+            print(f"Error loading {description} NIfTI at {nifti_path}: {e}")
+
+    if progress:
+        progress(len(items), len(items))
+    return combined_volume, first_affine, loaded_count
+
+def split_into_shards(items, num_shards):
+    """Split a list into at most num_shards contiguous, order-preserving shards."""
+    num_shards = max(1, min(num_shards, len(items)))
+    shard_size = -(-len(items) // num_shards)  # ceiling division
+    return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+def _get_pool(num_workers):
+    """Return a process pool with num_workers workers, reusing it across calls."""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != num_workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # spawn avoids inheriting the parent's database connections and threads
+            _pool = ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _pool_workers = num_workers
+        return _pool
+
+def map_shards(func, shards, *args, num_workers, **kwargs):
+    """Submit func(shard, *args, **kwargs) for every shard to the worker pool; futures are in shard order."""
+    pool = _get_pool(num_workers)
+    return [pool.submit(func, shard, *args, **kwargs) for shard in shards]
+
+def parallel_accumulate(items, num_workers, description='mask', shard_size=DEFAULT_SHARD_SIZE,
+                        accumulate=accumulate_mask_files, progress=None, voxel_store_dir=None,
+                        dtype=np.float64):
+    """
+    Sum NIfTI volumes by splitting the inputs into shards, summing each shard in a
+    worker process and combining the partial sums in shard order.
+
+    Partials are combined in shard order. With an integer dtype (tumor counts, see
+    accumulator_dtype) every addition is exact, so the result equals the serial sum.
+    With a float dtype (MRI and dose) each shard is rounded on its own before the
+    partials are added, so voxels may differ from the serial sum in the last bits.
+
+    Args:
+        items (list): Inputs understood by ``accumulate`` (NIfTI paths by default)
+        num_workers (int): Maximum number of worker processes
+        description (str): Human readable mask type used in log messages
+        shard_size (int): Minimum number of files per shard
+        accumulate (callable): Module-level shard reducer, e.g. accumulate_mask_files
+            or accumulate_cropped_masks
+        progress (callable, optional): Called as progress(processed, total) as shards finish
+        voxel_store_dir (str, optional): Packed voxel store passed on to ``accumulate``
+        dtype: Accumulator dtype passed on to ``accumulate``
+
+    Returns:
+        tuple: (combined_volume, affine, loaded_count), same as accumulate_mask_files
+    """
+    num_shards = min(num_workers, len(items) // shard_size)
+    if num_shards <= 1:
+        return accumulate(items, description, progress, voxel_store_dir=voxel_store_dir, dtype=dtype)
+
+    shards = split_into_shards(items, num_shards)
+    print(f"Summing {len(items)} {description} files in {len(shards)} shards across {num_workers} workers")
+
+    futures = map_shards(
+        accumulate, shards, description,
+        num_workers=num_workers, voxel_store_dir=voxel_store_dir, dtype=dtype
+    )
+
+    combined_volume = None
+    first_affine = None
+    loaded_count = 0
+    processed = 0
+    for i, future in enumerate(futures):
+        partial, affine, count = future.result()
+        processed += len(shards[i])
+        if progress:
+            progress(processed, len(items))
+        if partial is None:
+            continue
+        if first_affine is None:
+            combined_volume, first_affine = partial, affine
+        elif partial.shape == combined_volume.shape:
+            combined_volume += partial
+        else:
+            print(f"Warning: Skipping {description} shard {i} with mismatched shape {partial.shape}")
+            continue
+        loaded_count += count
+
+    return combined_volume, first_affine, loaded_count
+
+def stream_accumulate(item_batches, mask_type, num_workers, description='mask',
+                      accumulate=accumulate_mask_files, progress=None, voxel_store_dir=None,
+                      expected_count=None, merge=None, **accumulate_kwargs):
+    """
+    Sum NIfTI volumes whose inputs arrive in batches, e.g. from a server-side cursor,
+    starting on the first batch before the later ones have been fetched.
+
+    Each batch is summed by ``accumulate`` in a worker process (inline when num_workers
+    is 1) with at most two batches per worker in flight, and partials are combined in
+    batch order, so memory depends on the batch size rather than on the cohort size.
+    The cohort size is only known at the end, so the running sum starts in the dtype
+    accumulator_dtype picks for one batch and is widened as the count grows. As for
+    parallel_accumulate, integer sums are exact and float sums may differ from a
+    serial sum in the last bits.
+
+    Args:
+        item_batches (iterable): Lists of inputs understood by ``accumulate``
+        mask_type (str): Mask type passed to accumulator_dtype
+        num_workers (int): Maximum number of worker processes
+        description (str): Human readable mask type used in log messages
+        accumulate (callable): Module-level batch reducer, e.g. accumulate_mask_files
+            or accumulate_cropped_masks
+        progress (callable, optional): Called as progress(processed, total) as batches
+            finish; until the last batch has been fetched total is expected_count
+        voxel_store_dir (str, optional): Packed voxel store passed on to ``accumulate``
+        expected_count (int, optional): Number of inputs the batches are expected to
+            hold, e.g. from a count query, reported as the total while they stream in
+        merge (callable, optional): For reducers that also return a mergeable state per
+            batch (e.g. voxel_statistics.accumulate_with_statistics), called as
+            merge(state, batch_state) to combine those states in batch order
+        **accumulate_kwargs: Extra keyword arguments passed on to ``accumulate``
+
+    Returns:
+        tuple: (combined_volume, affine, loaded_count, item_count, state); combined_volume
+               and affine are None if none of the files could be loaded, state is None
+               without merge
+    """
+    combined_volume = None
+    first_affine = None
+    loaded_count = 0
+    item_count = 0
+    processed = 0
+    state = None
+    pending = deque()
+    max_in_flight = 2 * max(num_workers, 1)
+
+    def submit(batch):
+        kwargs = {**accumulate_kwargs, 'voxel_store_dir': voxel_store_dir, 'dtype': accumulator_dtype(mask_type, len(batch))}
+        if num_workers > 1:
+            return _get_pool(num_workers).submit(accumulate, batch, description, **kwargs)
+        future = Future()
+        future.set_result(accumulate(batch, description, **kwargs))
+        return future
+
+    def drain(limit, total=None):
+        nonlocal combined_volume, first_affine, loaded_count, processed, state
+        while len(pending) > limit:
+            future, batch_size = pending.popleft()
+            partial, affine, count, *batch_state = future.result()
+            if merge is not None and batch_state:
+                state = batch_state[0] if state is None else merge(state, batch_state[0])
+            processed += batch_size
+            if progress:
+                # The data may have changed since the count, so never report less than is done
+                progress(processed, total or (max(expected_count, processed) if expected_count else None))
+            if partial is None:
+                continue
+            if first_affine is None:
+                combined_volume, first_affine = partial, affine
+            elif partial.shape == combined_volume.shape:
+                # Widen the running sum before it could overflow its dtype
+                combined_volume = combined_volume.astype(
+                    np.promote_types(combined_volume.dtype, accumulator_dtype(mask_type, loaded_count + count)),
+                    copy=False
+                )
+                _add_into(combined_volume, partial)
+            else:
+                print(f"Warning: Skipping {description} batch with mismatched shape {partial.shape}")
+                continue
+            loaded_count += count
+
+    for batch in item_batches:
+        if not batch:
+            continue
+        item_count += len(batch)
+        pending.append((submit(batch), len(batch)))
+        drain(max_in_flight)
+    drain(0, item_count)
+
+    print(f"Summed {loaded_count}/{item_count} {description} files as they were streamed")
+    return combined_volume, first_affine, loaded_count, item_count, state
@@ -0,0 +1,145 @@
+"""
+Region reads (slices, bounding boxes) from aggregate and raw mask volumes.
+
+A gzipped NIfTI has to be inflated from the start to reach any voxel, so the first
+region read of one writes an uncompressed ``.npy`` copy next to it (aggregate blobs)
+or under the volume cache (raw masks), and every later read memory-maps that copy
+and touches only the pages of the requested region. Raw masks in the packed voxel
+store are read from its memory map directly.
+
+Aggregate blobs are content-addressed, so their copies are removed with them. Copies
+of raw masks are named by dataset version and replaced once the version changes.
+"""
+
+import os
+import glob
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+
+from db_loading.parallel_reduction import bbox_slices
+
+# Axis names in array order: volumes are stored as (z, y, x)
+AXES = {'z': 0, 'y': 1, 'x': 2}
+
+# Opened volumes kept per process; every gunicorn worker has its own cache
+MAX_OPEN_VOLUMES = 32
+
+# Least recently used cache of opened volumes: (nifti path, copy path) -> (source mtime, memmap, affine)
+_open_volumes = OrderedDict()
+
+def get_uncompressed_path(nifti_path, cache_dir=None, version=None):
+    """
+    Path of the uncompressed copy of a NIfTI: next to it, or in cache_dir if given,
+    named by version if given.
+    """
+    name = os.path.basename(nifti_path)[:-len('.nii.gz')]
+    if version is not None:
+        name = f"{name}.v{version}"
+    return os.path.join(cache_dir or os.path.dirname(nifti_path), name + '.raw.npy')
+
+def _remove_stale_copies(nifti_path, cache_dir, npy_path):
+    """Remove the copies of a NIfTI written for other versions."""
+    name = os.path.basename(nifti_path)[:-len('.nii.gz')]
+    for path in glob.glob(os.path.join(glob.escape(cache_dir), f"{glob.escape(name)}.v*.raw.npy")):
+        if path != npy_path:
+            try:
+                os.remove(path)
+            except OSError:
+                # Another worker removed it first
+                pass
+
+def _write_uncompressed(volume, npy_path):
+    os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+    tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, volume)
+    os.replace(tmp_path, npy_path)
+
+def open_volume(nifti_path, cache_dir=None, version=None):
+    """
+    Open a NIfTI volume for region reads, inflating it to an uncompressed copy once.
+
+    Args:
+        nifti_path (str): Path of the .nii.gz volume
+        cache_dir (str, optional): Where to keep the uncompressed copy; defaults to
+            next to the volume
+        version (str, optional): Dataset version the copy is for; copies of other
+            versions in cache_dir are removed when it is written
+
+    Returns:
+        tuple: (read-only memmap in the stored dtype, affine), or None if the file does not exist
+    """
+    if not os.path.exists(nifti_path):
+        return None
+
+    mtime = os.path.getmtime(nifti_path)
+    npy_path = get_uncompressed_path(nifti_path, cache_dir, version)
+    cache_key = (nifti_path, npy_path)
+    cached = _open_volumes.get(cache_key)
+    if cached and cached[0] == mtime:
+        _open_volumes.move_to_end(cache_key)
+        return cached[1], cached[2]
+
+    img = nib.load(nifti_path)
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < mtime:
+        # Keep the stored dtype so integer counts stay exact and small
+        _write_uncompressed(np.asanyarray(img.dataobj), npy_path)
+        if version is not None:
+            _remove_stale_copies(nifti_path, os.path.dirname(npy_path), npy_path)
+
+    volume = np.load(npy_path, mmap_mode='r')
+    _open_volumes[cache_key] = (mtime, volume, img.affine)
+    _open_volumes.move_to_end(cache_key)
+    while len(_open_volumes) > MAX_OPEN_VOLUMES:
+        # Dropping the memmap unmaps the copy once no response still holds a view of it
+        _open_volumes.popitem(last=False)
+    return volume, img.affine
+
+def parse_axis(axis):
+    """
+    Array axis of an axis name ('z', 'y', 'x') or number (0-2).
+
+    Raises:
+        ValueError: If the axis is not one of those
+    """
+    if axis in AXES:
+        return AXES[axis]
+    if axis in ('0', '1', '2', 0, 1, 2):
+        return int(axis)
+    raise ValueError(f"axis must be one of z, y, x (or 0, 1, 2): {axis}")
+
+def read_slice(volume, axis, index):
+    """
+    One 2D slice of a volume, copied out of the memory map.
+
+    Raises:
+        ValueError: If the index is outside the volume
+    """
+    if not 0 <= index < volume.shape[axis]:
+        raise ValueError(f"index must be between 0 and {volume.shape[axis] - 1} on axis {axis}")
+    return np.array(np.take(volume, index, axis=axis))
+
+def parse_bbox(text):
+    """
+    Parse an inclusive 'z_min,z_max,y_min,y_max,x_min,x_max' box.
+
+    Raises:
+        ValueError: If it is not six integers with min <= max
+    """
+    bbox = tuple(int(value) for value in text.split(','))
+    if len(bbox) != 6 or any(bbox[i] > bbox[i + 1] for i in (0, 2, 4)):
+        raise ValueError("bbox must be z_min,z_max,y_min,y_max,x_min,x_max with min <= max")
+    return bbox
+
+def read_roi(volume, bbox):
+    """
+    The voxels of a volume inside an inclusive bounding box, copied out of the memory map.
+
+    Raises:
+        ValueError: If the box is not inside the volume
+    """
+    for axis, (low, high) in enumerate(zip(bbox[0::2], bbox[1::2])):
+        if low < 0 or high >= volume.shape[axis]:
+            raise ValueError(f"bbox is outside the volume of shape {tuple(volume.shape)}")
+    return np.array(volume[bbox_slices(bbox)])
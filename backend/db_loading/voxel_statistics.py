@@ -0,0 +1,339 @@
+"""
+Streaming voxel-wise statistics over a cohort of masks.
+
+All requested statistics are computed in the same pass that sums the cohort: each mask
+is read once, added to the sum and used to update a per-voxel state (Welford mean/M2,
+running max/min, threshold counts and, only when a percentile is requested, a fixed-bin
+histogram) and is then dropped, so memory does not grow with the cohort. States of
+different batches merge exactly (Chan et al. for mean/M2), so the pass is spread across
+worker processes by parallel_reduction.stream_accumulate like the plain sums.
+"""
+
+import re
+import numpy as np
+
+from db_loading.parallel_reduction import accumulator_dtype, read_mask_region
+from db_loading.voxel_store import open_voxel_store, open_voxel_stores
+
+# Histogram bins per voxel used to approximate percentiles
+PERCENTILE_BINS = 64
+
+# Value ranges known without looking at the data: tumor masks are binary
+KNOWN_VALUE_RANGES = {
+    'tumor': (0.0, 1.0)
+}
+
+_STATISTIC_PATTERN = re.compile(r'^(sum|mean|std|max|min)$|^count_above_(-?\d+(?:\.\d+)?)$|^p(\d+(?:\.\d+)?)$')
+
+def parse_statistic(name):
+    """
+    Split a statistic name into (kind, parameter).
+
+    Supported names are 'sum', 'mean', 'std', 'max', 'min', 'count_above_<threshold>'
+    (e.g. 'count_above_20') and 'p<percentile>' (e.g. 'p90').
+
+    Raises:
+        ValueError: If the name is not a supported statistic
+    """
+    match = _STATISTIC_PATTERN.match(str(name))
+    if not match:
+        raise ValueError(f"Unsupported statistic: {name}")
+    if match.group(1):
+        return match.group(1), None
+    if match.group(2) is not None:
+        return 'count_above', float(match.group(2))
+    percentile = float(match.group(3))
+    if percentile > 100:
+        raise ValueError(f"Percentile out of range: {name}")
+    return 'percentile', percentile
+
+def _flat_voxel_indices(region, shape):
+    """Flat indices into a C-ordered volume of shape of the voxels a tuple of slices selects."""
+    index = np.zeros((), dtype=np.intp)
+    stride = 1
+    for axis in reversed(range(len(shape))):
+        positions = np.arange(*region[axis].indices(shape[axis]), dtype=np.intp) * stride
+        index = index + positions.reshape((-1,) + (1,) * (len(shape) - 1 - axis))
+        stride *= shape[axis]
+    return index
+
+class VoxelStatistics:
+    """
+    Mergeable per-voxel state for a set of statistics, updated one mask at a time.
+
+    A mask may be added as only the block inside its bounding box. Its voxels outside
+    the box are zero and are not touched: the state keeps, per voxel, how many masks
+    covered it (``seen``), and the zeros of the others are folded in when the
+    statistics are read, so the cost of an update follows the box, not the volume.
+    """
+    def __init__(self, statistics, value_range=None, bins=PERCENTILE_BINS):
+        self.statistics = list(statistics)
+        self.parsed = [parse_statistic(name) for name in self.statistics]
+        kinds = {kind for kind, _ in self.parsed}
+        self.track_sum = 'sum' in kinds
+        self.track_moments = bool(kinds & {'mean', 'std'})
+        self.track_max = 'max' in kinds
+        self.track_min = 'min' in kinds
+        self.thresholds = sorted({param for kind, param in self.parsed if kind == 'count_above'})
+        self.track_histogram = 'percentile' in kinds
+        self.track_seen = self.track_moments or self.track_max or self.track_min or bool(self.thresholds) or self.track_histogram
+        if self.track_histogram:
+            if value_range is None:
+                raise ValueError("Percentiles need the value range of the masks")
+            # Uncovered voxels are zero, so the bins always include zero
+            low, high = min(float(value_range[0]), 0.0), max(float(value_range[1]), 0.0)
+            value_range = (low, high if high > low else low + 1.0)
+        self.value_range = value_range
+        self.bins = bins
+
+        self.count = 0
+        self.shape = None
+        self.sum = self.mean = self.m2 = self.max = self.min = self.histogram = self.seen = None
+        self.above = {}
+
+    def _allocate(self, shape):
+        self.shape = shape
+        if self.track_sum:
+            self.sum = np.zeros(shape, dtype=np.float64)
+        if self.track_seen:
+            self.seen = np.zeros(shape, dtype=np.uint32)
+        if self.track_moments:
+            self.mean = np.zeros(shape, dtype=np.float64)
+            self.m2 = np.zeros(shape, dtype=np.float64)
+        if self.track_max:
+            self.max = np.full(shape, -np.inf, dtype=np.float32)
+        if self.track_min:
+            self.min = np.full(shape, np.inf, dtype=np.float32)
+        self.above = {threshold: np.zeros(shape, dtype=np.uint32) for threshold in self.thresholds}
+        if self.track_histogram:
+            # Bin counts never exceed the masks seen, so they start in the compact dtype
+            # of a batch (uint16) and are only widened once a state counts more masks
+            self.histogram = np.zeros((self.bins,) + tuple(shape), dtype=accumulator_dtype('tumor', 0))
+
+    def _widen_histogram(self, count):
+        dtype = np.promote_types(self.histogram.dtype, accumulator_dtype('tumor', count))
+        self.histogram = self.histogram.astype(dtype, copy=False)
+
+    def _bin_index(self, values):
+        low, high = self.value_range
+        bin_index = ((values - low) * (self.bins / (high - low))).astype(np.intp)
+        return np.clip(bin_index, 0, self.bins - 1, out=bin_index)
+
+    def update(self, block, region=None, shape=None):
+        """
+        Add one mask: its full volume, or the block at region (a tuple of slices) of a
+        volume of the given shape whose other voxels are zero.
+
+        Returns:
+            bool: False if the volume's shape does not match the cohort
+        """
+        shape = tuple(shape) if shape is not None else block.shape
+        if self.shape is None:
+            self._allocate(shape)
+        if shape != self.shape:
+            return False
+        if region is None:
+            region = (slice(None),) * len(shape)
+
+        self.count += 1
+        if self.track_sum:
+            self.sum[region] += block
+        if self.track_seen:
+            seen = self.seen[region]
+            seen += 1
+        if self.track_moments:
+            # Welford's update over the masks covering each voxel: numerically stable
+            # running mean and sum of squared deviations
+            mean = self.mean[region]
+            delta = block - mean
+            mean += delta / seen
+            self.m2[region] += delta * (block - mean)
+        if self.track_max:
+            np.maximum(self.max[region], block, out=self.max[region], casting='unsafe')
+        if self.track_min:
+            np.minimum(self.min[region], block, out=self.min[region], casting='unsafe')
+        for threshold, counts in self.above.items():
+            counts[region] += block > threshold
+        if self.track_histogram:
+            self._widen_histogram(self.count)
+            # Every voxel falls into exactly one bin, so plain fancy-index increments are safe
+            flat = self.histogram.reshape(self.bins, -1)
+            flat[self._bin_index(block).ravel(), _flat_voxel_indices(region, shape).ravel()] += 1
+        return True
+
+    def merge(self, other):
+        """Combine the state of another shard into this one and return the result."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            return other
+        if other.shape != self.shape:
+            print(f"Warning: Skipping statistics shard with mismatched shape {other.shape}")
+            return self
+
+        total = self.count + other.count
+        if self.track_sum:
+            self.sum += other.sum
+        if self.track_moments:
+            # Chan et al. pairwise combination of mean and M2, per voxel over the masks covering it
+            seen = self.seen.astype(np.float64)
+            other_seen = other.seen.astype(np.float64)
+            combined_seen = seen + other_seen
+            weight = np.divide(other_seen, combined_seen, out=np.zeros(self.shape), where=combined_seen > 0)
+            delta = other.mean - self.mean
+            self.mean += delta * weight
+            self.m2 += other.m2 + delta ** 2 * seen * weight
+        if self.track_seen:
+            self.seen += other.seen
+        if self.track_max:
+            np.maximum(self.max, other.max, out=self.max)
+        if self.track_min:
+            np.minimum(self.min, other.min, out=self.min)
+        for threshold, counts in self.above.items():
+            counts += other.above[threshold]
+        if self.track_histogram:
+            self._widen_histogram(total)
+            self.histogram += other.histogram
+        self.count = total
+        return self
+
+    def _unseen(self):
+        """Per voxel, how many masks left it out, i.e. were zero there."""
+        return self.count - self.seen.astype(np.int64)
+
+    def _percentile(self, percentile):
+        """Approximate percentile per voxel, interpolated linearly inside the histogram bin."""
+        low, high = self.value_range
+        histogram = self.histogram.astype(np.int64)
+        # The zeros of the masks that left a voxel out all fall into the bin holding zero
+        histogram[int(self._bin_index(np.zeros(())))] += self._unseen()
+        target = percentile / 100 * self.count
+        cumulative = np.cumsum(histogram, axis=0)
+        bin_index = np.argmax(cumulative >= target, axis=0)
+        below = np.where(
+            bin_index > 0,
+            np.take_along_axis(cumulative, np.maximum(bin_index - 1, 0)[None], axis=0)[0],
+            0
+        )
+        in_bin = np.take_along_axis(histogram, bin_index[None], axis=0)[0]
+        fraction = np.clip((target - below) / np.maximum(in_bin, 1), 0, 1)
+        return low + (bin_index + fraction) * ((high - low) / self.bins)
+
+    def results(self):
+        """
+        Returns:
+            dict: Statistic name -> volume; float32 for values, compact integers for
+                  counts. Empty if no mask was added.
+        """
+        if self.count == 0:
+            return {}
+
+        unseen = self._unseen() if self.track_seen else None
+        results = {}
+        for name, (kind, param) in zip(self.statistics, self.parsed):
+            if kind == 'sum':
+                volume = self.sum
+            elif kind == 'mean':
+                # Zeros only scale the mean of the covering masks down
+                volume = self.mean * (self.seen / self.count)
+            elif kind == 'std':
+                # Population standard deviation over the cohort: the covering masks' M2
+                # combined with that of the zeros, which have mean and M2 zero
+                m2 = self.m2 + self.mean ** 2 * (self.seen * (unseen / self.count))
+                volume = np.sqrt(m2 / self.count)
+            elif kind == 'max':
+                volume = np.where(unseen > 0, np.maximum(self.max, 0), self.max)
+            elif kind == 'min':
+                volume = np.where(unseen > 0, np.minimum(self.min, 0), self.min)
+            elif kind == 'count_above':
+                counts = self.above[param] + unseen if param < 0 else self.above[param]
+                results[name] = counts.astype(accumulator_dtype('tumor', self.count))
+                continue
+            else:
+                volume = self._percentile(param)
+            results[name] = volume.astype(np.float32)
+        return results
+
+def get_percentile_range(voxel_store_dir, mask_type, statistics):
+    """
+    Value range the percentile histograms of statistics over mask_type cover: the range
+    recorded by generate_voxel_store for the mask type, else a known one. Masks added
+    after the store was built may fall outside it and then count in the edge bins.
+
+    Returns:
+        tuple: (low, high), or None if statistics request no percentile
+
+    Raises:
+        ValueError: If percentiles are requested but the mask type's range is unknown
+    """
+    if not any(parse_statistic(name)[0] == 'percentile' for name in statistics or []):
+        return None
+    store = open_voxel_store(voxel_store_dir, f"{mask_type}_mask") if voxel_store_dir else None
+    if store is not None and store.value_range is not None:
+        return store.value_range
+    if mask_type in KNOWN_VALUE_RANGES:
+        return KNOWN_VALUE_RANGES[mask_type]
+    raise ValueError(f"Percentiles of {mask_type} masks need the voxel store; build it with generate_voxel_store")
+
+def merge_statistics(state, other):
+    """Merge function for parallel_reduction.stream_accumulate."""
+    return state.merge(other)
+
+def accumulate_with_statistics(items, description='mask', progress=None, voxel_store_dir=None, dtype=np.float64,
+                               statistics=(), value_range=None):
+    """
+    Sum masks like parallel_reduction.accumulate_mask_files and compute statistics from
+    the same reads.
+
+    Args:
+        items (list): NIfTI paths, or (nifti_path, bbox) tuples as for
+            accumulate_cropped_masks; masks with a bbox are only read inside it
+        description (str): Human readable mask type used in log messages
+        progress (callable, optional): Called as progress(processed, total)
+        voxel_store_dir (str, optional): Packed voxel store to read masks from
+        dtype: Accumulator dtype of the sum, see accumulator_dtype
+        statistics (list): Statistic names, see parse_statistic
+        value_range (tuple, optional): (low, high) covered by the percentile
+            histograms, see get_percentile_range; required for percentiles
+
+    Returns:
+        tuple: (combined_volume, affine, loaded_count, VoxelStatistics); the first
+               three as for accumulate_mask_files
+    """
+    state = VoxelStatistics(statistics, value_range)
+    combined_volume = None
+    first_affine = None
+    loaded_count = 0
+    stores = open_voxel_stores(voxel_store_dir)
+
+    for i, item in enumerate(items):
+        nifti_path, bbox = item if isinstance(item, tuple) else (item, None)
+        try:
+            loaded = read_mask_region(nifti_path, bbox, stores, description)
+            if loaded is None:
+                continue
+            block, region, shape, affine = loaded
+
+            if first_affine is None:
+                first_affine = affine
+                combined_volume = np.zeros(shape, dtype=dtype)
+            if shape != combined_volume.shape:
+                continue
+
+            # unsafe casting lets masks saved as float still add into integer count volumes
+            np.add(combined_volume[region], block, out=combined_volume[region], casting='unsafe')
+            state.update(block, region, shape)
+            loaded_count += 1
+            del block
+
+            if (i + 1) % 50 == 0:
+                print(f"Processed {i + 1}/{len(items)} {description} files...")
+                if progress:
+                    progress(i + 1, len(items))
+
+        except Exception as e:
+            print(f"Error loading {description} NIfTI at {nifti_path}: {e}")
+
+    if progress:
+        progress(len(items), len(items))
+    return combined_volume, first_affine, loaded_count, state
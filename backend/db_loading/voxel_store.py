@@ -0,0 +1,103 @@
+"""
+Packed, uncompressed voxel store for the raw mask corpus.
+
+Each series type is written once at ingest (see generate_voxel_store.py) as one flat
+``<series_type>-<build>.dat`` file holding every mask volume back to back in its native
+dtype, plus a ``<series_type>.json`` index mapping NiftiData ids to rows. Readers
+memory-map the data file, so a mask is a zero-copy view with no gzip inflation.
+
+The <uuid>.nii.gz files stay the source of truth: masks missing from the store (e.g.
+ingested after the last build) are read from them as before.
+"""
+
+import os
+import json
+import numpy as np
+
+SERIES_TYPES = ('tumor_mask', 'mri_mask', 'dose_mask')
+
+# Process-local cache of opened stores: (store_dir, series_type) -> (index mtime, VoxelStore)
+_open_stores = {}
+
+class VoxelStore:
+    """Memory-mapped volumes of one series type, addressed by mask id."""
+    def __init__(self, index, data):
+        self.series_type = index['series_type']
+        self.shape = tuple(index['shape'])
+        self.affine = np.array(index['affine'])
+        # (min, max) over every stored volume; absent from stores built before it was recorded
+        self.value_range = tuple(index['value_range']) if index.get('value_range') else None
+        self.rows = {mask_id: row for row, mask_id in enumerate(index['ids'])}
+        self._data = data
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, mask_id):
+        """Read-only view of a mask's volume, or None if the mask is not in the store."""
+        row = self.rows.get(str(mask_id))
+        if row is None:
+            return None
+        return self._data[row]
+
+def get_index_path(store_dir, series_type):
+    return os.path.join(store_dir, f"{series_type}.json")
+
+def mask_id_from_path(nifti_path):
+    """Mask id of a raw ``<uuid>.nii.gz`` path."""
+    return os.path.basename(nifti_path)[:-len('.nii.gz')]
+
+def open_voxel_store(store_dir, series_type):
+    """
+    Open (and cache per process) the store of one series type.
+
+    Returns:
+        VoxelStore: The store, or None if it has not been built or cannot be read
+    """
+    index_path = get_index_path(store_dir, series_type)
+    if not os.path.exists(index_path):
+        return None
+
+    try:
+        mtime = os.path.getmtime(index_path)
+        cached = _open_stores.get((store_dir, series_type))
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with open(index_path) as f:
+            index = json.load(f)
+        if not index['ids']:
+            return None
+        data = np.memmap(
+            os.path.join(store_dir, index['data_file']),
+            dtype=index['dtype'],
+            mode='r',
+            shape=(len(index['ids']),) + tuple(index['shape'])
+        )
+    except Exception as e:
+        print(f"Error opening {series_type} voxel store: {e}")
+        return None
+
+    store = VoxelStore(index, data)
+    _open_stores[(store_dir, series_type)] = (mtime, store)
+    return store
+
+def open_voxel_stores(store_dir):
+    """All series stores built under store_dir; empty if store_dir is None or nothing was built."""
+    if not store_dir:
+        return []
+    stores = [open_voxel_store(store_dir, series_type) for series_type in SERIES_TYPES]
+    return [store for store in stores if store is not None]
+
+def lookup_mask(stores, mask_id):
+    """
+    Find a mask in the opened stores.
+
+    Returns:
+        tuple: (volume_view, affine), or None if no store holds the mask
+    """
+    for store in stores:
+        volume = store.get(mask_id)
+        if volume is not None:
+            return volume, store.affine
+    return None
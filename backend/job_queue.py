@@ -0,0 +1,127 @@
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class LocalJobStore:
+    """In-process job store, used for local runs and tests where Redis is not available."""
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+    def load(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+class RedisJobStore:
+    """Job store shared by all gunicorn workers, so any of them can report a job's status."""
+    def __init__(self, redis_cache, ttl_seconds=24 * 60 * 60):
+        self.r = redis_cache.r
+        self.ttl_seconds = ttl_seconds
+
+    def save(self, job):
+        self.r.set(f"job:{job['id']}", json.dumps(job), ex=self.ttl_seconds)
+
+    def load(self, job_id):
+        job = self.r.get(f"job:{job_id}")
+        return json.loads(job) if job else None
+
+class JobQueue:
+    """
+    Runs long tasks (e.g. cohort aggregation) on a background thread pool and records
+    their state, progress and result in a job store.
+
+    Tasks are called as ``func(*args, progress=callback, **kwargs)`` inside an app
+    context, where ``callback(processed, total)`` reports progress.
+
+    Jobs whose state cannot be saved in the store (e.g. Redis is down) are kept in a
+    process-local store instead, so they still run and this worker can report them.
+    """
+    def __init__(self, app, store, max_workers=2):
+        self.app = app
+        self.store = store
+        self.fallback_store = LocalJobStore()
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created lazily so that each gunicorn worker gets its own threads after fork
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+            return self._executor
+
+    def _save(self, job):
+        if job.get('local'):
+            self.fallback_store.save(job)
+            return
+        try:
+            self.store.save(job)
+        except Exception as e:
+            print(f"Error saving job {job['id']}, keeping it in process: {e}")
+            job['local'] = True
+            self.fallback_store.save(job)
+
+    def submit(self, func, *args, description='', **kwargs):
+        """Enqueue func and return the new job's id immediately."""
+        job = {
+            'id': str(uuid.uuid4()),
+            'description': description,
+            'state': 'queued',
+            'processed': 0,
+            'total': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None
+        }
+        self._save(job)
+        self._get_executor().submit(self._run, job, func, args, kwargs)
+        return job['id']
+
+    def _run(self, job, func, args, kwargs):
+        def progress(processed, total):
+            job['processed'] = processed
+            job['total'] = total
+            self._save(job)
+
+        try:
+            job['state'] = 'running'
+            job['started_at'] = time.time()
+            self._save(job)
+            with self.app.app_context():
+                job['result'] = func(*args, progress=progress, **kwargs)
+            job['state'] = 'finished'
+        except Exception as e:
+            print(f"Job {job['id']} ({job['description']}) failed: {e}")
+            job['state'] = 'failed'
+            job['error'] = str(e)
+        job['finished_at'] = time.time()
+        self._save(job)
+
+    def get(self, job_id):
+        """Return the job's state with an ETA estimated from its progress so far, or None."""
+        job = self.fallback_store.load(job_id)
+        if job is None:
+            try:
+                job = self.store.load(job_id)
+            except Exception as e:
+                print(f"Error loading job {job_id}: {e}")
+        if job is None:
+            return None
+
+        job['eta_seconds'] = None
+        if job['state'] == 'running' and job['total'] and job['processed']:
+            elapsed = time.time() - job['started_at']
+            job['eta_seconds'] = elapsed / job['processed'] * (job['total'] - job['processed'])
+        elif job['state'] == 'finished':
+            job['eta_seconds'] = 0
+        return job
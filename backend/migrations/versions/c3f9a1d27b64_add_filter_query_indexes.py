@@ -0,0 +1,50 @@
+"""add filter query indexes
+
+Revision ID: c3f9a1d27b64
+Revises: a864e19f8035
+Create Date: 2026-10-16 09:12:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f9a1d27b64'
+down_revision = 'a864e19f8035'
+branch_labels = None
+depends_on = None
+
+
+SERIES_TYPES = ('tumor_mask', 'mri_mask', 'dose_mask')
+
+
+def upgrade():
+    # Patient-level filters
+    op.create_index('ix_patients_origin_cancer_sex', 'patients', ['origin_cancer', 'sex'], unique=False)
+    op.create_index('ix_patients_dob', 'patients', ['dob'], unique=False)
+
+    # Patient -> masks lookups (per-patient EXISTS filters, timelines)
+    op.create_index('ix_nifti_data_patient_id_series_type', 'nifti_data', ['patient_id', 'series_type'], unique=False)
+    # Index-only scans of one series type's (patient, mask) pairs for cohort joins
+    for series_type in SERIES_TYPES:
+        op.create_index(
+            f'ix_nifti_data_{series_type}_patient_id', 'nifti_data', ['patient_id', 'id'], unique=False,
+            postgresql_where=sa.text(f"series_type = '{series_type}'")
+        )
+
+    # Mask-level filters
+    op.create_index('ix_tumor_mask_location_volume_mm3', 'tumor_mask', ['location', 'volume_mm3'], unique=False)
+    op.create_index('ix_tumor_mask_volume_mm3', 'tumor_mask', ['volume_mm3'], unique=False)
+    op.create_index('ix_dose_mask_max_dose', 'dose_mask', ['max_dose'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_dose_mask_max_dose', table_name='dose_mask')
+    op.drop_index('ix_tumor_mask_volume_mm3', table_name='tumor_mask')
+    op.drop_index('ix_tumor_mask_location_volume_mm3', table_name='tumor_mask')
+    for series_type in SERIES_TYPES:
+        op.drop_index(f'ix_nifti_data_{series_type}_patient_id', table_name='nifti_data')
+    op.drop_index('ix_nifti_data_patient_id_series_type', table_name='nifti_data')
+    op.drop_index('ix_patients_dob', table_name='patients')
+    op.drop_index('ix_patients_origin_cancer_sex', table_name='patients')
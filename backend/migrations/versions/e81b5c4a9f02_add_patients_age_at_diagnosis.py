@@ -0,0 +1,35 @@
+"""add patients age_at_diagnosis
+
+Revision ID: e81b5c4a9f02
+Revises: c3f9a1d27b64
+Create Date: 2026-10-16 14:37:05.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b5c4a9f02'
+down_revision = 'c3f9a1d27b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Stored generated column: computed once on write, so age-at-diagnosis filters are
+    # plain indexed range scans
+    op.add_column('patients', sa.Column(
+        'age_at_diagnosis', sa.Integer(),
+        sa.Computed(
+            "date_part('year', age(date_of_original_diagnosis::timestamp, dob::timestamp))::integer",
+            persisted=True
+        ),
+        nullable=True
+    ))
+    op.create_index('ix_patients_age_at_diagnosis', 'patients', ['age_at_diagnosis'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_patients_age_at_diagnosis', table_name='patients')
+    op.drop_column('patients', 'age_at_diagnosis')
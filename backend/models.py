@@ -1,7 +1,7 @@
 import uuid
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship
-from sqlalchemy import CheckConstraint 
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy import CheckConstraint, text
 from app import db
 
 class Patients(db.Model):
@@ -28,6 +28,24 @@ class Patients(db.Model):
     date_of_original_diagnosis = db.Column(db.Date, nullable=False)
     date_of_metastatic_diagnosis = db.Column(db.Date, nullable=False)
 
+    # Age in completed years at the original diagnosis, computed by the database on write.
+    # Deferred so loading patients does not select it; only the age at diagnosis filter
+    # (criteria_compiler, columnar_index) reads it.
+    age_at_diagnosis = deferred(db.Column(
+        db.Integer,
+        db.Computed(
+            "date_part('year', age(date_of_original_diagnosis::timestamp, dob::timestamp))::integer",
+            persisted=True
+        )
+    ))
+
+    # Indexes for the cohort filters in db_loading/criteria_compiler.py
+    __table_args__ = (
+        db.Index('ix_patients_origin_cancer_sex', 'origin_cancer', 'sex'),
+        db.Index('ix_patients_dob', 'dob'),
+        db.Index('ix_patients_age_at_diagnosis', 'age_at_diagnosis'),
+    )
+
     nifti_data = db.relationship(
         "NiftiData",
         back_populates="patient",
@@ -56,6 +74,12 @@ class NiftiData(db.Model):
             "series_type IN ('tumor_mask', 'dose_mask', 'mri_mask')",
             name="check_nifti_data_type"
         ),
+        # Patient -> masks lookups (per-patient EXISTS filters, timelines)
+        db.Index('ix_nifti_data_patient_id_series_type', 'patient_id', 'series_type'),
+        # Index-only scans of one series type's (patient, mask) pairs for cohort joins
+        db.Index('ix_nifti_data_tumor_mask_patient_id', 'patient_id', 'id', postgresql_where=text("series_type = 'tumor_mask'")),
+        db.Index('ix_nifti_data_mri_mask_patient_id', 'patient_id', 'id', postgresql_where=text("series_type = 'mri_mask'")),
+        db.Index('ix_nifti_data_dose_mask_patient_id', 'patient_id', 'id', postgresql_where=text("series_type = 'dose_mask'")),
     )
 
     patient = db.relationship(
@@ -92,6 +116,11 @@ class TumorMask(db.Model):
 
     volume_mm3 = db.Column(db.Float, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_tumor_mask_location_volume_mm3', 'location', 'volume_mm3'),
+        db.Index('ix_tumor_mask_volume_mm3', 'volume_mm3'),
+    )
+
     x_com = db.Column(db.Integer, nullable=False)
     y_com = db.Column(db.Integer, nullable=False)
     z_com = db.Column(db.Integer, nullable=False)
@@ -120,6 +149,10 @@ class DoseMask(db.Model):
 
     max_dose = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_dose_mask_max_dose', 'max_dose'),
+    )
+
     volume_mm3 = db.Column(db.Float, nullable=False)
 
     x_com = db.Column(db.Integer, nullable=False)
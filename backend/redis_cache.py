@@ -1,3 +1,4 @@
+import json
 import redis
 
 class RedisCache:
@@ -14,4 +15,33 @@ class RedisCache:
         self.r.delete(key)
 
     def path_exists(self, key):
-        return self.r.exists(key)
\ No newline at end of file
+        return self.r.exists(key)
+
+    def get_json(self, key):
+        value = self.r.get(key)
+        return json.loads(value) if value else None
+
+    def set_json(self, key, value, ttl_seconds=None):
+        self.r.set(key, json.dumps(value), ex=ttl_seconds)
+
+    def add_member(self, key, member):
+        self.r.sadd(key, member)
+
+    def remove_member(self, key, member):
+        """Remove member from the set at key and return how many members remain, in one transaction."""
+        pipe = self.r.pipeline(transaction=True)
+        pipe.srem(key, member)
+        pipe.scard(key)
+        _, remaining = pipe.execute()
+        return remaining
+
+    def count_members(self, key):
+        return self.r.scard(key)
+
+    def get_dataset_version(self):
+        version = self.r.get('dataset_version')
+        return version.decode('utf-8') if version else '0'
+
+    def bump_dataset_version(self):
+        """Mark the patient/mask data as changed, invalidating everything derived from it."""
+        return self.r.incr('dataset_version')
@@ -0,0 +1,112 @@
+import os
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Only the holder's token may extend or release a lock
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class RedisLock:
+    """
+    Cross-host lock with a lease. The holder renews the lease from a heartbeat thread,
+    so a crashed worker's lock expires on its own instead of blocking waiters forever.
+    """
+    def __init__(self, r, name, lease_seconds=30, poll_interval=0.2):
+        self.r = r
+        self.key = f'single_flight:{name}'
+        self.lease_ms = int(lease_seconds * 1000)
+        self.poll_interval = poll_interval
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.r.set(self.key, self.token, nx=True, px=self.lease_ms):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out waiting for {self.key}")
+            time.sleep(self.poll_interval)
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_ms / 3000):
+            try:
+                self.r.eval(_RENEW_SCRIPT, 1, self.key, self.token, self.lease_ms)
+            except Exception as e:
+                print(f"Error renewing lock {self.key}: {e}")
+
+    def release(self):
+        self._stop.set()
+        self.r.eval(_RELEASE_SCRIPT, 1, self.key, self.token)
+
+class FileLock:
+    """Lock shared by all processes on one host, for local runs without Redis."""
+    def __init__(self, lock_dir, name, poll_interval=0.2):
+        os.makedirs(lock_dir, exist_ok=True)
+        self.path = os.path.join(lock_dir, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.lock')
+        self.poll_interval = poll_interval
+        self._file = None
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        self._file = open(self.path, 'a')
+        while True:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    self._file.close()
+                    raise TimeoutError(f"Timed out waiting for {self.path}")
+                time.sleep(self.poll_interval)
+
+    def release(self):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+def _make_lock(name):
+    from app import app, redis_cache
+    if app.config.get('LOCK_BACKEND', 'redis') == 'redis':
+        try:
+            redis_cache.r.ping()
+            return RedisLock(redis_cache.r, name)
+        except Exception as e:
+            print(f"Redis unavailable for lock {name}, using a file lock: {e}")
+    return FileLock(os.path.join(app.config['FILESTORE_PATH'], 'locks'), name)
+
+@contextmanager
+def single_flight(name, timeout=600):
+    """
+    Hold the cross-worker lock for name while the block runs.
+
+    Concurrent callers with the same name queue behind the holder. Callers should
+    re-check for the finished result once inside the block, so that only the first
+    one computes it and the rest pick up its output.
+
+    Raises:
+        TimeoutError: If the lock could not be acquired within timeout seconds
+    """
+    lock = _make_lock(name)
+    lock.acquire(timeout)
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            print(f"Error releasing lock {name}: {e}")
@@ -0,0 +1,88 @@
+"""
+Bundled copies of the combined fsaverage pial surfaces used by the glass brain.
+
+templateflow.api.get may download the GIfTI files and parsing them takes a while, so
+each combined mesh is saved once as a small .npz (at image build time, see the
+Dockerfile) and loaded from there. Without a bundle the surface falls back to
+templateflow and the bundle is written for next time.
+
+Levels of detail are the fsaverage densities templateflow ships, from the full
+164k-vertex fsaverage (level 0) down to the 3k-vertex fsaverage4 (level 3).
+
+    python surface_bundle.py [bundle_dir]
+"""
+
+import os
+import sys
+import numpy as np
+import nibabel as nib
+
+# This module is deliberately free of Flask/database imports so the Docker build can
+# run it before the app is configured.
+
+BUNDLE_DIR = os.environ.get(
+    'BRAIN_SURFACE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+)
+
+# templateflow density per level of detail (vertices per hemisphere)
+LOD_DENSITIES = ['164k', '41k', '10k', '3k']
+
+def get_bundle_path(density, bundle_dir=BUNDLE_DIR):
+    return os.path.join(bundle_dir, f"fsaverage_pial_{density}.npz")
+
+def load_fsaverage_pial_from_templateflow(density='164k'):
+    """Load and combine the left and right fsaverage pial surfaces of a density from templateflow."""
+    from templateflow import api as tf
+
+    lh_path = tf.get('fsaverage', density=density, hemi='L', suffix='pial', extension='surf.gii')
+    rh_path = tf.get('fsaverage', density=density, hemi='R', suffix='pial', extension='surf.gii')
+
+    lh_gii = nib.load(lh_path)
+    rh_gii = nib.load(rh_path)
+
+    lh_vertices, lh_faces = lh_gii.darrays[0].data, lh_gii.darrays[1].data
+    rh_vertices, rh_faces = rh_gii.darrays[0].data, rh_gii.darrays[1].data
+
+    num_lh_verts = lh_vertices.shape[0]
+    combined_vertices = np.vstack((lh_vertices, rh_vertices))
+    rh_faces_offset = rh_faces + num_lh_verts
+    combined_faces = np.vstack((lh_faces, rh_faces_offset))
+
+    return combined_vertices.astype(np.float32), combined_faces.astype(np.uint32)
+
+def write_bundle(vertices, faces, bundle_path):
+    """Atomically save the combined surface so concurrent readers never see a partial file."""
+    os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, vertices=vertices, faces=faces)
+    os.replace(tmp_path, bundle_path)
+
+def load_combined_fsaverage_pial(density='164k', bundle_dir=BUNDLE_DIR):
+    """
+    The combined surface of a density as (float32 vertices, uint32 faces), from the
+    bundle when it exists, else from templateflow (saving the bundle on the way).
+    """
+    bundle_path = get_bundle_path(density, bundle_dir)
+    if os.path.exists(bundle_path):
+        try:
+            with np.load(bundle_path, allow_pickle=False) as bundle:
+                return bundle['vertices'], bundle['faces']
+        except Exception as e:
+            print(f"Error loading brain surface bundle {bundle_path}, using templateflow: {e}")
+
+    vertices, faces = load_fsaverage_pial_from_templateflow(density)
+    try:
+        write_bundle(vertices, faces, bundle_path)
+    except OSError as e:
+        print(f"Could not save brain surface bundle {bundle_path}: {e}")
+    return vertices, faces
+
+if __name__ == "__main__":
+    bundle_dir = sys.argv[1] if len(sys.argv) > 1 else BUNDLE_DIR
+    for density in LOD_DENSITIES:
+        vertices, faces = load_fsaverage_pial_from_templateflow(density)
+        path = get_bundle_path(density, bundle_dir)
+        write_bundle(vertices, faces, path)
+        print(f"Saved {len(vertices)} vertices and {len(faces)} faces to {path}")
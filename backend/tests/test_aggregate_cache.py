@@ -0,0 +1,125 @@
+"""Blob links, reference counting and release in the content-addressed aggregate cache."""
+
+import os
+
+from db_loading.aggregate_cache import (
+    aggregate_cache_key, find_filter_aggregate, get_blob_key, get_blob_path, get_filter_key, get_shared_aggregate_path,
+    get_statistic_blob_path, link_filter, link_statistic, normalize_criteria, release_filter, release_key,
+    unlink_filter
+)
+
+MASK_TYPE = 'tumor'
+
+def make_blob(cache_dir, key, content=b'aggregate'):
+    path = get_blob_path(cache_dir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+def link(cache_dir, owner, filter_id, key):
+    """Link as the filter blueprint does: then release the filter's previous blob."""
+    link_path, previous_key = link_filter(cache_dir, MASK_TYPE, owner, filter_id, key)
+    if previous_key:
+        release_key(cache_dir, MASK_TYPE, previous_key, owner, filter_id)
+    return link_path
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_owners_get_separate_links_to_one_blob(tmp_path, fake_redis):
+    cache_dir = str(tmp_path)
+    make_blob(cache_dir, 'k1')
+
+    alice = link(cache_dir, 'alice', 'default_id', 'k1')
+    bob = link(cache_dir, 'bob', 'default_id', 'k1')
+
+    assert alice != bob
+    assert os.path.islink(alice) and os.path.islink(bob)
+    assert read(alice) == read(bob) == b'aggregate'
+    # Links are relative, so the filestore can move
+    assert not os.path.isabs(os.readlink(alice))
+    assert get_blob_key(cache_dir, 'alice', 'default_id') == 'k1'
+    assert get_filter_key(MASK_TYPE, 'bob', 'default_id') == 'k1'
+    assert find_filter_aggregate(cache_dir, 'alice', 'default_id') == alice
+
+def test_blob_lives_until_its_last_reference_is_released(tmp_path, fake_redis):
+    cache_dir = str(tmp_path)
+    blob_path = make_blob(cache_dir, 'k1')
+    statistic_path = make_blob(cache_dir, 'k1.mean')
+    link(cache_dir, 'alice', 'default_id', 'k1')
+    link(cache_dir, 'bob', 'default_id', 'k1')
+    link(cache_dir, 'bob', 'saved', 'k1')
+
+    release_filter(cache_dir, MASK_TYPE, 'alice', 'default_id')
+    assert find_filter_aggregate(cache_dir, 'alice', 'default_id') is None
+    assert get_filter_key(MASK_TYPE, 'alice', 'default_id') is None
+    assert os.path.exists(blob_path)
+
+    release_filter(cache_dir, MASK_TYPE, 'bob', 'default_id')
+    assert os.path.exists(blob_path)
+    assert read(find_filter_aggregate(cache_dir, 'bob', 'saved')) == b'aggregate'
+
+    release_filter(cache_dir, MASK_TYPE, 'bob', 'saved')
+    assert not os.path.exists(blob_path)
+    assert not os.path.exists(statistic_path)
+
+def test_relinking_releases_the_previous_blob(tmp_path, fake_redis):
+    cache_dir = str(tmp_path)
+    old_path = make_blob(cache_dir, 'old', b'old')
+    make_blob(cache_dir, 'new', b'new')
+
+    link_path = link(cache_dir, 'alice', 'default_id', 'old')
+    _, previous_key = link_filter(cache_dir, MASK_TYPE, 'alice', 'default_id', 'new')
+
+    assert previous_key == 'old'
+    assert read(link_path) == b'new'
+    release_key(cache_dir, MASK_TYPE, previous_key, 'alice', 'default_id')
+    assert not os.path.exists(old_path)
+
+    # Relinking the same key has nothing to release
+    assert link_filter(cache_dir, MASK_TYPE, 'alice', 'default_id', 'new')[1] is None
+
+def test_unlink_keeps_the_reference(tmp_path, fake_redis):
+    cache_dir = str(tmp_path)
+    blob_path = make_blob(cache_dir, 'k1')
+    make_blob(cache_dir, 'k1.mean')
+    link_path = link(cache_dir, 'alice', 'default_id', 'k1')
+    statistic_link = link_statistic(cache_dir, 'alice', 'default_id', 'k1', 'mean')
+    assert os.path.realpath(statistic_link) == os.path.realpath(get_statistic_blob_path(cache_dir, 'k1', 'mean'))
+
+    unlink_filter(cache_dir, 'alice', 'default_id')
+
+    assert not os.path.lexists(link_path)
+    assert not os.path.lexists(statistic_link)
+    assert os.path.exists(blob_path)
+    assert get_filter_key(MASK_TYPE, 'alice', 'default_id') == 'k1'
+
+def test_shared_aggregate_serves_owners_without_a_link(tmp_path, fake_redis):
+    cache_dir = str(tmp_path)
+    shared_path = get_shared_aggregate_path(cache_dir, 'default_id')
+    with open(shared_path, 'wb') as f:
+        f.write(b'shared')
+    make_blob(cache_dir, 'k1')
+
+    assert find_filter_aggregate(cache_dir, 'alice', 'default_id') == shared_path
+    assert get_blob_key(cache_dir, 'alice', 'default_id') is None
+
+    link(cache_dir, 'alice', 'default_id', 'k1')
+    assert read(find_filter_aggregate(cache_dir, 'alice', 'default_id')) == b'aggregate'
+    assert find_filter_aggregate(cache_dir, 'bob', 'default_id') == shared_path
+    assert find_filter_aggregate(cache_dir, 'bob', 'other') is None
+
+def test_equivalent_criteria_share_a_key():
+    criteria = {
+        'patient_demographics': {'origin_cancer': [{'label': 'Lung'}, 'Breast', 'Lung'], 'sex': []},
+        'clinical_data': {}
+    }
+    reordered = {'patient_demographics': {'origin_cancer': ['Breast', {'label': 'Lung', 'value': 3}]}}
+
+    assert normalize_criteria(criteria) == {'patient_demographics': {'origin_cancer': ['Breast', 'Lung']}}
+    assert aggregate_cache_key(MASK_TYPE, criteria, 1) == aggregate_cache_key(MASK_TYPE, reordered, 1)
+    assert aggregate_cache_key(MASK_TYPE, criteria, 1) != aggregate_cache_key('dose', criteria, 1)
+    assert aggregate_cache_key(MASK_TYPE, criteria, 1) != aggregate_cache_key(MASK_TYPE, criteria, 2)
+    assert aggregate_cache_key(MASK_TYPE, {}, 1) == aggregate_cache_key(MASK_TYPE, {'clinical_data': {}}, 1)
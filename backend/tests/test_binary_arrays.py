@@ -0,0 +1,131 @@
+"""The binary_arrays envelope, read back the way frontend/src/lib/binaryArrays.ts reads it."""
+
+import gzip
+import json
+import struct
+
+import numpy as np
+import pytest
+from flask import Flask
+
+from binary_arrays import ALIGNMENT, MAGIC, binary_response, pack_arrays, pack_volume, prefers_sparse, quantize
+
+def unpack(payload):
+    """Parse an envelope into (arrays, header)."""
+    assert payload[:4] == MAGIC
+    header_length, = struct.unpack('<I', payload[4:8])
+    header = json.loads(payload[8:8 + header_length])
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        assert entry['offset'] % ALIGNMENT == 0
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(payload, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+    return arrays, header
+
+def test_pack_arrays_round_trip():
+    arrays = {
+        'vertices': np.arange(30, dtype=np.float32).reshape(10, 3),
+        'faces': np.arange(7 * 3, dtype=np.uint32).reshape(7, 3),
+        'flags': np.array([1, 0, 1], dtype=np.uint8),
+        'empty': np.zeros((0, 3), dtype=np.float32),
+    }
+    unpacked, header = unpack(pack_arrays(arrays, lod=2, affine=np.eye(4).tolist()))
+
+    assert header['lod'] == 2
+    assert header['affine'] == np.eye(4).tolist()
+    assert set(unpacked) == set(arrays)
+    for name, array in arrays.items():
+        assert unpacked[name].dtype == array.dtype
+        np.testing.assert_array_equal(unpacked[name], array)
+
+def test_pack_arrays_writes_little_endian_c_order():
+    big_endian = np.arange(12, dtype='>i4').reshape(3, 4)
+    fortran = np.asfortranarray(np.arange(12, dtype=np.float64).reshape(3, 4))
+    unpacked, header = unpack(pack_arrays({'big': big_endian, 'fortran': fortran}))
+
+    assert header['arrays']['big']['dtype'] == '<i4'
+    np.testing.assert_array_equal(unpacked['big'], big_endian)
+    np.testing.assert_array_equal(unpacked['fortran'], fortran)
+
+def test_float32_is_sent_as_is():
+    values = np.array([-0.5, 0.25, 3.0])
+    quantized, scale = quantize(values, 'float32')
+    assert quantized.dtype == np.float32
+    assert scale == 1.0
+    np.testing.assert_array_equal(quantized, values.astype(np.float32))
+
+@pytest.mark.parametrize('encoding, dtype', [('uint8', np.uint8), ('uint16', np.uint16)])
+def test_quantize_is_within_half_a_step(encoding, dtype):
+    values = np.random.default_rng(0).random((4, 5, 6))
+    quantized, scale = quantize(values, encoding)
+    assert quantized.dtype == dtype
+    assert scale == 1.0 / np.iinfo(dtype).max
+    assert np.max(np.abs(quantized * scale - values)) <= scale / 2 + 1e-12
+    # The ends of the range are exact so empty and full voxels stay so
+    assert quantize(np.array([0.0, 1.0]), encoding)[0].tolist() == [0, np.iinfo(dtype).max]
+
+def test_quantize_clips_to_the_unit_range():
+    quantized, _ = quantize(np.array([-0.2, 1.7]), 'uint8')
+    assert quantized.tolist() == [0, 255]
+
+def test_dense_volume_round_trip():
+    volume, scale = quantize(np.random.default_rng(1).random((3, 4, 5)), 'uint16')
+    unpacked, header = unpack(pack_volume(volume, 'dense', scale=scale))
+    assert (header['layout'], header['dims'], header['scale']) == ('dense', [3, 4, 5], scale)
+    np.testing.assert_array_equal(unpacked['data'].reshape(header['dims']), volume)
+
+def test_binary_response_gzip_and_etag():
+    payload = pack_volume(np.zeros((8, 8, 8), dtype=np.uint8), 'dense')
+    app = Flask(__name__)
+
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = binary_response(payload, etag='abc', compress=True)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.get_etag() == ('abc-gz', False)
+        assert gzip.decompress(response.get_data()) == payload
+
+    with app.test_request_context():
+        response = binary_response(payload, etag='abc', compress=True)
+        assert 'Content-Encoding' not in response.headers
+        assert response.get_data() == payload
+
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"abc-gz"'}):
+        assert binary_response(payload, etag='abc', compress=True).status_code == 304
+    with app.test_request_context(headers={'If-None-Match': '"abc-gz"'}):
+        assert binary_response(payload, etag='abc', compress=True).status_code == 200
+
+def from_sparse(arrays, header):
+    """Rebuild a volume from the sparse layout as the client does."""
+    volume = np.zeros(int(np.prod(header['dims'])), dtype=arrays['values'].dtype)
+    volume[np.cumsum(arrays['deltas'], dtype=np.int64)] = arrays['values']
+    return volume.reshape(header['dims'])
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_sparse_volume_round_trip(dtype):
+    rng = np.random.default_rng(2)
+    volume = np.where(rng.random((6, 7, 8)) < 0.05, rng.integers(1, 200, (6, 7, 8)), 0).astype(dtype)
+    volume[0, 0, 0] = 7
+    volume[-1, -1, -1] = 9
+    unpacked, header = unpack(pack_volume(volume, 'sparse'))
+
+    assert header['layout'] == 'sparse'
+    assert header['count'] == np.count_nonzero(volume)
+    assert unpacked['deltas'].dtype == np.uint32
+    # The first delta is the first index itself
+    assert unpacked['deltas'][0] == 0
+    np.testing.assert_array_equal(from_sparse(unpacked, header), volume)
+
+def test_empty_volume_is_sparse_and_empty():
+    volume = np.zeros((4, 4, 4), dtype=np.uint8)
+    unpacked, header = unpack(pack_volume(volume))
+    assert (header['layout'], header['count']) == ('sparse', 0)
+    np.testing.assert_array_equal(from_sparse(unpacked, header), volume)
+
+def test_auto_layout_picks_the_smaller_one():
+    sparse = np.zeros((10, 10, 10), dtype=np.float32)
+    sparse[2:4, 2:4, 2:4] = 1.5
+    dense = np.ones((10, 10, 10), dtype=np.float32)
+    assert prefers_sparse(sparse) and not prefers_sparse(dense)
+    assert unpack(pack_volume(sparse))[1]['layout'] == 'sparse'
+    assert unpack(pack_volume(dense))[1]['layout'] == 'dense'
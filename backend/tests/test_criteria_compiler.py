@@ -0,0 +1,200 @@
+"""
+criteria_compiler against the per-filter queries it replaced.
+
+The reference queries below are the tumor query generate_display_nifti built before
+the compiler, filter by filter. Their age filter compared birth years, which the
+compiler deliberately replaced with exact completed years, so age is checked on its
+own against ages computed in Python.
+"""
+
+from datetime import date
+
+import pytest
+
+from db_loading.criteria_compiler import (
+    MASK_MODELS, age_predicate, cohort_counts_query, mask_ids_query, patient_ids_query, years_before
+)
+
+TODAY = date(2026, 6, 15)
+
+def make_patient(models, **fields):
+    defaults = {
+        'origin_cancer': 'Lung', 'tumor_count': 1, 'dob': date(1970, 1, 1), 'sex': 'F',
+        'height_cm': 165.0, 'weight_kg': 70.0, 'systolic_bp': 120, 'diastolic_bp': 80,
+        'date_of_original_diagnosis': date(2020, 1, 1), 'date_of_metastatic_diagnosis': date(2021, 1, 1)
+    }
+    return models.Patients(**{**defaults, **fields})
+
+def add_mask(db, models, patient, series_type, **fields):
+    nifti = models.NiftiData(patient=patient, series_type=series_type)
+    db.session.add(nifti)
+    db.session.flush()
+    bbox = {'x_min': 0, 'x_max': 1, 'y_min': 0, 'y_max': 1, 'z_min': 0, 'z_max': 1}
+    com = {'x_com': 0, 'y_com': 0, 'z_com': 0}
+    if series_type == 'tumor_mask':
+        db.session.add(models.TumorMask(id=nifti.id, location=fields['location'], volume_mm3=fields['volume_mm3'], **com, **bbox))
+    elif series_type == 'dose_mask':
+        db.session.add(models.DoseMask(id=nifti.id, max_dose=fields['max_dose'], volume_mm3=1.0, **com, **bbox))
+    else:
+        db.session.add(models.MRIMask(id=nifti.id))
+
+@pytest.fixture
+def cohort(database):
+    import models
+    db = database
+    patients = [
+        make_patient(models, origin_cancer='Lung', sex='F', height_cm=160, weight_kg=60, tumor_count=1,
+                     systolic_bp=110, diastolic_bp=70),
+        make_patient(models, origin_cancer='Breast', sex='F', height_cm=172, weight_kg=80, tumor_count=3,
+                     systolic_bp=140, diastolic_bp=95),
+        make_patient(models, origin_cancer='Melanoma', sex='M', height_cm=185, weight_kg=95, tumor_count=2,
+                     systolic_bp=125, diastolic_bp=85),
+        make_patient(models, origin_cancer='Lung', sex='M', height_cm=178, weight_kg=72, tumor_count=5,
+                     systolic_bp=160, diastolic_bp=100),
+    ]
+    db.session.add_all(patients)
+    db.session.flush()
+    tumors = [
+        (0, 'Frontal', 120.0), (0, 'Occipital', 15.0), (1, 'Frontal', 900.0), (2, 'Cerebellum', 40.0),
+        (2, 'Frontal', 300.0), (3, 'Occipital', 650.0)
+    ]
+    for index, location, volume in tumors:
+        add_mask(db, models, patients[index], 'tumor_mask', location=location, volume_mm3=volume)
+    for index, max_dose in [(0, 20), (1, 45), (1, 65), (3, 35)]:
+        add_mask(db, models, patients[index], 'dose_mask', max_dose=max_dose)
+    for index in [0, 2, 3]:
+        add_mask(db, models, patients[index], 'mri_mask')
+    db.session.commit()
+    return db
+
+def labels(selected):
+    return [item if isinstance(item, str) else item.get('label', str(item)) for item in selected]
+
+def ranges(column, selected, default_min, default_max):
+    return [column.between(item.get('min', default_min), item.get('max', default_max)) for item in selected]
+
+def old_tumor_ids(db, criteria):
+    """The pre-compiler tumor query, without its birth-year age filter."""
+    from models import Patients, TumorMask, NiftiData, DoseMask
+    query = db.session.query(TumorMask.id).join(
+        NiftiData, TumorMask.id == NiftiData.id
+    ).join(
+        Patients, NiftiData.patient_id == Patients.id
+    ).filter(NiftiData.series_type == 'tumor_mask')
+
+    demographics = criteria.get('patient_demographics') or {}
+    if demographics.get('origin_cancer'):
+        query = query.filter(Patients.origin_cancer.in_(labels(demographics['origin_cancer'])))
+    if demographics.get('sex'):
+        query = query.filter(Patients.sex.in_(labels(demographics['sex'])))
+    for key, column, default_min, default_max in [
+        ('height_range', Patients.height_cm, 0, 250),
+        ('weight_range', Patients.weight_kg, 0, 200),
+        ('tumor_count_range', Patients.tumor_count, 1, 100)
+    ]:
+        if demographics.get(key):
+            query = query.filter(db.or_(*ranges(column, demographics[key], default_min, default_max)))
+
+    clinical = criteria.get('clinical_data') or {}
+    for key, column, default_min, default_max in [
+        ('systolic_bp_range', Patients.systolic_bp, 0, 300),
+        ('diastolic_bp_range', Patients.diastolic_bp, 0, 200)
+    ]:
+        if clinical.get(key):
+            query = query.filter(db.or_(*ranges(column, clinical[key], default_min, default_max)))
+
+    tumor_characteristics = criteria.get('tumor_characteristics') or {}
+    if tumor_characteristics.get('tumor_location'):
+        query = query.filter(TumorMask.location.in_(labels(tumor_characteristics['tumor_location'])))
+    if tumor_characteristics.get('tumor_volume_range'):
+        query = query.filter(db.or_(*ranges(TumorMask.volume_mm3, tumor_characteristics['tumor_volume_range'], 0, 1000)))
+
+    treatment = criteria.get('treatment_data') or {}
+    if treatment.get('dose_range'):
+        dose_patient_ids = [row.id for row in db.session.query(Patients.id).join(
+            NiftiData, NiftiData.patient_id == Patients.id
+        ).join(
+            DoseMask, DoseMask.id == NiftiData.id
+        ).filter(
+            NiftiData.series_type == 'dose_mask',
+            db.or_(*ranges(DoseMask.max_dose, treatment['dose_range'], 0, 70))
+        ).all()]
+        if not dose_patient_ids:
+            return set()
+        query = query.filter(Patients.id.in_(dose_patient_ids))
+    return {row.id for row in query.all()}
+
+CRITERIA = [
+    {},
+    {'patient_demographics': {'origin_cancer': ['Lung']}},
+    {'patient_demographics': {'origin_cancer': [{'label': 'Lung'}, {'label': 'Melanoma'}], 'sex': ['M']}},
+    {'patient_demographics': {'height_range': [{'min': 150, 'max': 170}, {'min': 180, 'max': 190}]}},
+    {'patient_demographics': {'weight_range': [{'min': 70}], 'tumor_count_range': [{'max': 3}]}},
+    {'clinical_data': {'systolic_bp_range': [{'min': 120, 'max': 150}], 'diastolic_bp_range': [{'min': 80}]}},
+    {'tumor_characteristics': {'tumor_location': ['Frontal']}},
+    {'tumor_characteristics': {'tumor_location': ['Frontal', 'Occipital'], 'tumor_volume_range': [{'min': 100, 'max': 700}]}},
+    {'treatment_data': {'dose_range': [{'min': 30, 'max': 50}]}},
+    {'treatment_data': {'dose_range': [{'min': 66, 'max': 70}]}},
+    {
+        'patient_demographics': {'sex': ['F']},
+        'tumor_characteristics': {'tumor_location': ['Frontal']},
+        'treatment_data': {'dose_range': [{'min': 40}]}
+    },
+    {'patient_demographics': {'origin_cancer': [], 'sex': []}, 'clinical_data': {}},
+]
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_tumor_cohort_matches_old_query(cohort, criteria):
+    assert {row.id for row in mask_ids_query('tumor', criteria).all()} == old_tumor_ids(cohort, criteria)
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_counts_match_id_queries(cohort, criteria):
+    from models import NiftiData
+    counts = cohort_counts_query(criteria).one()
+    patients_with_masks = set()
+    for mask_type in MASK_MODELS:
+        ids = {row.id for row in mask_ids_query(mask_type, criteria).all()}
+        assert getattr(counts, f'{mask_type}_count') == len(ids)
+        if ids:
+            patients_with_masks |= {
+                row.patient_id for row in cohort.session.query(NiftiData.patient_id).filter(NiftiData.id.in_(ids)).all()
+            }
+    assert counts.total_patients == len(patients_with_masks)
+
+@pytest.mark.parametrize('criteria', CRITERIA)
+def test_patient_ids_cover_tumor_cohort(cohort, criteria):
+    from models import NiftiData
+    patient_ids = {row.id for row in patient_ids_query(criteria).all()}
+    tumor_ids = old_tumor_ids(cohort, criteria)
+    tumor_patients = {
+        row.patient_id for row in cohort.session.query(NiftiData.patient_id).filter(NiftiData.id.in_(tumor_ids)).all()
+    } if tumor_ids else set()
+    assert tumor_patients <= patient_ids
+
+def completed_years(dob, on_date):
+    return on_date.year - dob.year - ((on_date.month, on_date.day) < (dob.month, dob.day))
+
+def test_age_predicate_uses_completed_years(database):
+    import models
+    db = database
+    dobs = [
+        years_before(TODAY, 40),                                # 40 today
+        years_before(TODAY, 40).replace(day=16),                # 40 tomorrow, 39 today
+        years_before(TODAY, 50).replace(day=14),                # turned 50 yesterday
+        years_before(TODAY, 51).replace(day=16),                # 51 tomorrow, 50 today
+        date(1976, 2, 29),                                      # leap-day birthday
+    ]
+    db.session.add_all([make_patient(models, dob=dob) for dob in dobs])
+    db.session.commit()
+
+    for selected in [[{'min': 40, 'max': 40}], [{'min': 40, 'max': 49}], [{'min': 50, 'max': 50}], [{'min': 39, 'max': 39}, {'min': 50}]]:
+        matched = {row.dob for row in db.session.query(models.Patients.dob).filter(age_predicate(selected, TODAY)).all()}
+        expected = {
+            dob for dob in dobs
+            if any(item.get('min', 0) <= completed_years(dob, TODAY) <= item.get('max', 150) for item in selected)
+        }
+        assert matched == expected, selected
+
+def test_years_before_maps_leap_day_to_february_28():
+    assert years_before(date(2024, 2, 29), 1) == date(2023, 2, 28)
+    assert years_before(date(2024, 2, 29), 4) == date(2020, 2, 29)
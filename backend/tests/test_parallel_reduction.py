@@ -0,0 +1,137 @@
+"""Sharded and streamed mask sums against the serial sum."""
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from db_loading import parallel_reduction
+from db_loading.parallel_reduction import (
+    accumulate_cropped_masks, accumulate_mask_files, accumulator_dtype, parallel_accumulate, split_into_shards,
+    stream_accumulate
+)
+
+SHAPE = (6, 7, 8)
+
+@pytest.fixture(scope='module', autouse=True)
+def shutdown_pool():
+    yield
+    if parallel_reduction._pool is not None:
+        parallel_reduction._pool.shutdown()
+        parallel_reduction._pool = None
+
+def write_masks(directory, volumes):
+    paths = []
+    for i, volume in enumerate(volumes):
+        path = str(directory / f"mask{i}.nii.gz")
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+        paths.append(path)
+    return paths
+
+def binary_masks(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(rng.random(SHAPE) < 0.3).astype(np.uint8) for _ in range(count)]
+
+def float_masks(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.normal(0, 3, SHAPE).astype(np.float32) for _ in range(count)]
+
+def test_split_into_shards_keeps_order():
+    items = list(range(10))
+    shards = split_into_shards(items, 3)
+    assert len(shards) == 3
+    assert [item for shard in shards for item in shard] == items
+
+def test_parallel_sum_of_counts_equals_serial_sum(tmp_path):
+    volumes = binary_masks(12)
+    paths = write_masks(tmp_path, volumes)
+
+    serial, _, serial_count = accumulate_mask_files(paths, dtype=np.uint16)
+    combined, affine, loaded_count = parallel_accumulate(paths, num_workers=2, shard_size=3, dtype=np.uint16)
+
+    assert loaded_count == serial_count == len(paths)
+    assert combined.dtype == np.uint16
+    assert np.array_equal(combined, serial)
+    assert np.array_equal(combined, np.sum(volumes, axis=0))
+    assert np.array_equal(affine, np.eye(4))
+
+def test_parallel_sum_of_floats_is_close_to_serial_sum(tmp_path):
+    volumes = float_masks(12)
+    paths = write_masks(tmp_path, volumes)
+
+    serial, _, _ = accumulate_mask_files(paths, dtype=np.float32)
+    combined, _, _ = parallel_accumulate(paths, num_workers=2, shard_size=3, dtype=np.float32)
+
+    # Shards are rounded separately, so only the last bits may differ
+    np.testing.assert_allclose(combined, serial, rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(combined, np.sum(volumes, axis=0, dtype=np.float64), rtol=1e-5, atol=1e-4)
+
+def test_cropped_sum_equals_full_sum(tmp_path):
+    volumes = []
+    bboxes = []
+    for i, volume in enumerate(binary_masks(8, seed=1)):
+        # Confine each mask to a box so the box holds all its voxels
+        z0, y0, x0 = i % 3, i % 4, i % 5
+        box = (z0, z0 + 2, y0, y0 + 2, x0, x0 + 2)
+        confined = np.zeros_like(volume)
+        region = parallel_reduction.bbox_slices(box)
+        confined[region] = volume[region]
+        volumes.append(confined)
+        bboxes.append(box)
+    paths = write_masks(tmp_path, volumes)
+
+    full, _, _ = accumulate_mask_files(paths, dtype=np.uint16)
+    cropped, _, loaded_count = accumulate_cropped_masks(list(zip(paths, bboxes)), dtype=np.uint16)
+
+    assert loaded_count == len(paths)
+    assert np.array_equal(cropped, full)
+
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_stream_sum_equals_serial_sum(tmp_path, num_workers):
+    volumes = binary_masks(10, seed=2)
+    paths = write_masks(tmp_path, volumes)
+    batches = [paths[0:4], [], paths[4:7], paths[7:10]]
+    reports = []
+
+    combined, _, loaded_count, item_count, state = stream_accumulate(
+        iter(batches), 'tumor', num_workers, progress=lambda processed, total: reports.append((processed, total)),
+        expected_count=len(paths)
+    )
+
+    assert (loaded_count, item_count, state) == (len(paths), len(paths), None)
+    assert np.array_equal(combined, np.sum(volumes, axis=0))
+    assert reports[-1] == (len(paths), len(paths))
+
+def test_missing_files_are_skipped(tmp_path):
+    paths = write_masks(tmp_path, binary_masks(3, seed=3))
+    combined, _, loaded_count = accumulate_mask_files(paths + [str(tmp_path / 'missing.nii.gz')], dtype=np.uint16)
+    assert loaded_count == 3
+    assert combined.shape == SHAPE
+
+def test_accumulator_dtype_is_compact():
+    assert accumulator_dtype('tumor', 1) == np.uint16
+    assert accumulator_dtype('tumor', np.iinfo(np.uint16).max) == np.uint16
+    assert accumulator_dtype('tumor', np.iinfo(np.uint16).max + 1) == np.uint32
+    assert accumulator_dtype('mri', 10) == np.float32
+    assert accumulator_dtype('dose', 10) == np.float32
+
+def test_masks_add_into_the_accumulator_dtype(tmp_path):
+    volumes = [volume.astype(np.float32) for volume in binary_masks(5, seed=4)]
+    paths = write_masks(tmp_path, volumes)
+    combined, _, _ = accumulate_mask_files(paths, dtype=np.uint16)
+    assert combined.dtype == np.uint16
+    assert np.array_equal(combined, np.sum(volumes, axis=0))
+
+def test_stream_widens_the_running_sum_before_it_overflows(tmp_path, monkeypatch):
+    # uint8 until 255 masks so that widening happens within a small cohort
+    def narrow_dtype(mask_type, mask_count):
+        return np.dtype(np.uint8) if mask_count <= np.iinfo(np.uint8).max else np.dtype(np.uint16)
+    monkeypatch.setattr(parallel_reduction, 'accumulator_dtype', narrow_dtype)
+
+    path, = write_masks(tmp_path, [np.ones(SHAPE, dtype=np.uint8)])
+    batches = [[path] * 50 for _ in range(6)]
+
+    combined, _, loaded_count, _, _ = stream_accumulate(iter(batches), 'tumor', 1)
+
+    assert loaded_count == 300
+    assert combined.dtype == np.uint16
+    assert np.all(combined == 300)
@@ -0,0 +1,125 @@
+"""Streaming voxel statistics against NumPy over the whole cohort."""
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+from db_loading.parallel_reduction import bbox_slices
+from db_loading.voxel_statistics import (
+    PERCENTILE_BINS, VoxelStatistics, accumulate_with_statistics, get_percentile_range, parse_statistic
+)
+
+SHAPE = (5, 6, 7)
+VALUE_RANGE = (-4.0, 6.0)
+STATISTICS = ['sum', 'mean', 'std', 'max', 'min', 'count_above_1', 'count_above_-0.5', 'p50', 'p90']
+
+def cohort(count=40, seed=0):
+    """Masks as (block, region) pairs, half of them only inside a box, and the dense volumes they stand for."""
+    rng = np.random.default_rng(seed)
+    items, volumes = [], []
+    for i in range(count):
+        volume = rng.uniform(*VALUE_RANGE, SHAPE).astype(np.float32)
+        if i % 2:
+            region = bbox_slices((i % 3, i % 3 + 2, i % 4, i % 4 + 1, i % 5, i % 5 + 2))
+            dense = np.zeros(SHAPE, dtype=np.float32)
+            dense[region] = volume[region]
+            items.append((volume[region], region))
+            volumes.append(dense)
+        else:
+            items.append((volume, None))
+            volumes.append(volume)
+    return items, np.stack(volumes)
+
+def run(items, statistics=STATISTICS):
+    state = VoxelStatistics(statistics, VALUE_RANGE)
+    for block, region in items:
+        assert state.update(block, region, SHAPE)
+    return state
+
+def test_parse_statistic():
+    assert parse_statistic('mean') == ('mean', None)
+    assert parse_statistic('count_above_-2.5') == ('count_above', -2.5)
+    assert parse_statistic('p90') == ('percentile', 90.0)
+    for name in ['median', 'p101', 'count_above_', 'std2']:
+        with pytest.raises(ValueError):
+            parse_statistic(name)
+
+def test_statistics_match_numpy():
+    items, volumes = cohort()
+    results = run(items).results()
+
+    np.testing.assert_allclose(results['sum'], volumes.sum(axis=0), rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(results['mean'], volumes.mean(axis=0), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(results['std'], volumes.std(axis=0), rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(results['max'], volumes.max(axis=0))
+    np.testing.assert_array_equal(results['min'], volumes.min(axis=0))
+    np.testing.assert_array_equal(results['count_above_1'], (volumes > 1).sum(axis=0))
+    # Voxels outside a mask's box are zero, which is above a negative threshold
+    np.testing.assert_array_equal(results['count_above_-0.5'], (volumes > -0.5).sum(axis=0))
+
+def test_box_updates_equal_dense_updates():
+    items, volumes = cohort(seed=1)
+    boxed = run(items).results()
+    dense = run([(volume, None) for volume in volumes]).results()
+    for name in STATISTICS:
+        np.testing.assert_allclose(boxed[name], dense[name], rtol=1e-5, atol=1e-5, err_msg=name)
+
+@pytest.mark.parametrize('split', [1, 7, 20, 39])
+def test_merge_equals_single_pass(split):
+    items, _ = cohort(seed=2)
+    single = run(items).results()
+    merged = run(items[:split]).merge(run(items[split:])).results()
+    for name in STATISTICS:
+        np.testing.assert_allclose(merged[name], single[name], rtol=1e-6, atol=1e-6, err_msg=name)
+
+def test_merge_with_empty_state():
+    items, _ = cohort(count=6, seed=3)
+    state = run(items)
+    expected = state.results()
+    merged = VoxelStatistics(STATISTICS, VALUE_RANGE).merge(state).merge(VoxelStatistics(STATISTICS, VALUE_RANGE))
+    for name in STATISTICS:
+        np.testing.assert_array_equal(merged.results()[name], expected[name])
+
+def test_percentiles_are_within_a_bin_of_numpy():
+    items, volumes = cohort(count=200, seed=4)
+    results = run(items).results()
+    # Zero is always inside the bins, so the width is that of the range itself here
+    bin_width = (VALUE_RANGE[1] - VALUE_RANGE[0]) / PERCENTILE_BINS
+    for percentile in [50, 90]:
+        exact = np.percentile(volumes, percentile, axis=0)
+        assert np.max(np.abs(results[f'p{percentile}'] - exact)) <= 2 * bin_width
+
+def test_mismatched_shape_is_rejected():
+    state = VoxelStatistics(['mean'])
+    assert state.update(np.ones(SHAPE))
+    assert not state.update(np.ones((2, 2, 2)))
+    assert state.count == 1
+
+def test_percentiles_need_a_value_range(tmp_path):
+    with pytest.raises(ValueError):
+        VoxelStatistics(['p90'])
+    assert get_percentile_range(None, 'mri', ['mean', 'std']) is None
+    assert get_percentile_range(None, 'tumor', ['p90']) == (0.0, 1.0)
+    with pytest.raises(ValueError):
+        get_percentile_range(str(tmp_path), 'dose', ['p90'])
+
+def test_accumulate_with_statistics_reads_boxes_only(tmp_path):
+    items, volumes = cohort(count=10, seed=5)
+    paths = []
+    for i, volume in enumerate(volumes):
+        path = str(tmp_path / f"mask{i}.nii.gz")
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+        # Boxes as stored for tumor masks: inclusive (z_min, z_max, y_min, y_max, x_min, x_max)
+        region = items[i][1]
+        bbox = None if region is None else tuple(bound for axis in region for bound in (axis.start, axis.stop - 1))
+        paths.append((path, bbox) if bbox else path)
+
+    combined, affine, loaded_count, state = accumulate_with_statistics(
+        paths, dtype=np.float64, statistics=['mean', 'max'], value_range=VALUE_RANGE
+    )
+
+    assert loaded_count == len(paths)
+    np.testing.assert_allclose(combined, volumes.sum(axis=0), rtol=1e-5, atol=1e-4)
+    results = state.results()
+    np.testing.assert_allclose(results['mean'], volumes.mean(axis=0), rtol=1e-5, atol=1e-5)
+    np.testing.assert_array_equal(results['max'], volumes.max(axis=0))
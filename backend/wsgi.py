@@ -0,0 +1,12 @@
+"""
+WSGI entry point for production servers.
+
+Importing this module loads the app and preloads the glass brain surface. Under
+gunicorn --preload that happens once in the master before the workers fork, so every
+worker starts with the mesh in memory, shared copy-on-write.
+"""
+
+from app import app
+from blueprints.glass_brain import preload_brain_surface
+
+preload_brain_surface()
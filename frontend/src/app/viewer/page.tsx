@@ -6,6 +6,7 @@ import DataView from '@/components/DataView';
 import PatientSearch from '@/components/PatientSearch';
 import LeftSidebar from '@/components/LeftSidebar';
 import dynamic from 'next/dynamic';
+import { JobStatus, waitForJob } from '@/lib/jobs';
 
 const DynamicFilter = dynamic(() => import('@/components/filter'), {
   ssr: false
@@ -34,6 +35,9 @@ export default function Viewer() {
   const [isClient, setIsClient] = useState(false);
   const [iframeTranslateX, setIframeTranslateX] = useState(0);
   const [refreshTrigger, setRefreshTrigger] = useState(0);
+  // Aggregation jobs of filters that were just created or edited, by filter id
+  const [filterJobs, setFilterJobs] = useState<Record<string, JobStatus>>({});
+  const activeFilterIdRef = useRef<string | null>(null);
   
   const iframeRef = useRef<HTMLIFrameElement>(null);
   const sidebarRef = useRef<HTMLDivElement>(null);
@@ -44,6 +48,43 @@ export default function Viewer() {
     setIsClient(true);
   }, []);
 
+  useEffect(() => {
+    activeFilterIdRef.current = activeFilterId;
+  }, [activeFilterId]);
+
+  // Filter creates and edits return before the filter's aggregate is built. Poll the
+  // job here, where polling outlives the filter panel, and reload the viewers once it
+  // is done if they show that filter.
+  const handleFilterJob = async (filterId: string, jobId: string | null) => {
+    const refreshIfActive = () => {
+      if (filterId === activeFilterIdRef.current) {
+        setRefreshTrigger(prev => prev + 1);
+      }
+    };
+    if (!jobId) {
+      // Built synchronously
+      refreshIfActive();
+      return;
+    }
+    try {
+      const status = await waitForJob(jobId, (status) => {
+        setFilterJobs(prev => ({ ...prev, [filterId]: status }));
+      });
+      if (status?.state === 'failed') {
+        console.error(`Building filter ${filterId} failed:`, status.error);
+      }
+      refreshIfActive();
+    } catch (error) {
+      console.error(`Error polling job for filter ${filterId}:`, error);
+    } finally {
+      setFilterJobs(prev => {
+        const rest = { ...prev };
+        delete rest[filterId];
+        return rest;
+      });
+    }
+  };
+
   useEffect(() => {
     fetch(`/api/filters/get_current`, {
       credentials: 'include'  // Include session cookies
@@ -218,6 +259,8 @@ export default function Viewer() {
             toggleFilter={setFilterShowing}
             activeFilterId={activeFilterId}
             onFilterChange={handleFilterChange}
+            onFilterJob={handleFilterJob}
+            filterJobs={filterJobs}
             onWidthChange={setFilterWidth}
             onFullScreenChange={setIsFilterFullScreen}
             activeMaskType={activeMaskType}
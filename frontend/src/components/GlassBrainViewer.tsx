@@ -5,6 +5,7 @@ import { Canvas } from '@react-three/fiber';
 import { OrbitControls, useProgress, Html } from '@react-three/drei';
 import * as THREE from 'three';
 import VolumeRenderer from './VolumeRenderer';
+import { fetchBinaryArrays } from '@/lib/binaryArrays';
 
 function Loader() {
   const { progress } = useProgress();
@@ -12,10 +13,14 @@ function Loader() {
 }
 
 interface MeshData {
-    vertices: number[][];
-    faces: number[][];
+    vertices: Float32Array;
+    faces: Uint32Array;
 }
 
+// Levels of detail served by /api/glass_brain/brain_surface: 2 is the 10k-vertex fsaverage5
+const COARSE_LOD = 2;
+const FULL_LOD = 0;
+
 interface GlassBrainViewerProps {
     refreshTrigger?: number;
 }
@@ -49,24 +54,33 @@ export default function GlassBrainViewer({ refreshTrigger = 0 }: GlassBrainViewe
     const [meshData, setMeshData] = useState<MeshData | null>(null);
     const [error, setError] = useState<string | null>(null);
 
-    // Fetch brain mesh data
+    // Fetch brain mesh data: a coarse shell first, then the full-density surface
     useEffect(() => {
-        fetch('/api/glass_brain/brain_surface')
-            .then(res => res.json())
-            .then(data => {
-                if (data.error) throw new Error(data.error);
-                setMeshData(data);
-            }).catch(e => {
+        let cancelled = false;
+        const loadLevel = (lod: number) =>
+            fetchBinaryArrays(`/api/glass_brain/brain_surface?format=binary&lod=${lod}`)
+                .then(({ arrays }) => {
+                    if (cancelled) return;
+                    setMeshData({
+                        vertices: arrays.vertices as Float32Array,
+                        faces: arrays.faces as Uint32Array
+                    });
+                });
+
+        loadLevel(COARSE_LOD)
+            .then(() => loadLevel(FULL_LOD))
+            .catch(e => {
                 console.error("Fetch error:", e);
-                setError(e.message);
+                if (!cancelled) setError(e.message);
             });
+        return () => { cancelled = true; };
     }, [refreshTrigger]);
 
     const brainGeometry = useMemo(() => {
         if (!meshData) return null;
         const geom = new THREE.BufferGeometry();
-        geom.setAttribute('position', new THREE.Float32BufferAttribute(meshData.vertices.flat(), 3));
-        geom.setIndex(meshData.faces.flat());
+        geom.setAttribute('position', new THREE.BufferAttribute(meshData.vertices, 3));
+        geom.setIndex(new THREE.BufferAttribute(meshData.faces, 1));
         geom.computeVertexNormals();
         return geom;
     }, [meshData]);
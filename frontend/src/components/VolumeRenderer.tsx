@@ -4,6 +4,7 @@ import React, { useRef, useState, useEffect, useMemo } from 'react';
 import { useFrame } from '@react-three/fiber';
 import * as THREE from 'three';
 import { Html } from '@react-three/drei';
+import { fetchBinaryArrays, denseVolume, type VolumeMeta } from '@/lib/binaryArrays';
 
 // Vertex shader for the volume's bounding box
 const volumeVertexShader = `
@@ -87,7 +88,8 @@ const volumeFragmentShader = `
 
 interface VolumeData {
     dims: [number, number, number];
-    rawData: number[];
+    // Normalized volume quantized to uint8 (value / 255)
+    data: Uint8Array;
     affine: number[][];
 }
 
@@ -101,10 +103,10 @@ export default function VolumeRenderer({ brainSize, refreshTrigger = 0 }: Volume
     const [error, setError] = useState<string | null>(null);
 
     useEffect(() => {
-        fetch('/api/glass_brain/volume_data').then(res => res.json())
-        .then(data => {
-            if (data.error) throw new Error(data.error);
-            setVolumeData(data);
+        fetchBinaryArrays<VolumeMeta>('/api/glass_brain/volume_data?format=binary&encoding=uint8')
+        .then(volume => {
+            const { dims, affine } = volume.meta;
+            setVolumeData({ dims: dims as [number, number, number], data: denseVolume(volume) as Uint8Array, affine });
         }).catch(e => {
             console.error("Fetch error:", e);
             setError(e.message);
@@ -113,10 +115,11 @@ export default function VolumeRenderer({ brainSize, refreshTrigger = 0 }: Volume
 
     const { texture, colormap, uniforms } = useMemo(() => {
         if (!volumeData) return { texture: null, colormap: null, uniforms: null };
-        const { dims, rawData } = volumeData;
-        const tex = new THREE.Data3DTexture(new Float32Array(rawData), dims[0], dims[1], dims[2]);
+        const { dims, data } = volumeData;
+        // An R8 texture samples as value / 255, i.e. the normalized volume the shader expects
+        const tex = new THREE.Data3DTexture(data, dims[0], dims[1], dims[2]);
         tex.format = THREE.RedFormat;
-        tex.type = THREE.FloatType;
+        tex.type = THREE.UnsignedByteType;
         tex.minFilter = tex.magFilter = THREE.LinearFilter;
         tex.unpackAlignment = 1;
         tex.needsUpdate = true;
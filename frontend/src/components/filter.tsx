@@ -2,6 +2,7 @@ import React, { useState, useEffect } from 'react';
 import { v4 as uuidv4 } from 'uuid';
 import { Maximize2, X, BarChart3, Loader2, Users, Brain, Stethoscope, Pill } from 'lucide-react';
 import { useResizable } from '../hooks/useResizable';
+import { JobStatus } from '../lib/jobs';
 
 // Types based on database models
 interface FilterOption {
@@ -20,6 +21,7 @@ interface FilterOptions {
     origin_cancer: FilterCategory;
     sex: FilterCategory;
     age_range: FilterCategory;
+    age_at_diagnosis_range: FilterCategory;
     height_range: FilterCategory;
     weight_range: FilterCategory;
     tumor_count_range: FilterCategory;
@@ -64,6 +66,8 @@ interface FilterProps {
   toggleFilter: React.Dispatch<React.SetStateAction<boolean>>;
   activeFilterId: string | null;
   onFilterChange: (filterId: string) => void;
+  onFilterJob?: (filterId: string, jobId: string | null) => void;
+  filterJobs?: Record<string, JobStatus>;
   onWidthChange?: (width: number) => void;
   onFullScreenChange?: (isFullScreen: boolean) => void;
   activeMaskType: string;
@@ -97,6 +101,20 @@ export default function Filter(props: FilterProps) {
     }
   }, [isFullScreen, props.onFullScreenChange]);
 
+  const renderJobStatus = (filterId: string) => {
+    const job = props.filterJobs?.[filterId];
+    if (!job) {
+      return null;
+    }
+    const percent = job.total ? Math.round((job.processed / job.total) * 100) : null;
+    return (
+      <span className='ml-2 inline-flex items-center text-xs text-gray-500' title='Building the filter aggregate'>
+        <Loader2 className='w-3 h-3 mr-1 animate-spin' />
+        {percent !== null ? `${percent}%` : 'Building'}
+      </span>
+    );
+  };
+
   // Modal states
   const [modalFilter, setModalFilter] = useState<FilterItem | null>(null);
   const [modalStats, setModalStats] = useState<any>(null);
@@ -418,6 +436,7 @@ export default function Filter(props: FilterProps) {
                             <div className='col-span-8'>
                               <div className="text-sm font-medium text-gray-900 truncate" title={filter.name}>
                                 {filter.name}
+                                {renderJobStatus(filter.id)}
                               </div>
                             </div>
                             <div className='col-span-3 flex gap-2 justify-end'>
@@ -472,6 +491,7 @@ export default function Filter(props: FilterProps) {
                               <div className='col-span-10'>
                                 <div className="text-sm font-medium text-gray-900 truncate" title={filter.name}>
                                   {filter.name}
+                                  {renderJobStatus(filter.id)}
                                 </div>
                               </div>
                             </div>
@@ -731,6 +751,7 @@ export default function Filter(props: FilterProps) {
                       .then(response => response.json())
                       .then(data => {
                         setFilters(prev => [...prev, newFilter]);
+                        props.onFilterJob?.(newFilter.id, data.job_id ?? null);
                         setNewFilterName('');
                         setNewFilterCriteria({});
                         setNewFilterModal(false);
@@ -803,6 +824,7 @@ export default function Filter(props: FilterProps) {
                       })
                       .then(response => response.json())
                       .then(data => {
+                        props.onFilterJob?.(editFilterModal.id, data.job_id ?? null);
                         setFilters(prev => prev.map(f => 
                           f.id === editFilterModal.id 
                             ? { ...f, name: editFilterName, criteria: editFilterCriteria }
@@ -0,0 +1,107 @@
+// Parser for the binary array envelope written by backend/binary_arrays.py:
+// magic "NDA1", uint32 header length, JSON header, then 8-byte aligned little-endian arrays.
+
+export type TypedArray =
+  | Float32Array
+  | Float64Array
+  | Uint8Array
+  | Int8Array
+  | Uint16Array
+  | Int16Array
+  | Uint32Array
+  | Int32Array;
+
+interface ArrayEntry {
+  dtype: string;
+  shape: number[];
+  offset: number;
+}
+
+export interface BinaryArrays<Meta = Record<string, unknown>> {
+  arrays: Record<string, TypedArray>;
+  shapes: Record<string, number[]>;
+  meta: Meta;
+}
+
+const TYPED_ARRAYS: Record<string, new (buffer: ArrayBuffer, offset: number, length: number) => TypedArray> = {
+  f4: Float32Array,
+  f8: Float64Array,
+  u1: Uint8Array,
+  i1: Int8Array,
+  u2: Uint16Array,
+  i2: Int16Array,
+  u4: Uint32Array,
+  i4: Int32Array,
+};
+
+const MAGIC = 'NDA1';
+
+export function parseBinaryArrays<Meta = Record<string, unknown>>(buffer: ArrayBuffer): BinaryArrays<Meta> {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic !== MAGIC) {
+    throw new Error(`Unexpected binary payload (magic "${magic}")`);
+  }
+  const headerLength = view.getUint32(4, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+
+  const arrays: Record<string, TypedArray> = {};
+  const shapes: Record<string, number[]> = {};
+  for (const [name, entry] of Object.entries(header.arrays as Record<string, ArrayEntry>)) {
+    // dtype strings look like "<f4" or "|u1"
+    const ArrayType = TYPED_ARRAYS[entry.dtype.slice(1)];
+    if (!ArrayType || entry.dtype[0] === '>') {
+      throw new Error(`Unsupported dtype ${entry.dtype} for ${name}`);
+    }
+    const length = entry.shape.reduce((size, dim) => size * dim, 1);
+    arrays[name] = new ArrayType(buffer, entry.offset, length);
+    shapes[name] = entry.shape;
+  }
+
+  const meta = { ...header };
+  delete meta.arrays;
+  return { arrays, shapes, meta: meta as Meta };
+}
+
+export async function fetchBinaryArrays<Meta = Record<string, unknown>>(url: string): Promise<BinaryArrays<Meta>> {
+  const res = await fetch(url);
+  if (!res.ok) {
+    let message = `Request failed with status ${res.status}`;
+    try {
+      const data = await res.json();
+      if (data.error) message = data.error;
+    } catch {
+      // Not a JSON error body
+    }
+    throw new Error(message);
+  }
+  return parseBinaryArrays<Meta>(await res.arrayBuffer());
+}
+
+export interface VolumeMeta {
+  layout: 'dense' | 'sparse';
+  dims: number[];
+  affine: number[][];
+  scale: number;
+  min: number;
+  max: number;
+}
+
+// Expand a volume from pack_volume into a dense typed array in C order,
+// scattering the values of the sparse layout at their delta-decoded indices.
+export function denseVolume({ arrays, meta }: BinaryArrays<VolumeMeta>): TypedArray {
+  if (meta.layout !== 'sparse') {
+    return arrays.data;
+  }
+  const size = meta.dims.reduce((total, dim) => total * dim, 1);
+  const values = arrays.values;
+  const deltas = arrays.deltas;
+  const ValuesType = values.constructor as new (length: number) => TypedArray;
+  const dense = new ValuesType(size);
+  let index = 0;
+  for (let i = 0; i < deltas.length; i++) {
+    index += deltas[i];
+    dense[index] = values[i];
+  }
+  return dense;
+}
@@ -0,0 +1,39 @@
+// Polling for background jobs started by the backend (see backend/job_queue.py),
+// e.g. the aggregation a filter create or edit queues.
+
+export interface JobStatus {
+  id: string;
+  state: 'queued' | 'running' | 'finished' | 'failed';
+  processed: number;
+  total: number | null;
+  eta_seconds: number | null;
+  error: string | null;
+}
+
+const POLL_INTERVAL_MS = 1000;
+
+export async function fetchJob(jobId: string): Promise<JobStatus> {
+  const res = await fetch(`/api/jobs/${jobId}`, { credentials: 'include' });
+  if (!res.ok) {
+    throw new Error(`Job ${jobId} request failed with status ${res.status}`);
+  }
+  return res.json();
+}
+
+// Poll a job until it finishes or fails, reporting every status on the way.
+// Resolves with the last status; stops early (resolving null) once signal is aborted.
+export async function waitForJob(
+  jobId: string,
+  onStatus?: (status: JobStatus) => void,
+  signal?: AbortSignal,
+): Promise<JobStatus | null> {
+  while (!signal?.aborted) {
+    const status = await fetchJob(jobId);
+    onStatus?.(status);
+    if (status.state === 'finished' || status.state === 'failed') {
+      return status;
+    }
+    await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL_MS));
+  }
+  return null;
+}